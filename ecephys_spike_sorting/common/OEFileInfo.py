@@ -46,13 +46,95 @@ class OEContinuousFile:
         else:
             return False
         
-    def load(self):
-        
-        rawData = np.memmap(self.datafile, dtype='int16', mode='r')
-        data = np.reshape(rawData, (int(rawData.size/self.num_channels),self. num_channels)) * self.bit_volts[0]
-        
-        return data
-    
+    def load(self, dtype = 'float64'):
+
+        """
+        Returns a lazy, scaled view of the data (samples x channels)
+
+        Nothing is read until the view is sliced; each slice is scaled by
+        the per-channel bit_volts and returned as dtype (e.g. 'float32'
+        to halve the memory of large reads).
+        """
+
+        return ScaledContinuousData(self.datafile, self.num_channels, self.bit_volts,
+                                    tsfile = self.tsfile, dtype = dtype)
+
+
+class ScaledContinuousData:
+
+    """
+
+    Sliceable view of a continuous.dat file, scaled to microvolts on access
+
+    Indexing works like a (samples x channels) numpy array, e.g.
+    data[start:end, channels]; only the requested rows are read from the
+    memory-mapped file. time_slice() selects rows by timestamp instead of
+    sample index, using timestamps.npy.
+
+    """
+
+    def __init__(self, datafile, num_channels, bit_volts, tsfile = None, dtype = 'float64'):
+
+        rawData = np.memmap(datafile, dtype='int16', mode='r')
+        self.raw = np.reshape(rawData, (int(rawData.size/num_channels), num_channels))
+        self.bit_volts = np.asarray(bit_volts, dtype = dtype)
+        self.tsfile = tsfile
+        self.dtype = np.dtype(dtype)
+        self._timestamps = None
+
+    @property
+    def shape(self):
+        return self.raw.shape
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __len__(self):
+        return self.raw.shape[0]
+
+    def __getitem__(self, index):
+
+        if not isinstance(index, tuple):
+            index = (index,)
+
+        rows = index[0]
+        cols = index[1] if len(index) > 1 else slice(None)
+
+        # select channels before converting, so only the requested values
+        # are scaled; bit_volts[cols] broadcasts like the selected columns
+        data = np.asarray(self.raw[rows, cols], dtype = self.dtype)
+
+        return data * self.bit_volts[cols]
+
+    def __array__(self, dtype = None, copy = None):
+
+        data = self[:, :]
+
+        return data if dtype is None else data.astype(dtype)
+
+    @property
+    def timestamps(self):
+
+        """ Timestamp of each sample, loaded (memory-mapped) on first use """
+
+        if self._timestamps is None:
+            self._timestamps = np.load(self.tsfile, mmap_mode = 'r')
+
+        return self._timestamps
+
+    def time_slice(self, start_time, end_time, channels = slice(None)):
+
+        """
+        Returns the scaled samples with start_time <= timestamp < end_time
+
+        Timestamps are assumed to increase monotonically.
+        """
+
+        start, end = np.searchsorted(self.timestamps, [start_time, end_time])
+
+        return self[start:end, channels]
+
 
 
 def get_lfp_channel_order():
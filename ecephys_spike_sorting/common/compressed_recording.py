@@ -0,0 +1,251 @@
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+class CompressedRecording():
+
+    """
+    Random-access reader for a chunk-compressed binary recording (.cbin)
+
+    The recording is split into chunks of consecutive samples; each chunk is
+    differenced along time and compressed losslessly with zlib. A JSON index
+    (.ch file, same name as the .cbin) holds the sample and byte bounds of
+    every chunk, so any range of samples is read by decompressing only the
+    chunks it covers. The most recently used decompressed chunks are kept in
+    an LRU cache.
+
+    Indexing works like the (samples x channels) memmap of the uncompressed
+    file, e.g. data[start:end, channels], and returns int16 arrays.
+
+    Example:
+    --------
+    data = CompressedRecording('recording.imec0.ap.cbin')
+    snippet = data[1000:1082, :]
+
+    """
+
+    def __init__(self, cbin_file, ch_file = None, cache_size = 16):
+
+        """
+        cbin_file : String
+            Path of the compressed file
+        ch_file : String (optional)
+            Path of the chunk index; default is the .cbin path with a .ch extension
+        cache_size : int
+            Number of decompressed chunks to keep in memory
+        """
+
+        if ch_file is None:
+            ch_file = os.path.splitext(cbin_file)[0] + '.ch'
+
+        with open(ch_file) as f:
+            info = json.load(f)
+
+        self.filename = cbin_file
+        self.dtype = np.dtype(info['dtype'])
+        self.num_channels = int(info['n_channels'])
+        self.sample_rate = info.get('sample_rate')
+        self.time_diff = info['do_time_diff']
+
+        self.chunk_bounds = np.asarray(info['chunk_bounds'], dtype = 'int64')
+        self.chunk_offsets = np.asarray(info['chunk_offsets'], dtype = 'int64')
+
+        self.shape = (int(self.chunk_bounds[-1]), self.num_channels)
+        self.ndim = 2
+        self.size = self.shape[0] * self.shape[1]
+
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._file = open(cbin_file, 'rb')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def close(self):
+        self._file.close()
+
+    def chunk(self, chunk_idx):
+
+        """ Decompressed (samples x channels) array of one chunk, from the cache if possible """
+
+        with self._lock:
+
+            if chunk_idx in self._cache:
+                self._cache.move_to_end(chunk_idx)
+                return self._cache[chunk_idx]
+
+            self._file.seek(self.chunk_offsets[chunk_idx])
+            compressed = self._file.read(self.chunk_offsets[chunk_idx + 1] - self.chunk_offsets[chunk_idx])
+
+            num_samples = self.chunk_bounds[chunk_idx + 1] - self.chunk_bounds[chunk_idx]
+            data = np.frombuffer(zlib.decompress(compressed), dtype = self.dtype)
+            data = data.reshape((num_samples, self.num_channels))
+
+            if self.time_diff:
+                # integer overflow wraps around in both directions, so this is exact
+                data = np.cumsum(data, axis = 0, dtype = self.dtype)
+
+            data.flags.writeable = False
+
+            self._cache[chunk_idx] = data
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last = False)
+
+            return data
+
+    def read(self, start, end):
+
+        """ All channels for samples start to end (exclusive), clipped to the file """
+
+        start = max(0, start)
+        end = min(end, self.shape[0])
+
+        if end <= start:
+            return np.zeros((0, self.num_channels), dtype = self.dtype)
+
+        first = np.searchsorted(self.chunk_bounds, start, side = 'right') - 1
+        last = np.searchsorted(self.chunk_bounds, end, side = 'left') - 1
+
+        if first == last:
+            offset = self.chunk_bounds[first]
+            return self.chunk(first)[start - offset:end - offset, :].copy()
+
+        pieces = []
+
+        for chunk_idx in range(first, last + 1):
+            chunk_start = self.chunk_bounds[chunk_idx]
+            chunk_end = self.chunk_bounds[chunk_idx + 1]
+            pieces.append(self.chunk(chunk_idx)[max(start, chunk_start) - chunk_start:
+                                                min(end, chunk_end) - chunk_start, :])
+
+        return np.concatenate(pieces)
+
+    def __getitem__(self, index):
+
+        if not isinstance(index, tuple):
+            index = (index,)
+
+        rows = index[0]
+        cols = index[1] if len(index) > 1 else slice(None)
+
+        if isinstance(rows, slice):
+            start, end, step = rows.indices(self.shape[0])
+            if step < 0:
+                data = self.read(end + 1, start + 1)[::-1][::-step]
+            else:
+                data = self.read(start, end)[::step]
+            return data[:, cols]
+
+        if np.isscalar(rows):
+            row = int(rows)
+            if row < 0:
+                row += self.shape[0]
+            if not 0 <= row < self.shape[0]:
+                raise IndexError('index ' + repr(rows) + ' is out of bounds for ' + repr(self.shape[0]) + ' samples')
+            return self.read(row, row + 1)[0, cols]
+
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        rows = np.where(rows < 0, rows + self.shape[0], rows)
+
+        data = np.empty((rows.size, self.num_channels), dtype = self.dtype)
+        chunk_idx = np.searchsorted(self.chunk_bounds, rows, side = 'right') - 1
+
+        for c in np.unique(chunk_idx):
+            selected = chunk_idx == c
+            data[selected, :] = self.chunk(c)[rows[selected] - self.chunk_bounds[c], :]
+
+        return data[:, cols]
+
+
+def compress_recording(bin_file, cbin_file = None, num_channels = None, sample_rate = None,
+                       chunk_duration = 1.0, compression_level = 1, dtype = 'int16'):
+
+    """
+    Writes a chunk-compressed copy (.cbin + .ch) of a flat binary recording
+
+    Inputs:
+    -------
+    bin_file : String
+        Uncompressed (samples x channels) binary file
+    cbin_file : String (optional)
+        Output path; default is bin_file with a .cbin extension
+    num_channels, sample_rate : optional, read from the .meta file if not given
+    chunk_duration : float
+        Chunk length in seconds; also the unit of random access
+    compression_level : int
+        zlib level (1 is fast and compresses ephys data nearly as well as 9)
+    dtype : numpy dtype of the samples
+
+    Outputs:
+    --------
+    cbin_file, ch_file : paths to the compressed data and its chunk index
+
+    """
+
+    from .raw_recording import RawRecording
+
+    recording = RawRecording(bin_file, num_channels = num_channels,
+                             sample_rate = sample_rate, dtype = dtype)
+
+    if cbin_file is None:
+        cbin_file = os.path.splitext(bin_file)[0] + '.cbin'
+    ch_file = os.path.splitext(cbin_file)[0] + '.ch'
+
+    sample_rate = recording.sample_rate or 30000
+    chunk_size = int(chunk_duration * sample_rate)
+
+    chunk_bounds = [0]
+    chunk_offsets = [0]
+
+    with open(cbin_file, 'wb') as f:
+
+        for chunk_start, chunk_end, data in recording.iter_chunks(chunk_size = chunk_size, scaled = False):
+
+            data = np.ascontiguousarray(data)
+            diff = np.empty_like(data)
+            diff[0, :] = data[0, :]
+            np.subtract(data[1:, :], data[:-1, :], out = diff[1:, :])
+
+            compressed = zlib.compress(diff.tobytes(), compression_level)
+            f.write(compressed)
+
+            chunk_bounds.append(int(chunk_end))
+            chunk_offsets.append(chunk_offsets[-1] + len(compressed))
+
+    info = {'version': '1.0',
+            'algorithm': 'zlib',
+            'comp_level': compression_level,
+            'do_time_diff': True,
+            'dtype': np.dtype(dtype).str,
+            'n_channels': recording.num_channels,
+            'sample_rate': sample_rate,
+            'chunk_bounds': chunk_bounds,
+            'chunk_offsets': chunk_offsets}
+
+    with open(ch_file, 'w') as f:
+        json.dump(info, f)
+
+    return cbin_file, ch_file
+
+
+def decompress_recording(cbin_file, bin_file, ch_file = None):
+
+    """ Writes the uncompressed binary of a .cbin file (e.g. for Kilosort) """
+
+    data = CompressedRecording(cbin_file, ch_file = ch_file, cache_size = 1)
+
+    with open(bin_file, 'wb') as f:
+        for chunk_idx in range(data.chunk_bounds.size - 1):
+            f.write(data.chunk(chunk_idx).tobytes())
+
+    data.close()
+
+    return bin_file
@@ -0,0 +1,526 @@
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+# a blocked store replaces <name>.npy with <name>.blk plus a <name>.blk.json index
+FEATURE_STORE_SUFFIX = '.blk'
+
+# rows of <name>.npy / <name>.blk hidden by a virtual deletion (see mark_removed_spikes)
+REMOVED_SPIKES_SUFFIX = '.removed.npy'
+
+
+class BlockedArray():
+
+    """
+    Read-only array stored as zlib-compressed blocks along the first axis
+
+    Used for the large per-spike Kilosort arrays (pc_features,
+    template_features). Values may be stored as float16 to halve the size;
+    they are returned in the original dtype. The JSON index next to the
+    data file holds the shape, dtypes, block size and the byte offset of
+    every block, so indexing along spikes decompresses only the blocks that
+    hold the requested spikes. Recently used blocks are kept in an LRU cache.
+
+    Indexing works like the numpy array, e.g. pc_features[spikes,0,:].
+
+    """
+
+    def __init__(self, path, cache_size = 8):
+
+        """
+        path : String
+            Path of the data file (<name>.blk)
+        cache_size : int
+            Number of decompressed blocks to keep in memory
+        """
+
+        with open(path + '.json') as f:
+            info = json.load(f)
+
+        self.filename = path
+        self.shape = tuple(info['shape'])
+        self.dtype = np.dtype(info['dtype'])
+        self.stored_dtype = np.dtype(info['stored_dtype'])
+        self.block_size = int(info['block_size'])
+        self.offsets = np.asarray(info['offsets'], dtype = 'int64')
+
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+        self.num_blocks = self.offsets.size - 1
+
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def block(self, block_idx):
+
+        """ One decompressed block, in the original dtype """
+
+        with self._lock:
+
+            if block_idx in self._cache:
+                self._cache.move_to_end(block_idx)
+                return self._cache[block_idx]
+
+            with open(self.filename, 'rb') as f:
+                f.seek(self.offsets[block_idx])
+                compressed = f.read(self.offsets[block_idx + 1] - self.offsets[block_idx])
+
+            data = np.frombuffer(zlib.decompress(compressed), dtype = self.stored_dtype)
+            data = data.reshape((-1,) + self.shape[1:]).astype(self.dtype, copy = False)
+            data.flags.writeable = False
+
+            self._cache[block_idx] = data
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last = False)
+
+            return data
+
+    def read(self, start, end, out = None):
+
+        """ Rows start to end (exclusive), block by block """
+
+        start = max(0, start)
+        end = min(end, self.shape[0])
+
+        if out is None:
+            out = np.empty((max(0, end - start),) + self.shape[1:], dtype = self.dtype)
+
+        for block_idx in range(start // self.block_size, (end - 1) // self.block_size + 1 if end > start else 0):
+            block_start = block_idx * self.block_size
+            lo = max(start, block_start)
+            hi = min(end, block_start + self.block_size)
+            out[lo - start:hi - start] = self.block(block_idx)[lo - block_start:hi - block_start]
+
+        return out
+
+    def take(self, rows):
+
+        """ Rows at the given indices (any order), reading each block once """
+
+        rows = np.asarray(rows, dtype = 'int64')
+        rows = np.where(rows < 0, rows + self.shape[0], rows)
+
+        if rows.size > 0 and (rows.min() < 0 or rows.max() >= self.shape[0]):
+            raise IndexError('spike index out of bounds for ' + repr(self.shape[0]) + ' spikes')
+
+        out = np.empty((rows.size,) + self.shape[1:], dtype = self.dtype)
+        block_idx = rows // self.block_size
+
+        order = np.argsort(block_idx, kind = 'stable')
+        bounds = np.flatnonzero(np.diff(block_idx[order])) + 1
+
+        for selected in np.split(order, bounds):
+            if selected.size > 0:
+                b = block_idx[selected[0]]
+                out[selected] = self.block(b)[rows[selected] - b * self.block_size]
+
+        return out
+
+    def __getitem__(self, index):
+
+        if not isinstance(index, tuple):
+            index = (index,)
+
+        rows = index[0]
+        rest = (slice(None),) + index[1:]
+
+        if isinstance(rows, slice):
+            start, end, step = rows.indices(self.shape[0])
+            if step == 1:
+                return self.read(start, end)[rest]
+            return self.take(np.arange(start, end, step))[rest]
+
+        if np.isscalar(rows):
+            return self.take([rows])[rest][0]
+
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+
+        return self.take(rows)[rest]
+
+    def __array__(self, dtype = None, copy = None):
+
+        data = self.read(0, self.shape[0])
+
+        return data if dtype is None else data.astype(dtype)
+
+
+class MaskedFeatures():
+
+    """
+    Read-only view of a per-spike feature array with some spikes removed
+
+    The rows listed in a <name>.removed.npy sidecar are skipped, so the
+    view lines up with the compacted spike_times.npy without the feature
+    file being rewritten. Row i of the view is read from row
+    i + (number of removed rows up to it) of the underlying array, which
+    may be a memmap or a BlockedArray.
+
+    Indexing works like the numpy array, e.g. pc_features[spikes,0,:].
+
+    """
+
+    def __init__(self, array, removed):
+
+        """
+        array : numpy.ndarray, numpy.memmap or BlockedArray
+            Feature array as stored (num_stored_spikes x ...)
+        removed : numpy.ndarray
+            Sorted, unique indices of the stored rows to hide
+        """
+
+        self.array = array
+        self.removed = np.asarray(removed, dtype = 'int64')
+
+        self.dtype = np.dtype(array.dtype)
+        self.shape = (array.shape[0] - self.removed.size,) + tuple(array.shape[1:])
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+
+        # non-decreasing; a view row r is preceded by this many removed rows
+        # wherever r >= the entry
+        self._removed_before = self.removed - np.arange(self.removed.size)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def stored_rows(self, rows):
+
+        """ Rows of the stored array for rows of the view """
+
+        rows = np.asarray(rows, dtype = 'int64')
+
+        return rows + np.searchsorted(self._removed_before, rows, side = 'right')
+
+    def take(self, rows):
+
+        rows = np.asarray(rows, dtype = 'int64')
+        rows = np.where(rows < 0, rows + self.shape[0], rows)
+
+        if rows.size > 0 and (rows.min() < 0 or rows.max() >= self.shape[0]):
+            raise IndexError('spike index out of bounds for ' + repr(self.shape[0]) + ' spikes')
+
+        stored = self.stored_rows(rows)
+
+        if isinstance(self.array, BlockedArray):
+            return self.array.take(stored)
+
+        return np.asarray(self.array[stored])
+
+    def __getitem__(self, index):
+
+        if not isinstance(index, tuple):
+            index = (index,)
+
+        rows = index[0]
+        rest = (slice(None),) + index[1:]
+
+        if isinstance(rows, slice):
+            return self.take(np.arange(*rows.indices(self.shape[0])))[rest]
+
+        if np.isscalar(rows):
+            return self.take([rows])[rest][0]
+
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+
+        return self.take(rows)[rest]
+
+    def __array__(self, dtype = None, copy = None):
+
+        data = np.empty(self.shape, dtype = self.dtype)
+
+        for start in range(0, self.shape[0], 65536):
+            data[start:start + 65536] = self[start:start + 65536]
+
+        return data if dtype is None else data.astype(dtype)
+
+
+def write_blocked_array(path, array, block_size = 65536, stored_dtype = None, compression_level = 1, rows = None):
+
+    """
+    Writes an array (in memory, memory-mapped or blocked) as a blocked store
+
+    Inputs:
+    -------
+    path : String
+        Path of the data file; the index is written to path + '.json'
+    array : array-like (num_spikes x ...)
+        Read block_size rows at a time
+    block_size : int
+        Rows per compressed block; the unit of random access
+    stored_dtype : numpy dtype (optional)
+        dtype on disk, e.g. 'float16'; default is the dtype of the array
+    compression_level : int
+        zlib level
+    rows : numpy.ndarray (optional)
+        Increasing indices of the rows to write; default all rows
+
+    Outputs:
+    --------
+    store : BlockedArray opened on the new file
+
+    """
+
+    dtype = np.dtype(array.dtype)
+    stored_dtype = dtype if stored_dtype is None else np.dtype(stored_dtype)
+
+    num_rows = array.shape[0] if rows is None else len(rows)
+    offsets = [0]
+
+    # written next to the destination and renamed, so an existing store can
+    # be rewritten from itself
+    with open(path + '.tmp', 'wb') as f:
+
+        for start in range(0, num_rows, block_size):
+
+            if rows is None:
+                block = np.asarray(array[start:start + block_size], dtype = dtype)
+            else:
+                block = np.asarray(array[rows[start:start + block_size]], dtype = dtype)
+            with np.errstate(over = 'ignore'):
+                stored = block.astype(stored_dtype)
+
+            if stored_dtype.kind == 'f' and not np.all(np.isfinite(stored[np.isfinite(block)])):
+                raise ValueError('values in ' + path + ' are out of range for ' + stored_dtype.name)
+
+            compressed = zlib.compress(np.ascontiguousarray(stored).tobytes(), compression_level)
+            f.write(compressed)
+            offsets.append(offsets[-1] + len(compressed))
+
+    info = {'shape': [num_rows] + list(array.shape[1:]),
+            'dtype': dtype.str,
+            'stored_dtype': stored_dtype.str,
+            'block_size': block_size,
+            'compression': 'zlib',
+            'offsets': offsets}
+
+    with open(path + '.json.tmp', 'w') as f:
+        json.dump(info, f)
+
+    os.replace(path + '.tmp', path)
+    os.replace(path + '.json.tmp', path + '.json')
+
+    return BlockedArray(path)
+
+
+def load_features(folder, name, mmap_mode = None):
+
+    """
+    Loads <name>.npy, or the blocked store <name>.blk if there is no .npy
+    file or the store is newer
+
+    If a <name>.removed.npy sidecar at least as new as the data file exists,
+    the listed spikes are skipped on access (the data file is memory-mapped
+    in that case, whatever mmap_mode is).
+
+    Outputs:
+    --------
+    numpy.ndarray, numpy.memmap, BlockedArray or MaskedFeatures
+
+    """
+
+    npy_file = os.path.join(folder, name + '.npy')
+    store_file = os.path.join(folder, name + FEATURE_STORE_SUFFIX)
+    removed_file = os.path.join(folder, name + REMOVED_SPIKES_SUFFIX)
+
+    if os.path.exists(store_file + '.json') and \
+       (not os.path.exists(npy_file) or os.stat(store_file).st_mtime_ns >= os.stat(npy_file).st_mtime_ns):
+        data_file = store_file
+    else:
+        data_file = npy_file
+
+    masked = os.path.exists(removed_file) and \
+             os.stat(removed_file).st_mtime_ns >= os.stat(data_file).st_mtime_ns
+
+    if data_file == store_file:
+        array = BlockedArray(store_file)
+    else:
+        array = np.load(npy_file, mmap_mode = 'r' if masked else mmap_mode)
+
+    if masked:
+        return MaskedFeatures(array, np.load(removed_file))
+
+    return array
+
+
+def save_features(folder, name, array, use_store = False, stored_dtype = None):
+
+    """
+    Saves a per-spike feature array as <name>.npy, or as a blocked store
+
+    When a store is written, an older <name>.npy would no longer match the
+    spike arrays, so it is removed (phy needs the .npy file; restore it
+    with blocked_array_to_npy).
+    """
+
+    npy_file = os.path.join(folder, name + '.npy')
+    store_file = os.path.join(folder, name + FEATURE_STORE_SUFFIX)
+    removed_file = os.path.join(folder, name + REMOVED_SPIKES_SUFFIX)
+
+    if use_store:
+        write_blocked_array(store_file, array, stored_dtype = stored_dtype)
+        stale_files = (npy_file, removed_file)
+    else:
+        np.save(npy_file, np.asarray(array))
+        stale_files = (store_file, store_file + '.json', removed_file)
+
+    for stale_file in stale_files:
+        if os.path.exists(stale_file):
+            os.remove(stale_file)
+
+
+def compact_features(folder, name, keep = None, use_store = False, stored_dtype = None, chunk_size = 65536):
+
+    """
+    Rewrites a saved per-spike feature array, keeping a subset of spikes
+
+    The current <name>.npy (or blocked store) is read memory-mapped and
+    written out chunk_size spikes at a time, so the array is never held in
+    memory. The output goes to a temporary file that replaces the original
+    once it is complete; like save_features, the counterpart in the other
+    format is removed. Spikes hidden by a <name>.removed.npy sidecar are
+    dropped as well, and the sidecar is deleted.
+
+    Inputs:
+    -------
+    folder : String
+        Kilosort output directory
+    name : String
+        'pc_features' or 'template_features'
+    keep : numpy.ndarray (num_spikes x 0), bool (optional)
+        False for the spikes to drop; default keeps every spike
+    use_store, stored_dtype : as in save_features
+
+    """
+
+    npy_file = os.path.join(folder, name + '.npy')
+    store_file = os.path.join(folder, name + FEATURE_STORE_SUFFIX)
+    removed_file = os.path.join(folder, name + REMOVED_SPIKES_SUFFIX)
+
+    source = load_features(folder, name, mmap_mode = 'r')
+
+    if keep is None and not isinstance(source, MaskedFeatures):
+        in_store = isinstance(source, BlockedArray)
+        if in_store == use_store and (not use_store or stored_dtype is None or
+                                      source.stored_dtype == np.dtype(stored_dtype)):
+            return
+
+    if keep is None:
+        rows = None
+        num_rows = source.shape[0]
+    else:
+        if len(keep) != source.shape[0]:
+            raise ValueError(name + ' has ' + repr(source.shape[0]) + ' spikes, but keep has ' + repr(len(keep)))
+        rows = np.flatnonzero(keep)
+        num_rows = rows.size
+
+    if use_store:
+        write_blocked_array(store_file, source, stored_dtype = stored_dtype, rows = rows)
+        del source
+        stale_files = (npy_file, removed_file)
+    else:
+        out = np.lib.format.open_memmap(npy_file + '.tmp', mode = 'w+', dtype = source.dtype,
+                                        shape = (num_rows,) + tuple(source.shape[1:]))
+
+        for start in range(0, num_rows, chunk_size):
+            end = min(start + chunk_size, num_rows)
+            if rows is None:
+                out[start:end] = source[start:end]
+            else:
+                out[start:end] = source[rows[start:end]]
+
+        out.flush()
+        del out
+
+        # the memory map of the original must be closed before it is replaced
+        del source
+        os.replace(npy_file + '.tmp', npy_file)
+        stale_files = (store_file, store_file + '.json', removed_file)
+
+    for stale_file in stale_files:
+        if os.path.exists(stale_file):
+            os.remove(stale_file)
+
+
+def mark_removed_spikes(folder, name, keep):
+
+    """
+    Removes spikes from a saved feature array without rewriting it
+
+    The stored rows of the dropped spikes are added to the
+    <name>.removed.npy sidecar, which load_features applies on access.
+    The sidecar holds one int64 per removed spike, so removing a few
+    percent of the spikes costs a few MB of writes instead of a full copy
+    of the feature file. Use materialize_features to write compacted
+    files (e.g. for phy).
+
+    Inputs:
+    -------
+    folder : String
+        Kilosort output directory
+    name : String
+        'pc_features' or 'template_features'
+    keep : numpy.ndarray (num_spikes x 0), bool
+        False for the spikes to drop, indexed like the features as
+        currently loaded (i.e. after any earlier removal)
+
+    """
+
+    removed_file = os.path.join(folder, name + REMOVED_SPIKES_SUFFIX)
+
+    source = load_features(folder, name, mmap_mode = 'r')
+
+    if len(keep) != source.shape[0]:
+        raise ValueError(name + ' has ' + repr(source.shape[0]) + ' spikes, but keep has ' + repr(len(keep)))
+
+    dropped = np.flatnonzero(~np.asarray(keep, dtype = bool))
+
+    if isinstance(source, MaskedFeatures):
+        removed = np.union1d(source.removed, source.stored_rows(dropped))
+    else:
+        removed = dropped
+
+    del source
+
+    np.save(removed_file, removed.astype('int64'))
+
+
+def materialize_features(folder, use_store = False, stored_dtype = None):
+
+    """
+    Applies any removed-spike sidecars, writing compacted pc_features and
+    template_features files (as .npy, or as blocked stores)
+    """
+
+    for name in ('pc_features', 'template_features'):
+        if os.path.exists(os.path.join(folder, name + '.npy')) or \
+           os.path.exists(os.path.join(folder, name + FEATURE_STORE_SUFFIX + '.json')):
+            compact_features(folder, name, use_store = use_store, stored_dtype = stored_dtype)
+
+
+def blocked_array_to_npy(path, npy_file):
+
+    """ Writes the contents of a blocked store to a .npy file, block by block """
+
+    store = BlockedArray(path, cache_size = 1)
+    out = np.lib.format.open_memmap(npy_file, mode = 'w+', dtype = store.dtype, shape = store.shape)
+
+    for start in range(0, store.shape[0], store.block_size):
+        store.read(start, start + store.block_size, out = out[start:start + store.block_size])
+
+    out.flush()
+    del out
+
+    return npy_file
@@ -0,0 +1,462 @@
+import os
+import numpy as np
+
+from functools import cached_property
+
+from .sparse_templates import SparseTemplates
+from .feature_store import load_features
+
+
+# per-cluster spike count, majority template and peak channel, and the
+# files they are computed from
+CLUSTER_SUMMARY_FILE = 'cluster_summary.npz'
+CLUSTER_SUMMARY_INPUTS = ['spike_clusters.npy', 'spike_templates.npy', 'templates.npy',
+                          'whitening_mat_inv.npy', 'channel_map.npy']
+
+# cluster-sorted spike index sidecar: a permutation that sorts spikes by
+# cluster, then time, and the offset of each cluster in that order
+SPIKE_INDEX_FILES = ['spike_cluster_order.npy', 'cluster_spike_offsets.npy']
+SPIKE_INDEX_INPUTS = ['spike_clusters.npy', 'spike_times.npy']
+
+# unwhitened templates (zero padding included), memoized next to templates.npy
+UNWHITENED_TEMPLATES_FILE = 'templates_unwhitened.npy'
+UNWHITENED_TEMPLATES_INPUTS = ['templates.npy', 'whitening_mat_inv.npy']
+
+
+class KilosortDataset():
+
+    """
+    Represents a Kilosort/phy output directory
+
+    Arrays are loaded from disk on first access, optionally memory-mapped,
+    and cached; derived products (unwhitened templates, peak channels,
+    per-cluster majority templates) are computed on first access. Modules
+    only pay for the files they use.
+
+    The per-cluster summary (spike count, majority template, peak channel)
+    is also cached on disk as cluster_summary.npz, so every module reuses
+    it until spike_clusters.npy or spike_templates.npy change.
+
+    As in load_kilosort_data, spike_times and spike_clusters are squeezed,
+    templates have the zero padding removed, and other arrays are returned
+    as saved.
+
+    All spikes of one cluster are found through the cluster-sorted spike
+    index sidecar, without scanning spike_clusters.npy.
+
+    Example:
+    --------
+    ks = KilosortDataset(folder, mmap_mode='r')
+    spikes = ks.cluster_spikes(10)
+    times = ks.spike_times[spikes]
+    pcs = ks.pc_features[spikes,:,:]
+
+    """
+
+    def __init__(self, folder,
+                 use_master_clock = False,
+                 template_zero_padding = 21,
+                 mmap_mode = None,
+                 use_cache = True):
+
+        """
+        folder : String
+            Location of Kilosort output directory
+        use_master_clock : bool (optional)
+            Load spike times that have been converted to the master clock timebase
+        template_zero_padding : int (default = 21)
+            Number of zeros added to the beginning of each template
+        mmap_mode : None or 'r' (optional)
+            Memory-map the spike arrays, instead of reading them into memory
+        use_cache : bool (optional)
+            Read and write the per-cluster summary cache (cluster_summary.npz)
+        """
+
+        self.folder = folder
+        self.use_master_clock = use_master_clock
+        self.template_zero_padding = template_zero_padding
+        self.mmap_mode = mmap_mode
+        self.use_cache = use_cache
+
+    def load(self, filename, mmap_mode = None):
+
+        """ Loads a numpy file from the Kilosort output directory """
+
+        return np.load(os.path.join(self.folder, filename), mmap_mode = mmap_mode)
+
+    # files saved by Kilosort
+
+    @cached_property
+    def spike_times(self):
+        if self.use_master_clock:
+            return np.squeeze(self.load('spike_times_master_clock.npy', self.mmap_mode))
+        else:
+            return np.squeeze(self.load('spike_times.npy', self.mmap_mode))
+
+    @cached_property
+    def spike_clusters(self):
+        return np.squeeze(self.load('spike_clusters.npy', self.mmap_mode))
+
+    @cached_property
+    def spike_templates(self):
+        return self.load('spike_templates.npy', self.mmap_mode)
+
+    @cached_property
+    def amplitudes(self):
+        return self.load('amplitudes.npy', self.mmap_mode)
+
+    @cached_property
+    def templates(self):
+        """ Whitened templates (M x samples x channels), zero padding removed """
+        return self.load('templates.npy')[:,self.template_zero_padding:,:]
+
+    @cached_property
+    def whitening_mat_inv(self):
+        return self.load('whitening_mat_inv.npy')
+
+    @cached_property
+    def channel_map(self):
+        return self.load('channel_map.npy')
+
+    @cached_property
+    def channel_positions(self):
+        return self.load('channel_positions.npy')
+
+    @cached_property
+    def pc_features(self):
+        """ From pc_features.npy, or the blocked store if there is one (see feature_store.py) """
+        return load_features(self.folder, 'pc_features', self.mmap_mode)
+
+    @cached_property
+    def pc_feature_ind(self):
+        return self.load('pc_feature_ind.npy')
+
+    @cached_property
+    def template_features(self):
+        return load_features(self.folder, 'template_features', self.mmap_mode)
+
+    @cached_property
+    def cluster_amplitude(self):
+        """ Average amplitude for each cluster from cluster_Amplitude.tsv """
+        info = np.genfromtxt(os.path.join(self.folder, 'cluster_Amplitude.tsv'), dtype='str')
+        return info[1:,1].astype('float')
+
+    # derived products
+
+    @cached_property
+    def unwhitened_templates(self):
+        """ Templates multiplied by the inverse whitening matrix, float32, zero padding removed """
+        if self.use_cache:
+            templates = load_unwhitened_templates(self.folder, self.mmap_mode)
+        else:
+            templates = unwhiten_templates(self.load('templates.npy', 'r'), self.whitening_mat_inv)
+        return templates[:,self.template_zero_padding:,:]
+
+    @cached_property
+    def sparse_templates(self):
+        """ Unwhitened templates on their active channels only, float32 """
+        templates = self.load('templates.npy', 'r')[:,self.template_zero_padding:,:]
+        return SparseTemplates(templates, self.whitening_mat_inv)
+
+    @cached_property
+    def cluster_ids(self):
+        return np.unique(self.spike_clusters)
+
+    @cached_property
+    def cluster_quality(self):
+        return ['unsorted'] * self.cluster_ids.size
+
+    @cached_property
+    def template_peak_channels(self):
+        """ Data channel with the largest unwhitened amplitude, for each template """
+        channel_map = np.squeeze(self.channel_map)
+        return channel_map[self.sparse_templates.peak_channel_index]
+
+    @cached_property
+    def template_amplitudes(self):
+        """ Unwhitened peak-to-peak amplitude on the peak channel, for each template """
+        return self.sparse_templates.amplitudes
+
+    @cached_property
+    def cluster_spike_counts(self):
+        """ Number of spikes for each cluster ID, 0 to max(spike_clusters) """
+        return self._cluster_summary[0]
+
+    @cached_property
+    def cluster_majority_templates(self):
+        """ Most common template for each cluster ID; ties go to the lower template """
+        return self._cluster_summary[1]
+
+    @cached_property
+    def cluster_peak_channels(self):
+        """ Peak channel of the majority template for each cluster ID """
+        return self._cluster_summary[2]
+
+    @cached_property
+    def _cluster_summary(self):
+
+        # the summary is cached next to the Kilosort output, keyed by the size
+        # and modification time of its inputs, so it is recomputed after
+        # postprocessing or curation in phy rewrites spike_clusters.npy
+        cache_file = os.path.join(self.folder, CLUSTER_SUMMARY_FILE)
+        key = self._file_key(CLUSTER_SUMMARY_INPUTS)
+
+        if self.use_cache and os.path.exists(cache_file):
+            with np.load(cache_file) as cache:
+                if np.array_equal(cache['key'], key) and \
+                   cache['template_zero_padding'] == self.template_zero_padding:
+                    return cache['spike_counts'], cache['majority_templates'], cache['peak_channels']
+
+        spike_counts, majority_templates = get_majority_templates(self.spike_clusters, self.spike_templates)
+        peak_channels = self.template_peak_channels[majority_templates]
+
+        if self.use_cache:
+            try:
+                np.savez(cache_file,
+                         key = key,
+                         template_zero_padding = self.template_zero_padding,
+                         spike_counts = spike_counts,
+                         majority_templates = majority_templates,
+                         peak_channels = peak_channels)
+            except OSError:
+                print('Could not write ' + cache_file)
+
+        return spike_counts, majority_templates, peak_channels
+
+    @cached_property
+    def spike_index(self):
+
+        """
+        Memory-mapped (order, offsets) from the spike index sidecar; the
+        sidecar is rewritten first if it is older than spike_clusters.npy
+        or spike_times.npy
+        """
+
+        if not spike_index_is_current(self.folder):
+            try:
+                return write_spike_index(self.folder, self.spike_clusters,
+                                         np.squeeze(self.load('spike_times.npy', self.mmap_mode)))
+            except OSError:
+                print('Could not write the spike index in ' + self.folder)
+                return get_spike_index(self.spike_clusters,
+                                       np.squeeze(self.load('spike_times.npy', self.mmap_mode)))
+
+        return (self.load(SPIKE_INDEX_FILES[0], 'r'),
+                self.load(SPIKE_INDEX_FILES[1]))
+
+    def cluster_spikes(self, cluster_id):
+
+        """ Indices of all spikes in cluster_id, in time order """
+
+        order, offsets = self.spike_index
+
+        if cluster_id < 0 or cluster_id + 1 >= offsets.size:
+            return np.zeros((0,), dtype='int64')
+
+        return order[offsets[cluster_id]:offsets[cluster_id + 1]]
+
+    def _file_key(self, filenames):
+
+        """ Size and modification time (ns) of each file """
+
+        key = []
+        for filename in filenames:
+            stat = os.stat(os.path.join(self.folder, filename))
+            key.append([stat.st_size, stat.st_mtime_ns])
+
+        return np.array(key, dtype='int64')
+
+
+def get_majority_templates(spike_clusters, spike_templates):
+
+    """
+    Finds the spike count and the most common template for each cluster,
+    in one sorted pass
+
+    Inputs:
+    -------
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike
+    spike_templates : numpy.ndarray (num_spikes x 0)
+        Template IDs for each spike
+
+    Outputs:
+    --------
+    spike_counts : numpy.ndarray (num_clusters x 0)
+        Spike count for cluster IDs 0 to max(spike_clusters)
+    majority_templates : numpy.ndarray (num_clusters x 0)
+        Most common template for each cluster ID (0 for empty IDs); ties
+        go to the lower template ID, as with np.argmax(np.bincount())
+
+    """
+
+    spike_clusters = np.squeeze(spike_clusters).astype('int64')
+    spike_templates = np.squeeze(spike_templates).astype('int64')
+
+    num_clusters = np.max(spike_clusters) + 1
+
+    # runs of identical (cluster, template) pairs
+    order = np.lexsort((spike_templates, spike_clusters))
+    sorted_clusters = spike_clusters[order]
+    sorted_templates = spike_templates[order]
+
+    run_start = np.flatnonzero(np.concatenate(([True],
+                               (np.diff(sorted_clusters) != 0) | (np.diff(sorted_templates) != 0))))
+    run_length = np.diff(np.append(run_start, sorted_clusters.size))
+    run_cluster = sorted_clusters[run_start]
+    run_template = sorted_templates[run_start]
+
+    # longest run per cluster, lowest template first among equals
+    best = np.lexsort((run_template, -run_length, run_cluster))
+    first = np.concatenate(([True], np.diff(run_cluster[best]) != 0))
+
+    majority_templates = np.zeros((num_clusters,), dtype='int64')
+    majority_templates[run_cluster[best][first]] = run_template[best][first]
+
+    spike_counts = np.bincount(spike_clusters, minlength = num_clusters)
+
+    return spike_counts, majority_templates
+
+
+def unwhiten_templates(templates, w_inv, dtype = 'float32', num_active = None, block_size = 256, out = None):
+
+    """
+    Multiplies all templates by the inverse whitening matrix
+
+    Templates are processed block_size at a time with one batched matmul
+    each, so a memory-mapped templates.npy is never converted in full.
+
+    Inputs:
+    -------
+    templates : numpy.ndarray or numpy.memmap (num_templates x num_samples x num_channels)
+        Whitened templates
+    w_inv : numpy.ndarray (num_channels x num_channels)
+        Inverse of the whitening matrix
+    dtype : numpy dtype of the result
+    num_active : int (optional)
+        Unwhiten only this many channels with the largest amplitude for each
+        template, leaving zeros elsewhere (see SparseTemplates)
+    out : numpy.ndarray (optional)
+        Array to write the result into, e.g. a memory-mapped .npy file
+
+    Outputs:
+    --------
+    unwhitened : numpy.ndarray (num_templates x num_samples x num_channels)
+
+    """
+
+    if out is None:
+        out = np.empty(templates.shape, dtype = dtype)
+
+    if num_active is not None:
+        out[:] = SparseTemplates(templates, w_inv, num_active, block_size).to_dense()
+        return out
+
+    w_inv = np.asarray(w_inv, dtype = dtype)
+
+    for start in range(0, templates.shape[0], block_size):
+        out[start:start + block_size] = np.matmul(np.asarray(templates[start:start + block_size], dtype = dtype), w_inv)
+
+    return out
+
+
+def load_unwhitened_templates(folder, mmap_mode = None):
+
+    """
+    Loads the float32 unwhitened templates memoized in folder, computing
+    and saving them first if the memo is missing or older than
+    templates.npy or whitening_mat_inv.npy
+
+    The zero padding of templates.npy is kept.
+    """
+
+    memo_file = os.path.join(folder, UNWHITENED_TEMPLATES_FILE)
+
+    if os.path.exists(memo_file):
+        memo_time = os.stat(memo_file).st_mtime_ns
+        input_time = max(os.stat(os.path.join(folder, f)).st_mtime_ns for f in UNWHITENED_TEMPLATES_INPUTS)
+        if memo_time >= input_time:
+            return np.load(memo_file, mmap_mode = mmap_mode)
+
+    templates = np.load(os.path.join(folder, 'templates.npy'), mmap_mode = 'r')
+    w_inv = np.load(os.path.join(folder, 'whitening_mat_inv.npy'))
+
+    try:
+        out = np.lib.format.open_memmap(memo_file, mode = 'w+', dtype = 'float32', shape = templates.shape)
+    except OSError:
+        print('Could not write ' + memo_file)
+        return unwhiten_templates(templates, w_inv)
+
+    unwhiten_templates(templates, w_inv, out = out)
+    out.flush()
+    del out
+
+    return np.load(memo_file, mmap_mode = mmap_mode)
+
+
+def get_spike_index(spike_clusters, spike_times):
+
+    """
+    Sorts spikes by cluster, then time
+
+    Inputs:
+    -------
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Times for each spike
+
+    Outputs:
+    --------
+    order : numpy.ndarray (num_spikes x 0), int64
+        Spike indices sorted by cluster, then time
+    offsets : numpy.ndarray (num_clusters + 1 x 0), int64
+        The spikes of cluster k are order[offsets[k]:offsets[k+1]]
+
+    """
+
+    spike_clusters = np.squeeze(spike_clusters)
+
+    order = np.lexsort((np.squeeze(spike_times), spike_clusters)).astype('int64')
+
+    counts = np.bincount(spike_clusters.astype('int64'))
+    offsets = np.zeros((counts.size + 1,), dtype='int64')
+    offsets[1:] = np.cumsum(counts)
+
+    return order, offsets
+
+
+def write_spike_index(folder, spike_clusters, spike_times):
+
+    """
+    Writes the cluster-sorted spike index sidecar to a Kilosort output
+    directory; call after anything that changes spike_clusters.npy
+
+    Returns the memory-mapped (order, offsets) arrays
+    """
+
+    order, offsets = get_spike_index(spike_clusters, spike_times)
+
+    np.save(os.path.join(folder, SPIKE_INDEX_FILES[0]), order)
+    np.save(os.path.join(folder, SPIKE_INDEX_FILES[1]), offsets)
+
+    return (np.load(os.path.join(folder, SPIKE_INDEX_FILES[0]), mmap_mode = 'r'),
+            np.load(os.path.join(folder, SPIKE_INDEX_FILES[1])))
+
+
+def spike_index_is_current(folder):
+
+    """
+    True if the spike index sidecar exists and is at least as new as
+    spike_clusters.npy and spike_times.npy
+    """
+
+    paths = [os.path.join(folder, f) for f in SPIKE_INDEX_FILES]
+
+    if not all(os.path.exists(p) for p in paths):
+        return False
+
+    index_time = min(os.stat(p).st_mtime_ns for p in paths)
+    input_time = max(os.stat(os.path.join(folder, f)).st_mtime_ns for f in SPIKE_INDEX_INPUTS)
+
+    return index_time >= input_time
@@ -0,0 +1,231 @@
+import os
+from functools import cached_property
+from pathlib import Path
+
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+
+from .SGLXMetaToCoords import MetaToCoords
+
+
+# sidecar written next to channel_positions.npy (or <run>.meta for SpikeGLX)
+GEOMETRY_FILE = 'probe_geometry.npz'
+
+
+class ProbeGeometry():
+
+    """
+    Site positions of one probe, with precomputed neighbourhoods
+
+    Built once from a SpikeGLX .meta file or a Kilosort channel_positions.npy
+    file, and cached as a small .npz sidecar holding the positions, the
+    shank of each site and the neighbour lists of every radius requested so
+    far, so later modules (and worker processes) skip the parsing and the
+    KD-tree queries. Channel indices are rows of positions (template
+    channels for Kilosort output, saved AP channels for a .meta file).
+
+    Example:
+    --------
+    geometry = ProbeGeometry.from_kilosort(ks_directory)
+    nearby = geometry.neighbors(68)[peak_channel]
+    close_units = geometry.neighbor_mask(5)[np.ix_(peak_channels, peak_channels)]
+
+    """
+
+    def __init__(self, positions, shank_index = None):
+
+        """
+        positions : numpy.ndarray (num_channels x 2)
+            x and y (distance from tip) of each site, in um
+        shank_index : numpy.ndarray (num_channels x 0) (optional)
+            Shank of each site; default all on shank 0
+        """
+
+        self.positions = np.asarray(positions, dtype = 'float64')
+
+        if shank_index is None:
+            shank_index = np.zeros((self.positions.shape[0],), dtype = 'int64')
+
+        self.shank_index = np.asarray(shank_index).astype('int64')
+        self.num_channels = self.positions.shape[0]
+
+        self._neighbors = {}
+
+        # sidecar to update when new neighbour lists are computed
+        self.cache_file = None
+
+    @classmethod
+    def from_kilosort(cls, folder, use_cache = True):
+
+        """
+        Geometry of the template channels in a Kilosort output directory;
+        channel_positions.npy has no shank column, so shanks are inferred
+        from the gaps between site x positions
+        """
+
+        source = os.path.join(folder, 'channel_positions.npy')
+        cache_file = os.path.join(folder, GEOMETRY_FILE)
+
+        def build():
+            positions = np.load(source)
+            return cls(positions, infer_shank_index(positions))
+
+        return cls._cached(source, cache_file, use_cache, build)
+
+    @classmethod
+    def from_meta(cls, meta_file, use_cache = True):
+
+        """ Geometry of the saved AP channels of a SpikeGLX imec stream """
+
+        meta_file = Path(meta_file)
+        cache_file = str(meta_file.with_suffix('')) + '.' + GEOMETRY_FILE
+
+        def build():
+            xCoord, yCoord, shankInd = MetaToCoords(meta_file, -1)
+            return cls(np.stack((np.squeeze(xCoord), np.squeeze(yCoord)), 1), np.squeeze(shankInd))
+
+        return cls._cached(str(meta_file), cache_file, use_cache, build)
+
+    @classmethod
+    def _cached(cls, source, cache_file, use_cache, build):
+
+        # the sidecar is used while it is at least as new as its source
+        if use_cache and os.path.exists(cache_file) and \
+           os.stat(cache_file).st_mtime_ns >= os.stat(source).st_mtime_ns:
+            geometry = cls.load(cache_file)
+            geometry.cache_file = cache_file
+            return geometry
+
+        geometry = build()
+
+        if use_cache:
+            geometry.cache_file = cache_file
+            geometry._save_cache()
+
+        return geometry
+
+    @classmethod
+    def load(cls, path):
+
+        """ Reads a geometry written by save, with its neighbour lists """
+
+        with np.load(path) as cache:
+
+            geometry = cls(cache['positions'], cache['shank_index'])
+
+            if 'neighbor_keys' in cache.files:
+                for idx, (radius_um, same_shank) in enumerate(cache['neighbor_keys']):
+                    offsets = cache['neighbor_offsets_' + repr(idx)]
+                    indices = cache['neighbor_indices_' + repr(idx)]
+                    geometry._neighbors[(float(radius_um), bool(same_shank))] = \
+                        np.split(indices, offsets[1:-1])
+
+        return geometry
+
+    def save(self, path):
+
+        """
+        Writes positions, shank index and the neighbour lists computed so
+        far to an .npz file; each list of lists is stored CSR-style, as
+        offsets (num_channels + 1) into one array of indices
+        """
+
+        arrays = {'positions' : self.positions, 'shank_index' : self.shank_index}
+
+        keys = sorted(self._neighbors)
+        if len(keys) > 0:
+            arrays['neighbor_keys'] = np.array(keys, dtype = 'float64')
+
+        for idx, key in enumerate(keys):
+            neighbors = self._neighbors[key]
+            arrays['neighbor_offsets_' + repr(idx)] = np.concatenate(([0], np.cumsum([n.size for n in neighbors])))
+            arrays['neighbor_indices_' + repr(idx)] = np.concatenate(neighbors).astype('int64')
+
+        # written under a temporary name, so other processes never read a
+        # partial file
+        temp_file = path + '.tmp.npz'
+        np.savez(temp_file, **arrays)
+        os.replace(temp_file, path)
+
+    def _save_cache(self):
+
+        try:
+            self.save(self.cache_file)
+        except OSError:
+            print('Could not write ' + self.cache_file)
+
+    @cached_property
+    def kdtree(self):
+        return cKDTree(self.positions)
+
+    @cached_property
+    def distances(self):
+        """ (num_channels x num_channels) distance between sites, in um """
+        return cdist(self.positions, self.positions)
+
+    @cached_property
+    def same_shank(self):
+        """ (num_channels x num_channels) True for sites on the same shank """
+        return self.shank_index[:,np.newaxis] == self.shank_index[np.newaxis,:]
+
+    def neighbors(self, radius_um, same_shank = True):
+
+        """
+        Sites closer than radius_um to each site (including itself), in
+        ascending channel order; computed once per radius with the KD-tree,
+        and added to the sidecar for the next process
+        """
+
+        key = (float(radius_um), bool(same_shank))
+
+        if key not in self._neighbors:
+
+            # query_ball_point includes the boundary; the modules use a strict <
+            pairs = self.kdtree.query_ball_point(self.positions, np.nextafter(radius_um, 0))
+
+            neighbors = []
+            for channel, nearby in enumerate(pairs):
+                nearby = np.sort(np.asarray(nearby, dtype = 'int64'))
+                if same_shank:
+                    nearby = nearby[self.shank_index[nearby] == self.shank_index[channel]]
+                neighbors.append(nearby)
+
+            self._neighbors[key] = neighbors
+
+            if self.cache_file is not None:
+                self._save_cache()
+
+        return self._neighbors[key]
+
+    def neighbor_mask(self, radius_um, same_shank = True):
+
+        """ (num_channels x num_channels) True for site pairs closer than radius_um """
+
+        mask = self.distances < radius_um
+
+        if same_shank:
+            mask &= self.same_shank
+
+        return mask
+
+    def channels_within(self, channel, radius_um):
+
+        """ Sites closer than radius_um to one site, on any shank """
+
+        return np.flatnonzero(self.distances[channel] < radius_um)
+
+
+def infer_shank_index(positions, min_gap_um = 100):
+
+    """
+    Shank of each site, from gaps of more than min_gap_um between the x
+    positions of the sites (e.g. 250 um between NP2.0 shanks)
+    """
+
+    positions = np.asarray(positions)
+
+    x = np.unique(positions[:,0])
+    shank_of_x = np.concatenate(([0], np.cumsum(np.diff(x) > min_gap_um)))
+
+    return shank_of_x[np.searchsorted(x, positions[:,0])]
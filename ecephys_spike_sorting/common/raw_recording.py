@@ -0,0 +1,323 @@
+import os
+import queue
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from .SGLXMetaToCoords import readMeta, ChannelCountsIM
+from .compressed_recording import CompressedRecording
+
+
+class RawRecording():
+
+    """
+    Read-only access to a flat binary recording (samples x channels), such
+    as a SpikeGLX .bin or Open Ephys continuous.dat file, or a compressed
+    .cbin copy of one (see compressed_recording.py)
+
+    The channel count, sample rate and uV per bit are read from the SpikeGLX
+    .meta file next to the binary, unless they are given explicitly. Data
+    can be read by sample range, or streamed in chunks with a background
+    thread reading the next chunk while the current one is processed.
+
+    Example:
+    --------
+    rec = RawRecording(ap_band_file)
+    for chunk_start, chunk_end, data in rec.iter_chunks(chunk_size = 30000, channels = channel_map):
+        ...  # data is float32 in uV
+
+    """
+
+    def __init__(self, bin_file,
+                 num_channels = None,
+                 sample_rate = None,
+                 bit_volts = None,
+                 dtype = 'int16'):
+
+        """
+        bin_file : String
+            Path of the binary file
+        num_channels : int (optional)
+            Number of channels saved in the file; default from nSavedChans
+        sample_rate : float (optional)
+            Sample rate in Hz; default from imSampRate (or niSampRate)
+        bit_volts : float or numpy.ndarray (optional)
+            uV per bit, scalar or per channel; default from the .meta gain
+            settings, or 1.0 (unscaled) if there is no .meta file
+        dtype : numpy dtype of the samples
+        """
+
+        self.bin_file = bin_file
+
+        meta_file = Path(os.path.splitext(bin_file)[0] + '.meta')
+        self.meta = readMeta(meta_file) if meta_file.exists() else {}
+
+        compressed = bin_file.endswith('.cbin')
+
+        if compressed:
+            raw_data = CompressedRecording(bin_file)
+            if num_channels is None and 'nSavedChans' not in self.meta:
+                num_channels = raw_data.num_channels
+            if sample_rate is None and not self.meta:
+                sample_rate = raw_data.sample_rate
+
+        if num_channels is None:
+            if 'nSavedChans' not in self.meta:
+                raise ValueError('num_channels is required for ' + bin_file + ' (no .meta file)')
+            num_channels = int(self.meta['nSavedChans'])
+
+        if sample_rate is None and self.meta:
+            sample_rate = float(self.meta.get('imSampRate', self.meta.get('niSampRate', 0))) or None
+
+        if bit_volts is None:
+            bit_volts = get_bit_volts(self.meta, lfp = '.lf.' in os.path.basename(bin_file)) if self.meta else 1.0
+
+        self.num_channels = num_channels
+        self.sample_rate = sample_rate
+        self.bit_volts = bit_volts
+
+        if compressed:
+            # sliceable like the memmap, decompressing chunks on demand
+            self.data = raw_data
+            self.num_samples = raw_data.shape[0]
+        else:
+            raw_data = np.memmap(bin_file, dtype = dtype, mode = 'r')
+            self.num_samples = int(raw_data.size / num_channels)
+
+            # 2-D view; also usable directly (e.g. by the mean_waveforms workers,
+            # which reopen it from data.filename)
+            self.data = np.reshape(raw_data[:self.num_samples * num_channels],
+                                   (self.num_samples, num_channels))
+
+    def channel_counts(self):
+
+        """ (AP, LF, SY) channel counts of an imec stream, from the .meta file """
+
+        return ChannelCountsIM(self.meta)
+
+    def read(self, start = 0, end = None, channels = None, scaled = True):
+
+        """
+        Reads samples start to end (exclusive) for a subset of channels
+
+        Whole rows are read and the channels selected in memory, so the
+        file is accessed sequentially.
+
+        Inputs:
+        -------
+        start, end : int
+            Sample range; clipped to the file
+        channels : slice, list or numpy.ndarray (optional)
+            Channels to return; default all
+        scaled : bool
+            Return float32 in uV (multiplied by bit_volts); otherwise raw values
+
+        Outputs:
+        --------
+        data : numpy.ndarray (samples x channels)
+
+        """
+
+        if end is None or end > self.num_samples:
+            end = self.num_samples
+        start = max(0, start)
+
+        data = np.asarray(self.data[start:end, :])
+
+        if channels is not None:
+            data = data[:, channels]
+
+        if scaled:
+            bit_volts = np.asarray(self.bit_volts, dtype = 'float32')
+            if bit_volts.ndim > 0 and channels is not None:
+                bit_volts = bit_volts[channels]
+            data = data.astype('float32') * bit_volts
+
+        return data
+
+    def iter_chunks(self, chunk_size = None, overlap = 0, channels = None, scaled = True,
+                    start = 0, end = None, read_ahead = True):
+
+        """
+        Iterates over consecutive chunks of the recording
+
+        Inputs:
+        -------
+        chunk_size : int
+            Samples per chunk; default 1 s
+        overlap : int
+            Extra samples read before and after each chunk (clipped to the
+            file), e.g. for filter edge effects
+        channels, scaled : as in read()
+        start, end : int
+            Sample range to iterate over
+        read_ahead : bool
+            Read the next chunk on a background thread (double buffering)
+
+        Yields:
+        -------
+        (chunk_start, chunk_end, data) : the chunk covers samples chunk_start
+            to chunk_end; data starts at max(0, chunk_start - overlap)
+
+        """
+
+        if chunk_size is None:
+            chunk_size = int(self.sample_rate) if self.sample_rate else 30000
+
+        if end is None or end > self.num_samples:
+            end = self.num_samples
+
+        bounds = [(s, min(s + chunk_size, end)) for s in range(start, end, chunk_size)]
+
+        def read_chunk(chunk_start, chunk_end):
+            return chunk_start, chunk_end, self.read(chunk_start - overlap, chunk_end + overlap,
+                                                     channels, scaled)
+
+        if not read_ahead:
+            for chunk_start, chunk_end in bounds:
+                yield read_chunk(chunk_start, chunk_end)
+            return
+
+        chunks = queue.Queue(maxsize = 1)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout = 0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def reader():
+            try:
+                for chunk_start, chunk_end in bounds:
+                    if stop.is_set():
+                        return
+                    put(read_chunk(chunk_start, chunk_end))
+            except Exception as e:
+                put(e)
+            finally:
+                put(None)
+
+        thread = threading.Thread(target = reader, daemon = True)
+        thread.start()
+
+        try:
+            while True:
+                item = chunks.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def iter_snippets(self, times, pre_samples, samples_per_spike, channels = None, chunk_size = None):
+
+        """
+        Iterates over fixed-length snippets around a set of spike times
+
+        The recording is streamed once in time order (see iter_chunks), and
+        the snippets that start in each chunk are cut out together, so the
+        spikes can be in any order and the file is never read at random.
+
+        Inputs:
+        -------
+        times : numpy.ndarray (num_spikes x 0)
+            Spike times in samples
+        pre_samples : int
+            Samples before each spike time
+        samples_per_spike : int
+            Snippet length
+        channels : numpy.ndarray (optional)
+            Channels to return: None for all, a 1-D array for the same
+            channels for every spike, or (num_spikes x n) for different
+            channels per spike (e.g. around each unit's peak channel)
+        chunk_size : int
+            Samples per chunk; default 1 s
+
+        Yields:
+        -------
+        (spikes, snippets) : indices into times, and the raw (unscaled)
+            snippets (spikes x samples_per_spike x channels); spikes whose
+            snippet would cross the start or end of the file are skipped
+
+        """
+
+        starts = np.asarray(times, dtype = 'int64') - pre_samples
+
+        order = np.argsort(starts, kind = 'stable')
+        sorted_starts = starts[order]
+
+        in_file = (sorted_starts >= 0) & (sorted_starts + samples_per_spike <= self.num_samples)
+        order = order[in_file]
+        sorted_starts = sorted_starts[in_file]
+
+        if order.size == 0:
+            return
+
+        if channels is not None:
+            channels = np.asarray(channels)
+
+        offsets = np.arange(samples_per_spike)
+
+        for chunk_start, chunk_end, data in self.iter_chunks(chunk_size = chunk_size,
+                                                             overlap = samples_per_spike,
+                                                             scaled = False,
+                                                             start = int(sorted_starts[0]),
+                                                             end = int(sorted_starts[-1]) + 1):
+
+            first, last = np.searchsorted(sorted_starts, (chunk_start, chunk_end))
+
+            if last == first:
+                continue
+
+            spikes = order[first:last]
+            rows = (sorted_starts[first:last] - max(0, chunk_start - samples_per_spike))[:, np.newaxis] + offsets
+
+            if channels is None:
+                snippets = data[rows, :]
+            elif channels.ndim == 1:
+                snippets = data[rows[:, :, np.newaxis], channels[np.newaxis, np.newaxis, :]]
+            else:
+                snippets = data[rows[:, :, np.newaxis], channels[spikes][:, np.newaxis, :]]
+
+            yield spikes, snippets
+
+
+def get_bit_volts(meta, lfp = False):
+
+    """
+    uV per bit for an imec AP or LF stream, or an NI stream, from its .meta
+
+    For NP1.0/3A probes the AP (or LF, if lfp is True) gain of the first
+    channel in the imro table is used (all channels normally share one
+    gain); NP2.0 probes have a fixed gain of 80.
+    """
+
+    if 'imAiRangeMax' in meta:
+        range_max = float(meta['imAiRangeMax'])
+        max_int = int(meta.get('imMaxInt', 512))
+        probe_type = int(meta.get('imDatPrb_type', 0))
+
+        if probe_type in (0, 1020, 1030, 1100, 1120, 1121, 1122, 1123, 1200, 1300):
+            # imro entries: (chan bank refid apgain lfgain apfilt)
+            first_entry = meta['imroTbl'].split(sep=')')[1].strip('(').split()
+            if lfp:
+                gain = float(first_entry[4])
+            else:
+                gain = float(first_entry[3])
+        else:
+            gain = 80.0
+
+        return range_max / max_int / gain * 1e6
+
+    else:
+        # NI stream; unit gain
+        range_max = float(meta['niAiRangeMax'])
+        max_int = int(meta.get('niMaxInt', 32768))
+        return range_max / max_int * 1e6
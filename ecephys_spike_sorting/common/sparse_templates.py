@@ -0,0 +1,83 @@
+import numpy as np
+
+
+class SparseTemplates():
+
+    """
+    Unwhitened Kilosort templates restricted to their active channels
+
+    Each template has signal on a small neighbourhood of channels (Kilosort
+    whitens over the nearest 32 channels). Only the num_active channels with
+    the largest whitened peak-to-peak amplitude are kept, and only those are
+    unwhitened, using the matching columns of the inverse whitening matrix.
+    Values are float32.
+
+    The values on the active channels equal those of the dense unwhitened
+    templates (all whitened channels contribute to them), so peak channels
+    and amplitudes match as long as the peak lies within the active channels.
+
+    Attributes:
+    -----------
+    channels : numpy.ndarray (num_templates x num_active), int32
+        Template channel index of each active channel, in ascending order
+    values : numpy.ndarray (num_templates x num_samples x num_active), float32
+        Unwhitened template values on the active channels
+    peak_channel_index : numpy.ndarray (num_templates x 0)
+        Template channel index with the largest peak-to-peak amplitude
+    amplitudes : numpy.ndarray (num_templates x 0)
+        Peak-to-peak amplitude on the peak channel
+
+    """
+
+    def __init__(self, templates, w_inv, num_active = 32, block_size = 256):
+
+        """
+        templates : numpy.ndarray or numpy.memmap (num_templates x num_samples x num_channels)
+            Whitened templates, zero padding removed; read block_size
+            templates at a time, so a memory-mapped templates.npy is never
+            loaded in full
+        w_inv : numpy.ndarray (num_channels x num_channels)
+            Inverse of the whitening matrix
+        num_active : int
+            Number of active channels to keep for each template
+        """
+
+        num_templates, num_samples, num_channels = templates.shape
+        num_active = min(num_active, num_channels)
+
+        self.num_channels = num_channels
+        self.channels = np.zeros((num_templates, num_active), dtype = 'int32')
+        self.values = np.zeros((num_templates, num_samples, num_active), dtype = 'float32')
+
+        w_inv = np.asarray(w_inv, dtype = 'float32')
+
+        for start in range(0, num_templates, block_size):
+
+            block = np.asarray(templates[start:start + block_size,:,:], dtype = 'float32')
+
+            ptp = np.max(block,1) - np.min(block,1)
+            channels = np.sort(np.argpartition(-ptp, num_active - 1, axis = 1)[:,:num_active], 1)
+
+            # (templates in block x num_channels x num_active) columns of w_inv
+            w_sub = w_inv[:, channels].transpose(1, 0, 2)
+
+            self.channels[start:start + block_size,:] = channels
+            self.values[start:start + block_size,:,:] = np.matmul(block, w_sub)
+
+        amplitudes = np.max(self.values,1) - np.min(self.values,1)
+        peak_idx = np.argmax(amplitudes, 1)
+
+        self.peak_channel_index = self.channels[np.arange(num_templates), peak_idx]
+        self.amplitudes = amplitudes[np.arange(num_templates), peak_idx]
+
+    def to_dense(self):
+
+        """ Dense (num_templates x num_samples x num_channels) float32 templates, zeros off the active channels """
+
+        num_templates, num_samples, num_active = self.values.shape
+
+        dense = np.zeros((num_templates, num_samples, self.num_channels), dtype = 'float32')
+        np.put_along_axis(dense, np.broadcast_to(self.channels[:,np.newaxis,:], self.values.shape),
+                          self.values, 2)
+
+        return dense
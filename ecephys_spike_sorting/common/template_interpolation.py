@@ -0,0 +1,88 @@
+import numpy as np
+from scipy.interpolate import CloughTocher2DInterpolator
+from scipy import sparse
+
+
+class TemplateInterpolator():
+
+    """
+    Cubic (Clough-Tocher) interpolation from recording sites to a fixed
+    set of virtual sites, as a sparse matrix
+
+    griddata(..., method='cubic') is linear in the values being
+    interpolated, so for fixed site positions it is a matrix product. The
+    Delaunay triangulation and the interpolation weights are computed once
+    (by interpolating the identity), and every sample of every template is
+    then interpolated with one sparse product instead of one triangulation
+    per sample. Results match griddata to within the tolerance of its
+    gradient estimation.
+
+    Example:
+    --------
+    interpolator = get_template_interpolator(loc_a, loc_i)
+    interp_temp = interpolator(template)  # (samples x virtual sites)
+
+    """
+
+    def __init__(self, source_positions, target_positions, tolerance = 1e-9):
+
+        """
+        source_positions : numpy.ndarray (num_sites x 2)
+            x and y of the recording sites
+        target_positions : numpy.ndarray (num_targets x 2)
+            x and y of the virtual sites; those outside the convex hull of
+            the recording sites are 0 (as griddata with fill_value = 0)
+        tolerance : float
+            Weights smaller than this are dropped from the sparse matrix
+        """
+
+        self.source_positions = np.asarray(source_positions, dtype = 'float64')
+        self.target_positions = np.asarray(target_positions, dtype = 'float64')
+
+        num_sites = self.source_positions.shape[0]
+
+        weights = CloughTocher2DInterpolator(self.source_positions, np.eye(num_sites),
+                                             fill_value = 0, rescale = False)(self.target_positions)
+        weights[np.abs(weights) < tolerance] = 0
+
+        # (num_targets x num_sites)
+        self.weights = sparse.csr_matrix(weights)
+
+    def __call__(self, templates):
+
+        """
+        Interpolates the last axis of templates (..., num_sites), e.g. one
+        template (samples x sites) or many (templates x samples x sites)
+
+        Outputs:
+        --------
+        numpy.ndarray (..., num_targets)
+
+        """
+
+        templates = np.asarray(templates)
+        values = templates.reshape((-1, templates.shape[-1])).astype('float64')
+
+        interpolated = (self.weights @ values.T).T
+
+        return interpolated.reshape(templates.shape[:-1] + (self.weights.shape[0],))
+
+
+# one interpolator per pair of site layouts, per process
+_interpolators = {}
+
+
+def get_template_interpolator(source_positions, target_positions):
+
+    """ TemplateInterpolator for these site positions, built once and reused """
+
+    source_positions = np.ascontiguousarray(source_positions, dtype = 'float64')
+    target_positions = np.ascontiguousarray(target_positions, dtype = 'float64')
+
+    key = (source_positions.shape, source_positions.tobytes(),
+           target_positions.shape, target_positions.tobytes())
+
+    if key not in _interpolators:
+        _interpolators[key] = TemplateInterpolator(source_positions, target_positions)
+
+    return _interpolators[key]
@@ -8,6 +8,8 @@ import pathlib
 
 from git import Repo
 
+from .kilosort_dataset import KilosortDataset
+
 
 def find_range(x,a,b,option='within'):
     
@@ -253,6 +255,9 @@ def load_kilosort_data(folder,
     """
     Loads Kilosort output files from a directory
 
+    Wrapper over KilosortDataset, which loads files on demand; use it
+    directly to load only the arrays a module needs.
+
     Inputs:
     -------
     folder : String
@@ -299,49 +304,31 @@ def load_kilosort_data(folder,
 
     """
 
-    if use_master_clock:
-        spike_times = load(folder,'spike_times_master_clock.npy')
-    else:
-        spike_times = load(folder,'spike_times.npy')
-        
-    spike_clusters = load(folder,'spike_clusters.npy')
-    spike_templates = load(folder, 'spike_templates.npy')
-    amplitudes = load(folder,'amplitudes.npy')
-    templates = load(folder,'templates.npy')
-    unwhitening_mat = load(folder,'whitening_mat_inv.npy')
-    channel_map = load(folder, 'channel_map.npy')
-    channel_pos = load(folder, 'channel_positions.npy')
-
-    if include_pcs:
-        pc_features = load(folder, 'pc_features.npy')
-        pc_feature_ind = load(folder, 'pc_feature_ind.npy')
-        template_features = load(folder, 'template_features.npy') 
+    ks = KilosortDataset(folder,
+                         use_master_clock = use_master_clock,
+                         template_zero_padding = template_zero_padding)
 
-                
-    templates = templates[:,template_zero_padding:,:] # remove zeros
-    spike_clusters = np.squeeze(spike_clusters) # fix dimensions
-    spike_times = np.squeeze(spike_times)# fix dimensions
+    spike_times = ks.spike_times
 
     if convert_to_seconds and sample_rate is not None:
        spike_times = spike_times / sample_rate 
-                    
-    unwhitened_temps = np.zeros((templates.shape))
-    
-    for temp_idx in range(templates.shape[0]):
-        
-        unwhitened_temps[temp_idx,:,:] = np.dot(np.ascontiguousarray(templates[temp_idx,:,:]),np.ascontiguousarray(unwhitening_mat))
-    
+
+    spike_clusters = ks.spike_clusters
+    spike_templates = ks.spike_templates
+    amplitudes = ks.amplitudes
+    unwhitened_temps = ks.unwhitened_templates
+    channel_map = ks.channel_map
+    channel_pos = ks.channel_positions
+
     # removed option to read cluster_ids from cluster_group_tsv because this file is changed by phy.                
-    # try:
-    #     cluster_ids, cluster_quality = read_cluster_group_tsv(os.path.join(folder, 'cluster_group.tsv'))
-    # except OSError:
-    cluster_ids = np.unique(spike_clusters)
-    cluster_quality = ['unsorted'] * cluster_ids.size
-        
+    cluster_ids = ks.cluster_ids
+    cluster_quality = ks.cluster_quality
     cluster_amplitude = read_cluster_amplitude_tsv(os.path.join(folder, 'cluster_Amplitude.tsv'))
-    
-        
-        
+
+    if include_pcs:
+        pc_features = ks.pc_features
+        pc_feature_ind = ks.pc_feature_ind
+        template_features = ks.template_features
 
     if not include_pcs:
         return spike_times, spike_clusters, spike_templates, amplitudes, unwhitened_temps, \
@@ -596,45 +583,21 @@ def catGT_ex_params_from_str(ex_str):
 def getSortResults(output_dir, clu_version):
     # load results from phy for run logging and creation of the table for C_Waves
 
-    cluLabel = np.load(os.path.join(output_dir, 'spike_clusters.npy'))
-    spkTemplate = np.load(os.path.join(output_dir,'spike_templates.npy'))
-    cluLabel = np.squeeze(cluLabel)
-    spkTemplate = np.squeeze(spkTemplate)
+    # After manual splits or merges, some labels will have spikes found with
+    # different templates. The peak channel of each label is taken from its
+    # most common template, unwhitened with the inverse of the whitening
+    # matrix. The per-label summary is computed in one pass and cached in
+    # output_dir by KilosortDataset, shared with the other modules.
+    ks = KilosortDataset(output_dir)
 
-    unqLabel, labelCounts = np.unique(cluLabel, return_counts = True)
-    nTot = cluLabel.shape[0]
-    nLabel = unqLabel.shape[0]
-    maxLabel = np.max(unqLabel)
+    nTot = ks.spike_clusters.shape[0]
+    nTemplate = ks.templates.shape[0]
 
-    templates = np.load(os.path.join(output_dir, 'templates.npy'))
-    channel_map = np.load(os.path.join(output_dir, 'channel_map.npy'))
-    channel_map = np.squeeze(channel_map)
-    
-    # read in inverse of whitening matrix
-    w_inv = np.load((os.path.join(output_dir, 'whitening_mat_inv.npy')))
-    nTemplate = templates.shape[0]
-    
-    # initialize peak_channels array
-    peak_channels = np.zeros([nLabel,],'uint32')
-    
-   
-    # After manual splits or merges, some labels will have spikes found with
-    # different templats.
-    # for each label in the list unqLabel, get the most common template
-    # For that template (nt x nchan), multiply the the transpose (nchan x nt) by inverse of 
-    # the whitening matrix (nchan x nchan); get max and min along tthe time axis (1)
-    # to find the peak channel
-    for i in np.arange(0,nLabel):
-        curr_spkTemplate = spkTemplate[np.where(cluLabel==unqLabel[i])]
-        template_mode = np.argmax(np.bincount(curr_spkTemplate))
-        currT = templates[template_mode,:].T
-        curr_unwh = np.matmul(w_inv, currT)
-        currdiff = np.max(curr_unwh,1) - np.min(curr_unwh,1)
-        peak_channels[i] = channel_map[np.argmax(currdiff)]
-
-    clus_Table = np.zeros((maxLabel+1, 2), dtype='uint32')
-    clus_Table[unqLabel, 0] = labelCounts
-    clus_Table[unqLabel, 1] = peak_channels
+    labelCounts = ks.cluster_spike_counts
+
+    clus_Table = np.zeros((labelCounts.size, 2), dtype='uint32')
+    clus_Table[:, 0] = labelCounts
+    clus_Table[labelCounts > 0, 1] = ks.cluster_peak_channels[labelCounts > 0]
 
     if clu_version == 0:
         np.save(os.path.join(output_dir, 'clus_Table.npy'), clus_Table)
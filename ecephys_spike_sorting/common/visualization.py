@@ -1,3 +1,4 @@
+import os
 import numpy as np 
 import matplotlib.pyplot as plt 
 
@@ -7,9 +8,21 @@ from .utils import (get_spike_depths,
                     get_spike_amplitudes,
                     load_kilosort_data,
                     rms)
+from .raw_recording import RawRecording
 
 
-def plotKsTemplates(ks_directory, raw_data_file, sample_rate = 30000, bit_volts = 0.195, time_range = [10, 11], exclude_noise=True, fig=None, output_path=None):
+def _load_raw_data(raw_data_file, num_channels):
+
+    # channel count from the SpikeGLX .meta file if there is one, otherwise
+    # a 384-channel Open Ephys file is assumed (.cbin files store their own)
+    meta_file = os.path.splitext(raw_data_file)[0] + '.meta'
+    if num_channels is None and not os.path.exists(meta_file) and not raw_data_file.endswith('.cbin'):
+        num_channels = 384
+
+    return RawRecording(raw_data_file, num_channels = num_channels).data
+
+
+def plotKsTemplates(ks_directory, raw_data_file, sample_rate = 30000, bit_volts = 0.195, time_range = [10, 11], exclude_noise=True, fig=None, output_path=None, num_channels=None):
 
     """
     Compares the template-based model to the raw data
@@ -32,6 +45,8 @@ def plotKsTemplates(ks_directory, raw_data_file, sample_rate = 30000, bit_volts
         Figure handle to use for plotting
     output_path : str
         Path for saving the image
+    num_channels : int
+        Number of channels in the raw data file (default from the .meta file, or 384)
 
     Outputs:
     --------
@@ -47,8 +62,7 @@ def plotKsTemplates(ks_directory, raw_data_file, sample_rate = 30000, bit_volts
                     use_master_clock = False,
                     include_pcs = True)
 
-    raw_data = np.memmap(raw_data_file, dtype='int16')
-    data = np.reshape(raw_data, (int(raw_data.size / 384), 384))
+    data = _load_raw_data(raw_data_file, num_channels)
 
     if fig is None:
         fig = plt.figure(figsize=(16,10))
@@ -187,7 +201,7 @@ def plotDriftmap(ks_directory, sample_rate = 30000, time_range = [0, np.inf], ex
 
 
 
-def plotContinuousFile(raw_data_file, sample_rate = 30000, bit_volts = 0.195, noise_threshold = 20, time_range = [1000, 1002], fig=None, output_path=None):
+def plotContinuousFile(raw_data_file, sample_rate = 30000, bit_volts = 0.195, noise_threshold = 20, time_range = [1000, 1002], fig=None, output_path=None, num_channels=None):
 
     """
     Compares the template-based model to the raw data
@@ -208,6 +222,8 @@ def plotContinuousFile(raw_data_file, sample_rate = 30000, bit_volts = 0.195, no
         Figure handle to use for plotting
     output_path : str
         Path for saving the image
+    num_channels : int
+        Number of channels in the raw data file (default from the .meta file, or 384)
 
     Outputs:
     --------
@@ -215,8 +231,7 @@ def plotContinuousFile(raw_data_file, sample_rate = 30000, bit_volts = 0.195, no
 
     """
 
-    raw_data = np.memmap(raw_data_file, dtype='int16')
-    data = np.reshape(raw_data, (int(raw_data.size / 384), 384))
+    data = _load_raw_data(raw_data_file, num_channels)
 
     if fig is None:
         fig = plt.figure(figsize=(15,12))
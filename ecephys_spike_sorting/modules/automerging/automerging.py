@@ -2,9 +2,8 @@ import os
 import pandas as pd
 import numpy as np
 
-from .metrics import compare_templates, make_interp_temp, compute_isi_score, compute_isi_score
+from .metrics import get_depth_spectrum, compare_template_spectra, make_interp_temp, compute_isi_score, find_depth
 from .merges import compute_overall_score, ID_merge_groups, make_merges
-from ...common.spike_template_helpers import find_depth
 
 def automerging(spike_times, spike_clusters, clusterIDs, cluster_quality, templates, params):
 
@@ -39,28 +38,45 @@ def automerging(spike_times, spike_clusters, clusterIDs, cluster_quality, templa
 
     max_time = np.max(spike_times)
 
+    # spike times of each cluster, from one sort
+    order = np.argsort(spike_clusters, kind = 'stable')
+    unique_clusters, first_spike = np.unique(spike_clusters[order], return_index = True)
+    cluster_times = dict(zip(unique_clusters, np.split(spike_times[order], first_spike[1:])))
+    empty = spike_times[:0]
+
+    # interpolated template spectra, computed once per cluster; clusters are
+    # in depth order and only compared with deeper ones, so each is dropped
+    # after its own row
+    spectra = {}
+
+    def get_spectrum(index):
+        if index not in spectra:
+            spectra[index] = get_depth_spectrum(make_interp_temp(templates, [clusterIDs[index]]))
+        return spectra[index]
+
     for i in range(0,depths.size):
 
         if is_good[i]:
             
-            temp1 = make_interp_temp(templates,[clusterIDs[i]]) #
-            times1 = spike_times[spike_clusters == clusterIDs[i]]
+            spectrum1 = get_spectrum(i)
+            times1 = cluster_times.get(clusterIDs[i], empty)
             
             for j in range(i+1,depths.size):
                 
                 if comparison_matrix[i,j,0] == 1:
                     
-                    temp2 = make_interp_temp(templates, [clusterIDs[j]]) #
-                    times2 = spike_times[spike_clusters == clusterIDs[j]]
+                    spectrum2 = get_spectrum(j)
+                    times2 = cluster_times.get(clusterIDs[j], empty)
                     
-                    rms, offset_distance = compare_templates(temp1, temp2) #
+                    rms, offset_distance = compare_template_spectra(spectrum1, spectrum2) #
                    # overlap = percent_overlap(times1, times2, min_t, max_t, 50) #
                     cISI_score, score_weight, ISI1, ISI2, cISI, rcISI, another_score = compute_isi_score(times1, times2, max_time)
-                    is_good
                     comparison_matrix[i,j,1] = np.max(rms)
                     comparison_matrix[i,j,2] = another_score
                     comparison_matrix[i,j,3] = cISI_score
 
+        spectra.pop(i, None)
+
     overall_score, i_index, j_index = compute_overall_score(comparison_matrix)
 
     comparison_matrix[:,:,4] = 0
@@ -1,7 +1,8 @@
-from scipy.interpolate import griddata
 from scipy.signal import correlate
+from scipy.fft import next_fast_len
 import numpy as np
 from .spike_ISI import *    
+from ...common.template_interpolation import get_template_interpolator
 
 def find_depth(template):
     
@@ -81,53 +82,108 @@ def make_interp_temp(templates, indices):
     to_include = np.arange(0,total_channels)
     to_include = np.delete(to_include, refs)
     
-    interp_temp = np.zeros((templates.shape[1],templates.shape[2]*7,indices.size))
-    
-    for i in np.arange(indices.size):
-        
-        temp = templates[indices[i], :, :]
-        
-        for t in range(0,total_samples):
-            
-            interp_temp[t,:,i] = griddata(loc_a[to_include,:], temp[t,to_include], loc_i, method='cubic', fill_value=0, rescale=False)  
+    # all samples of all selected templates in one product
+    interpolator = get_template_interpolator(loc_a[to_include,:], loc_i)
+    interp_temp = np.moveaxis(interpolator(templates[indices][:,:,to_include]), 0, 2)
         
     return np.reshape(np.mean(interp_temp,2), (total_samples, total_channels, 7)).astype('float')       
 
 
-def compare_templates(t1, t2):
-    
-    depth1 = find_depth(t1) / 7
-    depth2 = find_depth(t2) / 7
-    
-    total_channels = t1.shape[1]
+def get_depth_spectrum(interp_temp):
+
+    """
+    Precomputes what compare_templates needs from one interpolated template
+
+    The template is flattened to one vector per depth row (samples x 7
+    columns) and Fourier transformed along depth, so the correlation with
+    another template at every vertical offset is one product of spectra.
+
+    Inputs:
+    -------
+    interp_temp : numpy.ndarray (samples x depth rows x 7), from make_interp_temp
+
+    Outputs:
+    --------
+    spectrum : dict with the depth of the peak (in rows), the spectrum, and
+        the sum and sum of squares of the template
+
+    """
+
+    total_rows = interp_temp.shape[1]
+    fft_length = next_fast_len(2 * total_rows)
+
+    rows = np.reshape(np.moveaxis(interp_temp, 1, 0), (total_rows, -1)).astype('float64')
+
+    return {'depth' : find_depth(interp_temp) / 7,
+            'spectrum' : np.fft.rfft(rows, fft_length, axis = 0),
+            'fft_length' : fft_length,
+            'sum' : np.sum(rows),
+            'sum_sq' : np.sum(rows ** 2),
+            'shape' : interp_temp.shape}
+
+
+def compare_template_spectra(s1, s2):
+
+    """
+    Correlation of two interpolated templates at each vertical offset of
+    the second, from their get_depth_spectrum outputs
+
+    Same as compare_templates, with both templates placed in a zero-padded
+    (samples x padded rows x 7) array and np.corrcoef taken for each
+    offset; the template sums don't change with the offset, and the
+    cross terms for all offsets come from one inverse FFT.
+    """
+
+    total_samples, total_channels, num_columns = s1['shape']
+
+    depth1 = s1['depth']
+    depth2 = s2['depth']
+
     max_padding = 10
     if np.max((depth1,depth2)) < max_padding:
         padding_neg = int(np.max((depth1, depth2)))
     else:
         padding_neg = max_padding
-        
+
     if np.min((depth1,depth2)) > total_channels - max_padding:
         padding_pos = int(total_channels - np.min((depth1, depth2)))
     else:
         padding_pos = max_padding
-    
-    m1 = np.zeros((61, total_channels+padding_neg+padding_pos, 7))
-    m1[:,padding_neg:total_channels+padding_neg,:] = t1
-    m2 = np.zeros((61, total_channels+padding_neg+padding_pos, 7))
-    
-    sim = np.zeros((padding_neg + padding_pos,))
-    offset_distance = np.zeros((padding_neg + padding_pos,))
-    ii = 0
-    
-    for idx, offset in enumerate(range(-padding_neg, padding_pos)):
-        m2[:,padding_neg+offset:total_channels+padding_neg+offset,:] = t2
-        sim[ii] = np.corrcoef(m1.flatten(), m2.flatten())[0,1]
-        offset_distance[idx] = -offset*10
-        ii += 1
-        
+
+    offsets = np.arange(-padding_neg, padding_pos)
+
+    # sum over rows r of t1[r] . t2[r - offset], for every offset
+    fft_length = s1['fft_length']
+    cross = np.fft.irfft(np.sum(s1['spectrum'] * np.conj(s2['spectrum']), 1), fft_length)
+    sum_xy = cross[offsets % fft_length]
+
+    n = total_samples * (total_channels + padding_neg + padding_pos) * num_columns
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        sim = (n * sum_xy - s1['sum'] * s2['sum']) / \
+            np.sqrt((n * s1['sum_sq'] - s1['sum'] ** 2) * (n * s2['sum_sq'] - s2['sum'] ** 2))
+
+    offset_distance = -offsets * 10.0
+
     return sim, offset_distance
 
 
+def compare_templates(t1, t2):
+
+    """
+    Correlation of two interpolated templates (from make_interp_temp) with
+    the second shifted by up to 10 rows (100 um) up or down
+
+    Outputs:
+    --------
+    sim : correlation at each offset
+    offset_distance : offset of the second template, in um
+
+    """
+
+    return compare_template_spectra(get_depth_spectrum(t1), get_depth_spectrum(t2))
+
+
 def compute_isi_score(t1, t2, max_time):
     
     cISI_score, score_weight, ISI1, ISI2, cISI, rcISI = find_cISI_score(t1, t2, max_time)
@@ -8,7 +8,8 @@ import numpy as np
 
 from ecephys_spike_sorting.modules.depth_estimation.depth_estimation import compute_channel_offsets, find_surface_channel
 from ecephys_spike_sorting.common.utils import write_probe_json
-from ecephys_spike_sorting.common.SGLXMetaToCoords import MetaToCoords
+from ecephys_spike_sorting.common.probe_geometry import ProbeGeometry
+from ecephys_spike_sorting.common.raw_recording import RawRecording
 
 def run_depth_estimation(args):
 
@@ -18,16 +19,17 @@ def run_depth_estimation(args):
 
     numChannels = args['ephys_params']['num_channels']
 
-    rawDataAp = np.memmap(args['ephys_params']['ap_band_file'], dtype='int16', mode='r')
-    dataAp = np.reshape(rawDataAp, (int(rawDataAp.size/numChannels), numChannels))
+    dataAp = RawRecording(args['ephys_params']['ap_band_file'], num_channels = numChannels).data
 
-    rawDataLfp = np.memmap(args['ephys_params']['lfp_band_file'], dtype='int16', mode='r')
-    dataLfp = np.reshape(rawDataLfp, (int(rawDataLfp.size/numChannels), numChannels))
+    dataLfp = RawRecording(args['ephys_params']['lfp_band_file'], num_channels = numChannels).data
     
     metaName, binExt = os.path.splitext(args['ephys_params']['ap_band_file'])
     metaFullPath = Path(metaName + '.meta')  
     
-    [xCoord, yCoord, shankInd] = MetaToCoords(metaFullPath, -1, badChan= np.zeros((0), dtype = 'int'), destFullPath = '', showPlot=False)
+    geometry = ProbeGeometry.from_meta(metaFullPath)
+    xCoord = geometry.positions[:,0]
+    yCoord = geometry.positions[:,1]
+    shankInd = geometry.shank_index
 
     print('Computing surface channel...')
 
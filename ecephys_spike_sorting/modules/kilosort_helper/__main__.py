@@ -15,6 +15,7 @@ from scipy.signal import butter, filtfilt, medfilt
 
 from . import matlab_file_generator
 from ...common.SGLXMetaToCoords import MetaToCoords
+from ...common.raw_recording import RawRecording
 from ...common.utils import read_probe_json, get_repo_commit_date_and_hash, rms
 
 def run_kilosort(args):
@@ -198,12 +199,10 @@ def get_noise_channels(raw_data_file, num_channels, sample_rate, bit_volts, nois
     noise_delay = 5            #in seconds
     noise_interval = 10         #in seconds
     
-    raw_data = np.memmap(raw_data_file, dtype='int16')
-    
-    num_samples = int(raw_data.size/num_channels)
-      
-    data = np.reshape(raw_data, (num_samples, num_channels))
-   
+    recording = RawRecording(raw_data_file, num_channels = num_channels, bit_volts = bit_volts)
+
+    num_samples = recording.num_samples
+
     start_index = int(noise_delay * sample_rate)
     end_index = int((noise_delay + noise_interval) * sample_rate)
     
@@ -217,12 +216,10 @@ def get_noise_channels(raw_data_file, num_channels, sample_rate, bit_volts, nois
     
     b, a = butter(3, [10/(sample_rate/2), uplim], btype='band')
 
-    D = data[start_index:end_index, :] * bit_volts
-    
-    D_filt = np.zeros(D.shape)  # datatype set by D
+    # float32 in uV; filtered along time for all channels at once
+    D = recording.read(start_index, end_index)
 
-    for i in range(D.shape[1]):
-        D_filt[:,i] = filtfilt(b, a, D[:,i])
+    D_filt = filtfilt(b, a, D, axis = 0)
 
     rms_values = np.apply_along_axis(rms, axis=0, arr=D_filt)
 
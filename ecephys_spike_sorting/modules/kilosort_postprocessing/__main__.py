@@ -6,9 +6,12 @@ import time
 
 import numpy as np
 
-from ...common.utils import load_kilosort_data, getSortResults
+from ...common.utils import getSortResults
+from ...common.kilosort_dataset import KilosortDataset, write_spike_index
+from ...common.feature_store import compact_features, mark_removed_spikes
+from ...common.probe_geometry import ProbeGeometry
 
-from .postprocessing import remove_double_counted_spikes
+from .postprocessing import find_double_counted_spikes
 from .postprocessing import align_spike_times
 
 def run_postprocessing(args):
@@ -24,50 +27,49 @@ def run_postprocessing(args):
     
     include_pcs = args['ks_postprocessing_params']['include_pcs']
     
-    if include_pcs:
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                    load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                        args['ephys_params']['sample_rate'], \
-                        convert_to_seconds = False, \
-                        use_master_clock = False, \
-                        include_pcs = include_pcs )
-    else:
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-                    load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                        args['ephys_params']['sample_rate'], \
-                        convert_to_seconds = False, \
-                        use_master_clock = False, \
-                        include_pcs = include_pcs )
-        # empty arrays to stand in for the missing variables
-        pc_features = []
-        pc_feature_ind = []
-        template_features = []
-        
+    # only the template peak channels are needed, so the templates are
+    # unwhitened on their active channels only
+    ks = KilosortDataset(args['directories']['kilosort_output_directory'])
+
+    spike_times = ks.spike_times
+    spike_clusters = ks.spike_clusters
+    spike_templates = ks.spike_templates
+    amplitudes = ks.amplitudes
+    channel_map = ks.channel_map
+    channel_pos = ks.channel_positions
+    cluster_amplitude = ks.cluster_amplitude
+
+    # pc_features and template_features are not loaded; they are compacted
+    # on disk, in chunks, when the outputs are saved
+    keep = None
+
     if args['ks_postprocessing_params']['align_avg_waveform']: 
         spike_times = align_spike_times(spike_times,
                                         spike_clusters,
                                         args['ephys_params']['ap_band_file'], 
                                         args['directories']['kilosort_output_directory'], 
-                                        args['ks_postprocessing_params']['cWaves_path'])
+                                        args['ks_postprocessing_params'].get('cWaves_path'),
+                                        args['ks_postprocessing_params']['use_C_Waves'],
+                                        args['ephys_params']['num_channels'])
         
     if args['ks_postprocessing_params']['remove_duplicates']:
-        spike_times, spike_clusters, spike_templates, amplitudes, pc_features, \
-        template_features, overlap_matrix, overlap_summary = \
-            remove_double_counted_spikes(spike_times, 
-                                         spike_clusters,
-                                         spike_templates, 
-                                         amplitudes, 
-                                         channel_map,
-                                         channel_pos,
-                                         templates, 
-                                         pc_features, 
-                                         pc_feature_ind, 
-                                         template_features,
-                                         cluster_amplitude,
-                                         args['ephys_params']['sample_rate'],
-                                         args['ks_postprocessing_params'])
+        keep, overlap_matrix, overlap_summary = \
+            find_double_counted_spikes(spike_times, 
+                                       spike_clusters,
+                                       channel_map,
+                                       channel_pos,
+                                       None, 
+                                       cluster_amplitude,
+                                       args['ephys_params']['sample_rate'],
+                                       args['ks_postprocessing_params'],
+                                       peak_chan_idx = ks.sparse_templates.peak_channel_index,
+                                       geometry = ProbeGeometry.from_kilosort(ks.folder))
+
+        # the within- and between-unit duplicates are removed in one pass
+        spike_times = spike_times[keep]
+        spike_clusters = spike_clusters[keep]
+        spike_templates = spike_templates[keep]
+        amplitudes = amplitudes[keep]
 
 
     print("Saving data...")
@@ -79,9 +81,16 @@ def run_postprocessing(args):
     np.save(os.path.join(output_dir, 'spike_clusters.npy'), spike_clusters)
     np.save(os.path.join(output_dir, 'spike_templates.npy'), spike_templates)
     
-    if args['ks_postprocessing_params']['include_pcs']:
-        np.save(os.path.join(output_dir, 'pc_features.npy'), pc_features)
-        np.save(os.path.join(output_dir, 'template_features.npy'), template_features)
+    if include_pcs:
+        use_store = args['ks_postprocessing_params']['feature_store']
+        stored_dtype = args['ks_postprocessing_params']['feature_store_dtype']
+        for name in ('pc_features', 'template_features'):
+            if args['ks_postprocessing_params']['virtual_feature_deletion']:
+                # the feature files keep their format; only the removed spikes are written
+                if keep is not None:
+                    mark_removed_spikes(output_dir, name, keep)
+            else:
+                compact_features(output_dir, name, keep, use_store, stored_dtype)
     
     if args['ks_postprocessing_params']['remove_duplicates']:
         np.save(os.path.join(output_dir, 'overlap_matrix.npy'), overlap_matrix)
@@ -89,6 +98,10 @@ def run_postprocessing(args):
         # save the overlap_summary as a text file -- allows user to easily understand what happened
         np.savetxt(os.path.join(output_dir, 'overlap_summary.csv'), overlap_summary, fmt = '%d', delimiter = ',')
 
+    # cluster-sorted spike index for per-unit access; consumers regenerate
+    # it through KilosortDataset if phy changes spike_clusters.npy later
+    write_spike_index(output_dir, spike_clusters, spike_times)
+
     execution_time = time.time() - start
 
     print('total time: ' + str(np.around(execution_time,2)) + ' seconds')
@@ -13,6 +13,10 @@ class PostprocessingParams(DefaultSchema):
     remove_duplicates = Boolean(required=False, default=True, help='Set to True for duplicate removal')
     align_avg_waveform = Boolean(required=False, default=True, help='Set to true to set spike times for mean waveform min = t0')
     cWaves_path = InputDir(require=False, help='directory containing the CWaves executable.')
+    use_C_Waves = Boolean(required=False, default=False, help='Use C_Waves for the mean waveforms in align_avg_waveform; otherwise they are computed in-process from the binary')
+    feature_store = Boolean(required=False, default=False, help='Save pc_features and template_features as compressed blocked stores (.blk) instead of .npy; phy needs the .npy files')
+    feature_store_dtype = String(required=False, default='float32', help='float32, or float16 to halve the size of the stores (lossy)')
+    virtual_feature_deletion = Boolean(required=False, default=False, help='Leave pc_features and template_features unchanged and list the removed spikes in .removed.npy sidecars instead; run scripts/helpers/materialize_features.py before opening the output in phy')
 
 class InputParameters(ArgSchema):
     
@@ -4,13 +4,15 @@ import sys
 import subprocess
 from collections import OrderedDict
 
-from ...common.utils import printProgressBar
 from ...common.utils import getSortResults
+from ...common.probe_geometry import ProbeGeometry
+from ...common.raw_recording import RawRecording
+from ...common.kilosort_dataset import KilosortDataset
 
 def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates, 
                                  amplitudes, channel_map, channel_pos, templates, pc_features, 
                                  pc_feature_ind, template_features, cluster_amplitude, 
-                                 sample_rate, params, epochs = None):
+                                 sample_rate, params, epochs = None, peak_chan_idx = None, geometry = None):
 
     """ Remove putative double-counted spikes from Kilosort outputs
 
@@ -29,7 +31,7 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
     channel_pos : numpy.ndarray (num_channels x 2)
         X and Z coordinates for each channel used in the sort    
     templates : numpy.ndarray (num_units x num_channels x num_samples)
-        Spike templates for each unit
+        Spike templates for each unit (not used if peak_chan_idx is given)
     pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
         Pre-computed PCs for blocks of channels around each spike
     pc_feature_ind : numpy.ndarray (num_units x num_channels)
@@ -43,6 +45,11 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
         'include_pcs' : whether to update files pc_features and template_features. Should be 'true' unless these files are absent
     epochs : list of Epoch objects
         contains information on Epoch start and stop times
+    peak_chan_idx : numpy.ndarray (num_units x 0), optional
+        Template channel index of each unit's peak, e.g. from SparseTemplates
+    geometry : ProbeGeometry, optional
+        Geometry of the template channels, e.g. ProbeGeometry.from_kilosort;
+        built from channel_pos if not given
 
     
     Outputs:
@@ -63,9 +70,62 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
         Matrix indicating number of spikes removed for each pair of clusters
 
     """
-    include_pcs = params['include_pcs']
+    keep, overlap_matrix, overlap_summary = find_double_counted_spikes(spike_times,
+                                                                       spike_clusters,
+                                                                       channel_map,
+                                                                       channel_pos,
+                                                                       templates,
+                                                                       cluster_amplitude,
+                                                                       sample_rate,
+                                                                       params,
+                                                                       peak_chan_idx,
+                                                                       geometry)
+
+    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times,
+                                                                         spike_clusters,
+                                                                         spike_templates,
+                                                                         amplitudes,
+                                                                         pc_features,
+                                                                         template_features,
+                                                                         np.flatnonzero(~keep),
+                                                                         params['include_pcs'])
+
+    return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, overlap_matrix, overlap_summary
+
+                
+def find_double_counted_spikes(spike_times, spike_clusters, channel_map, channel_pos, templates,
+                               cluster_amplitude, sample_rate, params, peak_chan_idx = None, geometry = None):
+
+    """
+    Finds putative double-counted spikes without modifying any outputs
+
+    Within-unit duplicates are found first; between-unit duplicates are
+    then found among the spikes that remain, as if the within-unit
+    duplicates had already been deleted. Both passes only mark spikes in
+    one mask, so the (possibly memory-mapped) feature arrays can be
+    compacted once afterwards, e.g. with compact_features in
+    common/feature_store.py.
+
+    Inputs:
+    -------
+    As for remove_double_counted_spikes
+
+    Outputs:
+    --------
+    keep : numpy.ndarray (num_spikes x 0), bool
+        False for the spikes to remove
+    overlap_matrix : numpy.ndarray (num_clusters x num_clusters)
+        Matrix indicating number of spikes removed for each pair of clusters
+    overlap_summary : numpy.ndarray (num_clusters x 5)
+        Rows of overlap_summary.csv, sorted by cluster label
+
+    """
 
-    peak_chan_idx = np.squeeze(np.argmax(np.max(templates,1) - np.min(templates,1),1))
+    if peak_chan_idx is None:
+        peak_chan_idx = np.squeeze(np.argmax(np.max(templates,1) - np.min(templates,1),1))
+
+    if geometry is None:
+        geometry = ProbeGeometry(channel_pos)
 
     # to accomdate case where matlab writes out chan map as (1,nchan) instead of (nchan,1)
     channel_map = np.squeeze(channel_map);
@@ -87,74 +147,53 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
 
     print('Removing within-unit overlapping spikes...')
 
-    spikes_to_remove = np.zeros((0,), dtype = 'int')
+    keep = np.ones(spike_times.shape, dtype = bool)
 
-    for idx1, unit_id1 in enumerate(sorted_unit_list):
+    # all units in one pass: with the spikes grouped by cluster (keeping
+    # their order within each cluster, as find_within_unit_overlap sees
+    # them), the earlier spike of each close pair in the same cluster is removed
+    by_cluster = np.argsort(spike_clusters, kind = 'stable')
+    grouped_clusters = spike_clusters[by_cluster]
 
-        printProgressBar(idx1+1, len(unit_list))
+    same_unit = (grouped_clusters[1:] == grouped_clusters[:-1]) & (grouped_clusters[:-1] < num_clusters)
+    too_close = np.diff(spike_times[by_cluster]) < within_unit_overlap_samples
 
-        for_unit1 = np.where(spike_clusters == unit_id1)[0]
+    within_unit_duplicates = by_cluster[:-1][same_unit & too_close]
+    keep[within_unit_duplicates] = False
 
-        to_remove = find_within_unit_overlap(spike_times[for_unit1], within_unit_overlap_samples)
-
-        overlap_matrix[idx1, idx1] = len(to_remove)
-
-        spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove]))
-
-    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
-                                                                        spike_clusters, 
-                                                                        spike_templates, 
-                                                                        amplitudes, 
-                                                                        pc_features, 
-                                                                        template_features, 
-                                                                        spikes_to_remove,
-                                                                        include_pcs)
+    within_counts = np.bincount(spike_clusters[within_unit_duplicates], minlength = num_clusters)
+    overlap_matrix[np.arange(num_clusters), np.arange(num_clusters)] = within_counts[sorted_unit_list]
 
     print('Removing between-unit overlapping spikes...')
 
-    spikes_to_remove = np.zeros((0,), dtype = 'int')
-
-    for idx1, unit_id1 in enumerate(sorted_unit_list):
-
-        printProgressBar(idx1+1, len(unit_list))
+    # pairs of units whose peak channels are closer than between_unit_dist_um
+    neighbors = geometry.neighbors(params['between_unit_dist_um'], same_shank = False)
 
-        for_unit1 = np.where(spike_clusters == unit_id1)[0]
-        
-        for idx2, unit_id2 in enumerate(sorted_unit_list):
-            
-            deltaX = np.squeeze(channel_pos[peak_chan_idx[unit_id2],0] - channel_pos[peak_chan_idx[unit_id1],0])
-            deltaZ = np.squeeze(channel_pos[peak_chan_idx[unit_id2],1] - channel_pos[peak_chan_idx[unit_id1],1])
-            
-            dist = pow( (pow(deltaX,2) + pow(deltaZ,2)), 0.5 )
-            
-            if idx2 > idx1 and dist < params['between_unit_dist_um']:
-                
-                amp1 = cluster_amplitude[unit_id1]
-                amp2 = cluster_amplitude[unit_id2]
-                
-                for_unit2 = np.where(spike_clusters == unit_id2)[0]
+    close_units = np.zeros((num_clusters, num_clusters), dtype = bool)
+    for unit, peak_chan in enumerate(peak_chan_idx):
+        close_units[unit] = np.isin(peak_chan_idx, neighbors[peak_chan])
 
-                to_remove1, to_remove2 = find_between_unit_overlap(spike_times[for_unit1], spike_times[for_unit2], amp1, amp2, between_unit_overlap_samples, params['deletion_mode'] )
+    remaining = np.flatnonzero(keep)
 
-                overlap_matrix[idx1, idx2] = overlap_matrix[idx1, idx2] + len(to_remove1) 
-                overlap_matrix[idx2, idx1] = overlap_matrix[idx2, idx1] + len(to_remove2)
+    spikes_to_remove, between_matrix = find_all_between_unit_overlaps(spike_times[remaining],
+                                                                      spike_clusters[remaining],
+                                                                      sorted_unit_list,
+                                                                      close_units,
+                                                                      cluster_amplitude,
+                                                                      between_unit_overlap_samples,
+                                                                      params['deletion_mode'])
 
-                spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove1], for_unit2[to_remove2]))
+    overlap_matrix = overlap_matrix + between_matrix
 
+    keep[remaining[spikes_to_remove]] = False
 
-    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
-                                                                         spike_clusters,
-                                                                         spike_templates, 
-                                                                         amplitudes, 
-                                                                         pc_features, 
-                                                                         template_features, 
-                                                                         np.unique(spikes_to_remove),
-                                                                         include_pcs)
 #   build overlap summary 
+    spike_counts = np.bincount(spike_clusters[keep], minlength = num_clusters)
+
     overlap_summary = np.zeros((num_clusters, 5), dtype=int )
     for idx1, unit_id1 in enumerate(sorted_unit_list):
         overlap_summary[idx1,0] = unit_id1
-        overlap_summary[idx1,1] = np.sum(spike_clusters == unit_id1)
+        overlap_summary[idx1,1] = spike_counts[unit_id1]
         overlap_summary[idx1,2] = overlap_matrix[idx1,idx1]
         overlap_summary[idx1,3] = np.sum(overlap_matrix[idx1,:]) - overlap_matrix[idx1,idx1]
         overlap_summary[idx1,4] = sorted_unit_list[np.argmax(overlap_matrix[idx1,:])]     
@@ -162,9 +201,9 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
     new_order = np.argsort(overlap_summary[:,0])
     overlap_summary = overlap_summary[new_order,:]
 
-    return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, overlap_matrix, overlap_summary
+    return keep, overlap_matrix, overlap_summary
+
 
-                
 def find_within_unit_overlap(spike_train, overlap_window = 5):
 
     """
@@ -190,6 +229,237 @@ def find_within_unit_overlap(spike_train, overlap_window = 5):
     return spikes_to_remove
 
 
+def find_all_between_unit_overlaps(spike_times, spike_clusters, sorted_unit_list, close_units,
+                                   cluster_amplitude, overlap_window = 5, deletionMode = 'lowAmpCluster'):
+
+    """
+    Finds overlapping spikes between all pairs of nearby units in one sweep
+
+    Gives the same result as calling find_between_unit_overlap for every
+    pair of units (in sorted_unit_list order) that are close to each other.
+    All spikes are sorted by time once; the pairs of spikes that are
+    consecutive in the combined train of their two units, and close enough
+    in time to matter, are found by comparing each spike with the next few
+    spikes in the sorted order. The spike time difference histograms of the
+    'lowAmpCluster' mode are built from these pairs, and the peak detection
+    and deletion rules are applied per unit pair. A pair whose deletion range
+    is open-ended (the peak next to the last histogram bin) is handed to
+    find_between_unit_overlap, which sees all its spikes.
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times (in samples)
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike
+    sorted_unit_list : numpy.ndarray (num_units x 0)
+        Unit IDs, in the order of the rows of the overlap matrix
+    close_units : numpy.ndarray (num_units x num_units), bool
+        True for pairs of unit IDs that are close enough to compare; as in
+        the pairwise loop, [unit_id1, unit_id2] is read with unit_id1 before
+        unit_id2 in sorted_unit_list
+    cluster_amplitude : numpy.ndarray (num_units x 0)
+        Average amplitude of each unit
+    overlap_window : int
+        Number of samples to search for overlapping spikes
+    deletionMode : 'lowAmpCluster' or 'deleteFirst'
+
+    Outputs:
+    --------
+    spikes_to_remove : numpy.ndarray
+        Indices of the overlapping spikes (may repeat)
+    overlap_matrix : numpy.ndarray (num_units x num_units)
+        Spikes removed from the row unit for each pair, as in
+        remove_double_counted_spikes
+
+    """
+
+    num_units = len(sorted_unit_list)
+    overlap_matrix = np.zeros((num_units, num_units), dtype = 'int')
+
+    # position of each unit in sorted_unit_list; spikes of other cluster IDs
+    # never take part in a comparison
+    rank = np.full((max(num_units, int(np.max(spike_clusters, initial = -1)) + 1),), -1, dtype = 'int64')
+    rank[sorted_unit_list] = np.arange(num_units)
+
+    spike_rank = rank[spike_clusters]
+    in_list = np.flatnonzero(spike_rank >= 0)
+
+    # time order; at equal times the earlier unit in sorted_unit_list comes
+    # first, as in the stable sort of each concatenated pair of trains
+    times = spike_times[in_list].astype('int64')
+    order = in_list[np.lexsort((in_list, spike_rank[in_list], times))]
+    times = spike_times[order].astype('int64')
+    units = spike_rank[order]
+
+    cent_bin_edges = np.arange(0, (overlap_window+4), 2)
+    num_bins = len(cent_bin_edges) - 1
+    max_diff = cent_bin_edges[-1] if deletionMode != 'deleteFirst' else overlap_window
+
+    # pairs of spikes within max_diff that are consecutive in the combined
+    # train of their two units: cross-unit (early, late) pairs, same-unit
+    # pairs, and the other units whose spikes fall between a same-unit pair
+    cross_early, cross_late = [], []
+    same_early, same_late = [], []
+    skip_early, skip_late, skip_unit = [], [], []
+
+    k = 1
+    while k < times.size:
+
+        early = np.flatnonzero(times[k:] - times[:-k] <= max_diff)
+        if early.size == 0:
+            break
+        late = early + k
+
+        x = units[early]
+        y = units[late]
+
+        if k > 1:
+            between = units[early[:,np.newaxis] + np.arange(1, k)]
+            x_between = np.any(between == x[:,np.newaxis], 1)
+            y_between = np.any(between == y[:,np.newaxis], 1)
+        else:
+            x_between = y_between = np.zeros(early.shape, dtype = bool)
+
+        cross = (x != y) & ~x_between & ~y_between
+        cross_early.append(early[cross])
+        cross_late.append(late[cross])
+
+        same = (x == y) & ~x_between
+        same_early.append(early[same])
+        same_late.append(late[same])
+
+        if k > 1:
+            rows, cols = np.nonzero(same[:,np.newaxis] & (between != x[:,np.newaxis]))
+            skip_early.append(early[rows])
+            skip_late.append(late[rows])
+            skip_unit.append(between[rows, cols])
+
+        k += 1
+
+    cross_early = concatenate_indices(cross_early)
+    cross_late = concatenate_indices(cross_late)
+
+    # pairs of units compared by the pairwise loop: (idx1, idx2) with idx1 < idx2
+    # and close_units[unit_id1, unit_id2]
+    close_pairs = np.triu(close_units[np.ix_(sorted_unit_list, sorted_unit_list)], 1)
+    pairs = np.flatnonzero(close_pairs)
+
+    # keep the spike pairs of those units, labelled by (lower rank, higher rank)
+    rank1 = np.minimum(units[cross_early], units[cross_late])
+    rank2 = np.maximum(units[cross_early], units[cross_late])
+    cross_close = close_pairs[rank1, rank2]
+    cross_early = cross_early[cross_close]
+    cross_late = cross_late[cross_close]
+
+    pair_idx = np.searchsorted(pairs, rank1[cross_close] * num_units + rank2[cross_close])
+
+    cross_diffs = times[cross_late] - times[cross_early]
+
+    spikes_to_remove = []
+
+    if deletionMode == 'deleteFirst':
+
+        # the later spike of each pair closer than the window
+        remove = cross_diffs < overlap_window
+        removed = order[cross_late[remove]]
+        removed_rank = units[cross_late[remove]]
+        other_rank = units[cross_early[remove]]
+        np.add.at(overlap_matrix, (removed_rank, other_rank), 1)
+
+        return removed, overlap_matrix
+
+    def hist_bin(diffs):
+        # np.histogram bins; the last bin includes its right edge
+        b = np.searchsorted(cent_bin_edges, diffs, side = 'right') - 1
+        b[diffs == cent_bin_edges[-1]] = num_bins - 1
+        return b
+
+    # spike time difference histogram for each pair of close units
+    cent_hist = np.zeros((pairs.size, num_bins), dtype = 'int64')
+    b = hist_bin(cross_diffs)
+    np.add.at(cent_hist, (pair_idx, b), 1)
+
+    # same-unit differences count toward every pair of that unit, unless a
+    # spike of the other unit falls between them
+    same_early = concatenate_indices(same_early)
+    same_late = concatenate_indices(same_late)
+    same_hist = np.zeros((num_units, num_bins), dtype = 'int64')
+    np.add.at(same_hist, (units[same_early], hist_bin(times[same_late] - times[same_early])), 1)
+
+    cent_hist += same_hist[pairs // num_units] + same_hist[pairs % num_units]
+
+    skip_early = concatenate_indices(skip_early)
+
+    if skip_early.size > 0 and pairs.size > 0:
+        skip_late = concatenate_indices(skip_late)
+        skip_unit = concatenate_indices(skip_unit)
+        # count each (same-unit pair, other unit) once
+        first = np.unique(np.stack((skip_early, skip_unit)), axis = 1, return_index = True)[1]
+        skip_early, skip_late, skip_unit = skip_early[first], skip_late[first], skip_unit[first]
+        skip_key = np.minimum(units[skip_early], skip_unit) * num_units + np.maximum(units[skip_early], skip_unit)
+        skip_pair = np.minimum(np.searchsorted(pairs, skip_key), pairs.size - 1)
+        found = pairs[skip_pair] == skip_key
+        np.add.at(cent_hist, (skip_pair[found], hist_bin(times[skip_late[found]] - times[skip_early[found]])), -1)
+
+    cross_dig = np.digitize(cross_diffs, cent_bin_edges)
+    max_val = len(cent_bin_edges)
+    rem_range = 2
+
+    # peak in the interior of the window, above 20 spikes and 10X the minimum
+    cent_max = np.amax(cent_hist, 1)
+    cent_max_ind = np.argmax(cent_hist, 1)
+    has_peak = (cent_max_ind < num_bins - 1) & (cent_max > 10*np.amin(cent_hist, 1)) & (cent_max > 20)
+
+    for i in np.flatnonzero(has_peak):
+
+        key = pairs[i]
+        idx1, idx2 = key // num_units, key % num_units
+        unit_id1, unit_id2 = sorted_unit_list[idx1], sorted_unit_list[idx2]
+        amp1, amp2 = cluster_amplitude[unit_id1], cluster_amplitude[unit_id2]
+
+        peak_val = cent_max_ind[i] + 1
+        min_rem = np.amax([peak_val-rem_range,1])
+        max_rem = np.amin([peak_val+rem_range,max_val])
+
+        if max_rem == max_val:
+            # every larger difference is deleted too; compare the full trains
+            for_unit1 = np.where(spike_clusters == unit_id1)[0]
+            for_unit2 = np.where(spike_clusters == unit_id2)[0]
+            to_remove1, to_remove2 = find_between_unit_overlap(spike_times[for_unit1], spike_times[for_unit2],
+                                                               amp1, amp2, overlap_window, deletionMode)
+            removed = [for_unit1[to_remove1], for_unit2[to_remove2]]
+            counts = [len(to_remove1), len(to_remove2)]
+        else:
+            in_pair = np.flatnonzero((pair_idx == i) & (cross_dig >= min_rem) & (cross_dig <= max_rem))
+            # delete the spike of the lower amplitude unit from each pair
+            lower = idx1 if amp1 <= amp2 else idx2
+            spikes = np.where(units[cross_early[in_pair]] == lower, cross_early[in_pair], cross_late[in_pair])
+            removed = [order[spikes]]
+            counts = [spikes.size, 0] if lower == idx1 else [0, spikes.size]
+
+        overlap_matrix[idx1, idx2] += counts[0]
+        overlap_matrix[idx2, idx1] += counts[1]
+        spikes_to_remove.extend(removed)
+
+    if spikes_to_remove:
+        spikes_to_remove = np.concatenate(spikes_to_remove)
+    else:
+        spikes_to_remove = np.zeros((0,), dtype = 'int')
+
+    return spikes_to_remove, overlap_matrix
+
+
+def concatenate_indices(arrays):
+
+    """ Concatenates a list of index arrays, which may be empty """
+
+    if len(arrays) == 0:
+        return np.zeros((0,), dtype = 'int64')
+
+    return np.concatenate(arrays)
+
+
 def find_between_unit_overlap(spike_train1, spike_train2, amp1, amp2, overlap_window = 5, deletionMode = 'lowAmpCluster'):
 
     """
@@ -222,7 +492,7 @@ def find_between_unit_overlap(spike_train1, spike_train2, amp1, amp2, overlap_wi
     original_inds = np.concatenate( (np.arange(len(spike_train1)), np.arange(len(spike_train2)) ) )
     cluster_ids = np.concatenate( (np.zeros((len(spike_train1),), dtype = 'int'), np.ones((len(spike_train2),),dtype = 'int')) )
 
-    order = np.argsort(spike_train)
+    order = np.argsort(spike_train, kind = 'stable')
     sorted_train = spike_train[order]
 #   trim off the first member of the array of cluster labels; means the later spike will be picked for any pair
     sorted_cluster_ids = cluster_ids[order][1:]
@@ -337,19 +607,207 @@ def remove_spikes(spike_times, spike_clusters, spike_templates, amplitudes, pc_f
 
     """
 
-    spike_times = np.delete(spike_times, spikes_to_remove, 0)
-    spike_clusters = np.delete(spike_clusters, spikes_to_remove, 0)
-    spike_templates = np.delete(spike_templates, spikes_to_remove, 0)
-    amplitudes = np.delete(amplitudes, spikes_to_remove, 0)
+    # one boolean mask applied to every array, so each is copied once
+    keep = np.ones((len(spike_times),), dtype = bool)
+    keep[spikes_to_remove] = False
+
+    spike_times = spike_times[keep]
+    spike_clusters = spike_clusters[keep]
+    spike_templates = spike_templates[keep]
+    amplitudes = amplitudes[keep]
     
     if include_pcs:
-        pc_features = np.delete(pc_features, spikes_to_remove, 0)
-        template_features = np.delete(template_features, spikes_to_remove, 0)
+        pc_features = pc_features[keep]
+        template_features = template_features[keep]
     # otherwise, just returns the input pc_fearures and template_features arrays
 
     return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features
 
-def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, cWaves_path):
+def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, cWaves_path,
+                      use_C_Waves = False, num_channels = None):
+
+    """
+    Shifts spike times so that the mean waveform of each cluster peaks at
+    pre_samples - 1 (the earlier of the trough and peak if both exceed
+    30 uV, otherwise the larger one)
+
+    Inputs:
+    ------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    spikeglx_bin : String
+        Path of the binary file that was sorted
+    output_dir : String
+        Kilosort output directory
+    cWaves_path : String
+        Directory containing the C_Waves executable (if use_C_Waves)
+    use_C_Waves : bool
+        Compute the mean waveforms with C_Waves instead of in-process
+    num_channels : int (optional)
+        Channels in the binary file; default from its .meta file
+
+    Outputs:
+    --------
+    spike_times : numpy.ndarray (num_spikes x 0)
+
+    """
+
+    if use_C_Waves:
+        mean_waveforms, spike_counts = get_C_Waves_mean_waveforms(spikeglx_bin, output_dir, cWaves_path)
+    else:
+        print('Calculating mean waveforms for align_spike_times...')
+        peak_channels = KilosortDataset(output_dir).cluster_peak_channels
+        mean_waveforms, spike_counts = get_cluster_mean_waveforms(spike_times, spike_clusters,
+                                                                  spikeglx_bin, peak_channels,
+                                                                  num_channels = num_channels)
+
+    deltat = get_alignment_offsets(mean_waveforms, spike_counts)
+
+    # one gather over all spikes; clusters without a mean waveform are not moved
+    deltat = np.concatenate((deltat, np.zeros((max(0, int(np.max(spike_clusters)) + 1 - deltat.size),), dtype = 'int64')))
+
+    shifted = spike_times.astype('int64') - deltat[spike_clusters]
+
+    return np.maximum(shifted, 0).astype(spike_times.dtype)
+
+
+def get_alignment_offsets(mean_waveforms, spike_counts, peak_t = 19, min_spikes = 10, threshold = 30):
+
+    """
+    Alignment offset for each cluster, in samples
+
+    Inputs:
+    -------
+    mean_waveforms : numpy.ndarray (num_clusters x num_samples x num_channels)
+        Mean waveforms in uV
+    spike_counts : numpy.ndarray (num_clusters x 0)
+        Spikes averaged for each cluster; clusters with min_spikes or fewer are not shifted
+    peak_t : int
+        Sample the peak is moved to (pre_samples - 1)
+    threshold : float
+        Trough and peak larger than this (in uV) count as substantial
+
+    Outputs:
+    --------
+    deltat : numpy.ndarray (num_clusters x 0)
+        Samples to subtract from the spike times of each cluster
+
+    """
+
+    num_clusters = mean_waveforms.shape[0]
+
+    ptp = np.max(mean_waveforms, 1) - np.min(mean_waveforms, 1)
+    max_site = np.argmax(ptp, 1)
+    max_site_wave = mean_waveforms[np.arange(num_clusters), :, max_site]
+
+    min_v = np.abs(np.min(max_site_wave, 1))
+    max_v = np.abs(np.max(max_site_wave, 1))
+    min_t = np.argmin(max_site_wave, 1)
+    max_t = np.argmax(max_site_wave, 1)
+
+    # if both are substantial, align to the earlier one; otherwise to the larger
+    mean_peak_time = np.where((min_v > threshold) & (max_v > threshold),
+                              np.minimum(min_t, max_t),
+                              np.where(min_v >= max_v, min_t, max_t))
+
+    deltat = peak_t - mean_peak_time
+    deltat[np.asarray(spike_counts) <= min_spikes] = 0
+
+    return deltat.astype('int64')
+
+
+def get_cluster_mean_waveforms(spike_times, spike_clusters, spikeglx_bin, peak_channels,
+                               num_spikes = 5000, samples_per_spike = 82, pre_samples = 20,
+                               channel_radius = 8, num_channels = None):
+
+    """
+    Mean waveform of each cluster around its peak channel, in uV
+
+    Up to num_spikes spikes, evenly spaced in time, are averaged for each
+    cluster, on the 2 * channel_radius + 1 data channels around its peak
+    channel (shifted inwards at the ends of the probe). All snippets are
+    cut from one time-ordered pass over the binary file. Each channel's
+    mean over the window is subtracted, so the offset of wide-band data
+    does not count as amplitude.
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    spikeglx_bin : String
+        Path of the binary file (.bin, or a compressed .cbin)
+    peak_channels : numpy.ndarray (num_clusters x 0)
+        Data channel with the largest amplitude, for each cluster ID
+    num_channels : int (optional)
+        Channels in the binary file; default from its .meta file
+
+    Outputs:
+    --------
+    mean_waveforms : numpy.ndarray (num_clusters x samples_per_spike x channels)
+    spike_counts : numpy.ndarray (num_clusters x 0)
+        Number of spikes averaged for each cluster
+
+    """
+
+    recording = RawRecording(spikeglx_bin, num_channels = num_channels)
+
+    peak_channels = np.asarray(peak_channels, dtype = 'int64')
+    num_clusters = peak_channels.size
+
+    # the sync channel (if saved) is never part of a neighbourhood
+    if recording.meta and 'snsApLfSy' in recording.meta:
+        num_neural = recording.channel_counts()[0] or recording.num_channels
+    else:
+        num_neural = recording.num_channels
+
+    width = min(2 * channel_radius + 1, num_neural)
+    first_channel = np.clip(peak_channels - channel_radius, 0, num_neural - width)
+    cluster_channels = first_channel[:, np.newaxis] + np.arange(width)
+
+    # evenly spaced spikes of each cluster, as in the C_Waves selection
+    spike_clusters = np.asarray(spike_clusters, dtype = 'int64')
+    by_cluster = np.argsort(spike_clusters, kind = 'stable')
+    bounds = np.searchsorted(spike_clusters[by_cluster], np.arange(num_clusters + 1))
+    counts = np.diff(bounds)
+
+    used = np.minimum(counts, num_spikes)
+    rank = np.arange(np.sum(used)) - np.repeat(np.cumsum(used) - used, used)
+    step = np.repeat(counts / np.maximum(used, 1), used)
+    selected = by_cluster[np.repeat(bounds[:-1], used) + (rank * step).astype('int64')]
+
+    selected_clusters = spike_clusters[selected]
+
+    sums = np.zeros((num_clusters, samples_per_spike, width), dtype = 'float64')
+    spike_counts = np.zeros((num_clusters,), dtype = 'int64')
+
+    for spikes, snippets in recording.iter_snippets(spike_times[selected], pre_samples, samples_per_spike,
+                                                    channels = cluster_channels[selected_clusters]):
+
+        clusters = selected_clusters[spikes]
+        order = np.argsort(clusters, kind = 'stable')
+        clusters = clusters[order]
+        starts = np.flatnonzero(np.diff(clusters, prepend = -1))
+
+        sums[clusters[starts]] += np.add.reduceat(snippets[order].astype('float64'), starts, axis = 0)
+        spike_counts += np.bincount(clusters, minlength = num_clusters)
+
+    mean_waveforms = sums / np.maximum(spike_counts, 1)[:, np.newaxis, np.newaxis]
+    mean_waveforms -= np.mean(mean_waveforms, 1, keepdims = True)
+
+    bit_volts = np.asarray(recording.bit_volts, dtype = 'float64')
+    if bit_volts.ndim > 0:
+        bit_volts = bit_volts[cluster_channels][:, np.newaxis, :]
+
+    return mean_waveforms * bit_volts, spike_counts
+
+
+def get_C_Waves_mean_waveforms(spikeglx_bin, output_dir, cWaves_path):
+
+    """ Mean waveforms (num_clusters x num_samples x num_channels) and spike counts from C_Waves """
     
     print('Calculating mean waveforms for aligh_spike_times using C_waves.')
 
@@ -393,43 +851,6 @@ def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, cWa
     
     mean_waveforms = np.load(mean_waveform_fullpath)
     snr_array = np.load(snr_fullpath)
-    (nClu, nChan, nt) = mean_waveforms.shape
-    
-    peak_t = 19   #because pre_samples in C_Waves set to 20
-    
-    # Loop over units
-    for i in range(nClu):
-        nSpike = snr_array[i,1]
-        if nSpike > 10:
-            # only try to correct if we some spikes to average
-            curr_wave = mean_waveforms[i,:,:]
-            max_site = np.argmax(np.max(curr_wave,1) - np.min(curr_wave,1))
-            max_site_wave = curr_wave[max_site,:]
-            
-            min_v = abs(np.min(max_site_wave))
-            max_v = abs(np.max(max_site_wave))
-            min_t = np.argmin(max_site_wave)
-            max_t = np.argmax(max_site_wave)
-            
-            # align to min or max?
-            if min_v > 30 and max_v > 30:
-                # set spike to to earlier of the two
-                if min_t <= max_t:               
-                   mean_peak_time = min_t
-                else:
-                   mean_peak_time = max_t
-            else:
-                # only one substantial peak, align to larger
-                if min_v >= max_v:
-                   mean_peak_time = min_t
-                else:
-                    mean_peak_time = max_t
-               
-            deltat = peak_t - mean_peak_time
-            # print('nClu, deltat: ' + repr(i) + ', ' +  repr(deltat) )
-            clu_ind = (spike_clusters == i)
-            spike_times[clu_ind] = spike_times[clu_ind] - deltat
-            
-                
-    
-    return spike_times
\ No newline at end of file
+
+    # C_Waves writes (clusters x channels x samples)
+    return np.transpose(mean_waveforms, (0, 2, 1)), snr_array[:,1]
@@ -9,13 +9,17 @@ import numpy as np
 import pandas as pd
 from scipy.io import loadmat
 
-from ...common.utils import load_kilosort_data
+from ...common.utils import load_kilosort_data, load
 from ...common.utils import getSortResults
 from ...common.utils import getFileVersion
+from ...common.kilosort_dataset import KilosortDataset
+from ...common.raw_recording import RawRecording
 
-from .extract_waveforms import extract_waveforms, writeDataAsNpy
+from .extract_waveforms import extract_waveforms, writeDataAsNpy, get_sparse_channel_map
 from .waveform_metrics import calculate_waveform_metrics
-from .metrics_from_file import metrics_from_file
+from .metrics_from_file import metrics_from_file, metrics_from_avg_waveforms
+from .template_waveforms import calculate_template_waveforms
+from .incremental import versioned_path, find_changed_clusters, write_cluster_subset, copy_unchanged_rows
 
 def calculate_mean_waveforms(args):
 
@@ -23,7 +27,54 @@ def calculate_mean_waveforms(args):
     
     start = time.time()
     
-    if args['mean_waveform_params']['use_C_Waves']:
+    if args['mean_waveform_params']['use_template_reconstruction']:
+
+        print('Estimating mean waveforms from templates.')
+        output_dir = args['directories']['kilosort_output_directory']
+
+        # no raw data is read; mean waveforms are rebuilt from the templates
+        # and amplitudes, and the outputs are tagged as estimates
+        spike_clusters = load(output_dir, 'spike_clusters.npy')
+        spike_templates = load(output_dir, 'spike_templates.npy')
+        amplitudes = load(output_dir, 'amplitudes.npy')
+        templates = load(output_dir, 'templates.npy')[:,args['ephys_params']['template_zero_padding']:,:]
+        w_inv = load(output_dir, 'whitening_mat_inv.npy')
+        channel_map = np.squeeze(load(output_dir, 'channel_map.npy'))
+        channel_pos = load(output_dir, 'channel_positions.npy')
+
+        site_x, site_y = get_site_positions(args['ephys_params']['ap_band_file'], channel_map, channel_pos)
+
+        mean_waveforms, snr_array, clus_table = calculate_template_waveforms(spike_clusters,
+                    spike_templates,
+                    amplitudes,
+                    templates,
+                    w_inv,
+                    channel_map,
+                    args['ephys_params']['bit_volts'],
+                    site_x.size,
+                    args['mean_waveform_params']['samples_per_spike'],
+                    args['mean_waveform_params']['pre_samples'])
+
+        mwf_path = args['mean_waveform_params']['mean_waveforms_file']
+        dest = pathlib.Path(mwf_path).parent
+        np.save(os.path.join(dest, pathlib.Path(mwf_path).stem + '_est.npy'), mean_waveforms)
+        np.save(os.path.join(dest, 'cluster_snr_est.npy'), snr_array)
+
+        metrics = metrics_from_avg_waveforms(mean_waveforms,
+                    snr_array,
+                    clus_table[:,1],
+                    np.arange(clus_table.shape[0]),
+                    channel_map,
+                    args['ephys_params']['sample_rate'],
+                    site_x, site_y,
+                    args['mean_waveform_params'])
+        metrics['waveform_source'] = 'template_estimate'
+
+        clu_version = 0
+        wm_fullpath = args['waveform_metrics']['waveform_metrics_file']
+        metrics.to_csv(wm_fullpath, index=False)
+
+    elif args['mean_waveform_params']['use_C_Waves']:
         
         print('Calculating mean waveforms using C_waves.')
         spikeglx_bin = args['ephys_params']['ap_band_file']
@@ -69,9 +120,33 @@ def calculate_mean_waveforms(args):
         if sc.dtype != 'uint32':
             sc = sc.astype('uint32')
             np.save(clus_lbl_npy,sc)
-            
-        
-        
+
+        # incremental mode: only recompute clusters changed since the last
+        # version; the others are copied forward from the previous outputs
+        wm_base = args['waveform_metrics']['waveform_metrics_file']
+        incremental = args['mean_waveform_params']['incremental']
+        changed = None
+
+        if incremental and clu_version > 0:
+            prev = load_previous_version(output_dir, dest, wm_base, clu_version - 1)
+            if prev is None:
+                print('No complete previous version found, recomputing all clusters.')
+            else:
+                clus_table = np.load(clus_table_npy)
+                changed = find_changed_clusters(prev['labels'], sc, prev['clus_table'], clus_table)
+                if changed is None:
+                    print('Spike set has changed, recomputing all clusters.')
+                else:
+                    # IDs removed from the end of the table have no rows
+                    changed = changed[changed < clus_table.shape[0]]
+
+        if changed is not None:
+            print('Recomputing ' + repr(changed.size) + ' changed clusters.')
+            cwaves_table_npy, clus_time_npy, clus_lbl_npy = \
+                write_cluster_subset(output_dir, clus_table, np.load(clus_time_npy), sc, changed)
+        else:
+            cwaves_table_npy = clus_table_npy
+
         # path to the 'runit.bat' executable that calls C_Waves.
         # Essential in linux where C_Waves executable is only callable through runit
         if sys.platform.startswith('win'):
@@ -82,7 +157,7 @@ def calculate_mean_waveforms(args):
             print('unknown system, cannot run C_Waves')
         
         cwaves_cmd = exe_path + ' -spikeglx_bin=' + spikeglx_bin + \
-                                ' -clus_table_npy=' + clus_table_npy + \
+                                ' -clus_table_npy=' + cwaves_table_npy + \
                                 ' -clus_time_npy=' + clus_time_npy + \
                                 ' -clus_lbl_npy=' + clus_lbl_npy + \
                                 ' -dest=' + dest + \
@@ -94,8 +169,12 @@ def calculate_mean_waveforms(args):
                                 
         print(cwaves_cmd)
         
-        # make the C_Waves call
-        subprocess.Popen(cwaves_cmd,shell='False').wait()
+        # make the C_Waves call; skipped if no clusters have changed
+        run_cwaves = changed is None or np.any(clus_table[changed,0] > 0)
+        if run_cwaves:
+            subprocess.Popen(cwaves_cmd,shell='False').wait()
+        else:
+            print('No clusters have changed, skipping C_Waves.')
         
         # for first version, retain original names
         if clu_version == 0:
@@ -106,9 +185,36 @@ def calculate_mean_waveforms(args):
             # version 0 files are not renamed to maintain compatiblity with
             mean_waveform_fullpath = os.path.join(dest, 'mean_waveforms_' + repr(clu_version) + '.npy')
             snr_fullpath = os.path.join(dest, 'cluster_snr_' + repr(clu_version) + '.npy')
-            os.rename(os.path.join(dest, 'mean_waveforms.npy'), mean_waveform_fullpath)
-            os.rename(os.path.join(dest, 'cluster_snr.npy'), snr_fullpath)
-            
+            if run_cwaves:
+                os.rename(os.path.join(dest, 'mean_waveforms.npy'), mean_waveform_fullpath)
+                os.rename(os.path.join(dest, 'cluster_snr.npy'), snr_fullpath)
+
+        if changed is not None:
+            # fill in unchanged clusters from the previous version
+            num_clusters = clus_table.shape[0]
+            unchanged = np.setdiff1d(np.flatnonzero(clus_table[:,0] > 0), changed)
+
+            if run_cwaves:
+                mean_waveforms = np.load(mean_waveform_fullpath)
+                snr_array = np.load(snr_fullpath)
+            else:
+                mean_waveforms = np.zeros((num_clusters,) + prev['mean_waveforms'].shape[1:],
+                                          dtype=prev['mean_waveforms'].dtype)
+                snr_array = np.zeros((num_clusters,) + prev['snr'].shape[1:],
+                                     dtype=prev['snr'].dtype)
+
+            mean_waveforms = copy_unchanged_rows(mean_waveforms, prev['mean_waveforms'], unchanged)
+            snr_array = copy_unchanged_rows(snr_array, prev['snr'], unchanged)
+            np.save(mean_waveform_fullpath, mean_waveforms)
+            np.save(snr_fullpath, snr_array)
+
+            for subset_file in (cwaves_table_npy, clus_time_npy, clus_lbl_npy):
+                os.remove(subset_file)
+
+        if incremental:
+            # snapshot of the labels, for comparison in the next round
+            np.save(os.path.join(output_dir, 'clus_lbl_' + repr(clu_version) + '.npy'), sc)
+
         
         # C_Waves writes out files of the waveforms and snr
         # call version of calculate_waveform_metrics that will use these files
@@ -123,40 +229,34 @@ def calculate_mean_waveforms(args):
         # read in inverse of whitening matrix
         w_inv = np.load((os.path.join(args['directories']['kilosort_output_directory'], 'whitening_mat_inv.npy')))
         
-        # the channel_pos loaded from the phy output omits any sites excluded
-        # as noise by the kilosort_helper module, or excluded fow low spike rete
-        # by kilosort itself. The waveform metrics are calculated on ALL sites
-        # based on the mean waveforms calculated for each unit; therefore
-        # we need the site locations for all sites.
-        # load the channel map associated with this kilosort run; in kilosort_helper
-        # a copy is made next to the data file
-        input_file = args['ephys_params']['ap_band_file']
-        dat_dir, dat_fname = os.path.split(input_file)
-        dat_name, dat_ext = os.path.splitext(dat_fname)
-        chanMapMat = os.path.join(dat_dir, (dat_name +'_chanMap.mat'))
-        site_x = np.squeeze(loadmat(chanMapMat)['xcoords'])
-        site_y = np.squeeze(loadmat(chanMapMat)['ycoords'])
-        
-                
+        site_x, site_y = get_site_positions(args['ephys_params']['ap_band_file'], channel_map, channel_pos)
 
-                
-        metrics = metrics_from_file(mean_waveform_fullpath, snr_fullpath, clus_table_npy, \
-                    spike_times, \
-                    spike_clusters, \
-                    templates, \
-                    channel_map, \
-                    args['ephys_params']['bit_volts'], \
-                    args['ephys_params']['sample_rate'], \
-                    args['ephys_params']['vertical_site_spacing'], \
-                    w_inv, \
-                    site_x, site_y, \
-                    args['mean_waveform_params'])
+        if changed is None:
+            metrics = metrics_from_file(mean_waveform_fullpath, snr_fullpath, clus_table_npy, \
+                        spike_times, \
+                        spike_clusters, \
+                        templates, \
+                        channel_map, \
+                        args['ephys_params']['bit_volts'], \
+                        args['ephys_params']['sample_rate'], \
+                        args['ephys_params']['vertical_site_spacing'], \
+                        w_inv, \
+                        site_x, site_y, \
+                        args['mean_waveform_params'])
+        else:
+            new_metrics = metrics_from_avg_waveforms(mean_waveforms,
+                        snr_array,
+                        clus_table[:,1],
+                        changed,
+                        channel_map,
+                        args['ephys_params']['sample_rate'],
+                        site_x, site_y,
+                        args['mean_waveform_params'])
+            prev_metrics = prev['metrics'][prev['metrics']['cluster_id'].isin(unchanged)]
+            metrics = pd.concat([prev_metrics, new_metrics]).sort_values('cluster_id', kind='stable')
         
-        wm_fullpath = (args['waveform_metrics']['waveform_metrics_file'])
-
-        if clu_version > 0:
-           # save new metrics as _version number
-           wm_fullpath = os.path.join(pathlib.Path(wm_fullpath).parent, pathlib.Path(wm_fullpath).stem + '_' + repr(clu_version) + '.csv')
+        # save new metrics as _version number
+        wm_fullpath = versioned_path(wm_base, clu_version)
     
         metrics.to_csv(wm_fullpath, index=False)
             
@@ -166,8 +266,8 @@ def calculate_mean_waveforms(args):
         print('Calculating mean waveforms using python.')
         print("Loading data...")
     
-        rawData = np.memmap(args['ephys_params']['ap_band_file'], dtype='int16', mode='r')
-        data = np.reshape(rawData, (int(rawData.size/args['ephys_params']['num_channels']), args['ephys_params']['num_channels']))
+        data = RawRecording(args['ephys_params']['ap_band_file'],
+                            num_channels = args['ephys_params']['num_channels']).data
     
         spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
         channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
@@ -175,6 +275,15 @@ def calculate_mean_waveforms(args):
                     args['ephys_params']['sample_rate'], \
                     convert_to_seconds = False)
     
+        ks = KilosortDataset(args['directories']['kilosort_output_directory'])
+        peak_channels = ks.cluster_peak_channels
+
+        if args['mean_waveform_params']['sparse_channels']:
+            unit_channels = get_sparse_channel_map(channel_map, channel_pos, peak_channels, 
+                                                   args['mean_waveform_params']['sparse_radius_um'])
+        else:
+            unit_channels = None
+
         print("Calculating mean waveforms...")
     
         waveforms, spike_counts, coords, labels, metrics = extract_waveforms(data, spike_times, \
@@ -184,10 +293,18 @@ def calculate_mean_waveforms(args):
                     args['ephys_params']['bit_volts'], \
                     args['ephys_params']['sample_rate'], \
                     args['ephys_params']['vertical_site_spacing'], \
-                    args['mean_waveform_params'])
+                    args['mean_waveform_params'],
+                    unit_channels = unit_channels,
+                    channel_pos = channel_pos,
+                    store_file = args['mean_waveform_params'].get('waveform_store_file'),
+                    peak_channels = peak_channels,
+                    cluster_spikes = ks.cluster_spikes)
     
-        writeDataAsNpy(waveforms, args['mean_waveform_params']['mean_waveforms_file'])
-        metrics.to_csv(args['waveform_metrics']['waveform_metrics_file'], index=False)
+        writeDataAsNpy(waveforms, args['mean_waveform_params']['mean_waveforms_file'], unit_channels)
+
+        clu_version = 0
+        wm_fullpath = args['waveform_metrics']['waveform_metrics_file']
+        metrics.to_csv(wm_fullpath, index=False)
 
 
     # if the cluster metrics have already been run, merge the waveform metrics into that file
@@ -212,6 +329,61 @@ def calculate_mean_waveforms(args):
     return {"execution_time" : execution_time} # output manifest
 
 
+def load_previous_version(output_dir, dest, wm_path, version):
+
+    # load the outputs of an earlier C_Waves run for incremental updates;
+    # returns None if any of them is missing
+    if version == 0:
+        # version 0 waveforms are renamed to _0 when version 1 is created
+        mwf_path = os.path.join(dest, 'mean_waveforms_0.npy')
+        snr_path = os.path.join(dest, 'cluster_snr_0.npy')
+    else:
+        mwf_path = os.path.join(dest, 'mean_waveforms_' + repr(version) + '.npy')
+        snr_path = os.path.join(dest, 'cluster_snr_' + repr(version) + '.npy')
+
+    paths = {'labels' : os.path.join(output_dir, 'clus_lbl_' + repr(version) + '.npy'),
+             'clus_table' : versioned_path(os.path.join(output_dir, 'clus_Table.npy'), version),
+             'mean_waveforms' : mwf_path,
+             'snr' : snr_path,
+             'metrics' : versioned_path(wm_path, version)}
+
+    if not all(os.path.exists(p) for p in paths.values()):
+        return None
+
+    prev = {key : np.load(path) for key, path in paths.items() if key != 'metrics'}
+    prev['metrics'] = pd.read_csv(paths['metrics'])
+
+    return prev
+
+
+def get_site_positions(ap_band_file, channel_map, channel_pos):
+
+    # the channel_pos loaded from the phy output omits any sites excluded
+    # as noise by the kilosort_helper module, or excluded fow low spike rete
+    # by kilosort itself. The waveform metrics are calculated on ALL sites
+    # based on the mean waveforms calculated for each unit; therefore
+    # we need the site locations for all sites.
+    # load the channel map associated with this kilosort run; in kilosort_helper
+    # a copy is made next to the data file
+    dat_dir, dat_fname = os.path.split(ap_band_file)
+    dat_name, dat_ext = os.path.splitext(dat_fname)
+    chanMapMat = os.path.join(dat_dir, (dat_name +'_chanMap.mat'))
+
+    if os.path.exists(chanMapMat):
+        site_x = np.squeeze(loadmat(chanMapMat)['xcoords'])
+        site_y = np.squeeze(loadmat(chanMapMat)['ycoords'])
+    else:
+        # no copy of the channel map; only the sorted sites have positions
+        print('No channel map next to the data file, using channel_positions.npy')
+        site_x = np.full((np.max(channel_map) + 1,), np.nan)
+        site_y = np.full((np.max(channel_map) + 1,), np.nan)
+        channel_map = np.squeeze(channel_map)
+        site_x[channel_map] = channel_pos[:,0]
+        site_y[channel_map] = channel_pos[:,1]
+
+    return site_x, site_y
+
+
 def main():
 
     from ._schemas import InputParameters, OutputParameters
@@ -13,8 +13,15 @@ class MeanWaveformParams(DefaultSchema):
     site_range = Int(require=False, default=16, help='Number of sites to use for 2D waveform metrics')
     cWaves_path = InputDir(require=False, help='directory containing the TPrime executable.')
     use_C_Waves = Bool(require=False, default=False, help='Use faster C routine to calculate mean waveforms')
+    use_template_reconstruction = Bool(require=False, default=False, help='Estimate mean waveforms from templates and amplitudes, without reading raw data')
+    incremental = Bool(require=False, default=False, help='C_Waves only: after curation, recompute only clusters whose spikes have changed since the previous version')
     snr_radius = Int(require=False, default=8, help='disk radius (chans) about pk-chan for snr calculation in C_waves')
     snr_radius_um = Int(require=False, default=8, help='disk radius (um) about pk-chan for snr calculation in C_waves')
+    sparse_channels = Bool(require=False, default=False, help='Python extraction only: extract channels within sparse_radius_um of the peak channel, stored as float32')
+    sparse_radius_um = Float(require=False, default=160.0, help='disk radius (um) about pk-chan for radius-limited extraction')
+    num_workers = Int(require=False, default=1, help='Python extraction only: number of worker processes; 1 = serial')
+    io_concurrency = Int(require=False, default=0, help='Python extraction only: max workers reading raw data at once, 0 = no limit. Lower for network filesystems')
+    waveform_store_file = String(require=False, help='Python extraction only: path to save the full (cluster, epoch, mean/std, channel, time) array, chunked by cluster and compressed; .zarr for zarr, otherwise netCDF4/HDF5')
     mean_waveforms_file = String(required=True, help='Path to mean waveforms file (.npy)')
 
 
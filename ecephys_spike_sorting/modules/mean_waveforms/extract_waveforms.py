@@ -6,10 +6,16 @@ import xarray as xr
 import pandas as pd
 
 import warnings
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
 
-from .waveform_metrics import calculate_waveform_metrics
+
+from .waveform_metrics import calculate_waveform_metrics, calculate_sparse_waveform_metrics
+from .waveform_store import WaveformStore
 from ...common.epoch import Epoch
 from ...common.utils import printProgressBar
+from ...common.probe_geometry import ProbeGeometry
 
 def extract_waveforms(raw_data, 
                       spike_times, 
@@ -20,7 +26,12 @@ def extract_waveforms(raw_data,
                       sample_rate, 
                       site_spacing, 
                       params, 
-                      epochs=None):
+                      epochs=None,
+                      unit_channels=None,
+                      channel_pos=None,
+                      store_file=None,
+                      peak_channels=None,
+                      cluster_spikes=None):
     
     """
     Calculate mean waveforms for sorted units.
@@ -34,6 +45,21 @@ def extract_waveforms(raw_data,
     cluster_quality : 'noise' or 'good'
     sample_rate : Hz
     site_spacing : m
+    unit_channels : (optional) cluster IDs x local channels map from 
+        get_sparse_channel_map; if given, only these channels are extracted
+        for each unit, and the waveforms are stored as float32
+    channel_pos : (optional) X and Z coordinates for each channel in 
+        channel_map, in um; required with unit_channels
+    store_file : (optional) path to a chunked, compressed WaveformStore;
+        if given, the full cube is streamed to it one unit at a time, and
+        only the last epoch is returned in mean_waveforms
+    peak_channels : (optional) peak channel for each cluster ID, e.g.
+        KilosortDataset.cluster_peak_channels; if not given, the peak
+        channel of the template with the same ID is used
+    cluster_spikes : (optional) function returning the indices of all spikes
+        in a cluster ID, e.g. KilosortDataset.cluster_spikes; if given, each
+        unit's spikes are read from the spike index instead of scanning
+        spike_clusters once per unit
 
     Outputs:
     -------
@@ -41,7 +67,7 @@ def extract_waveforms(raw_data,
      - 1 : clusterID
      - 2 : epochs
      - 3 : mean (0) or std (1)
-     - 4 : channels
+     - 4 : channels (local channels, if unit_channels is given)
      - 5 : samples
     spike_count : numpy array with dims :
      - 1 : clusterID
@@ -56,6 +82,10 @@ def extract_waveforms(raw_data,
     pre_samples : number of samples prior to peak
     num_epochs : number of epochs to calculate mean waveforms
     spikes_per_epoch : max number of spikes to generate average for epoch
+    num_workers : (optional) number of processes; if > 1 and raw_data is a
+        memmap, clusters are partitioned across a worker pool
+    io_concurrency : (optional) max number of workers reading raw data at
+        once, 0 = no limit
 
     """
 
@@ -65,14 +95,9 @@ def extract_waveforms(raw_data,
     pre_samples = params['pre_samples']
     num_epochs = params['num_epochs']
     spikes_per_epoch = params['spikes_per_epoch']
-    upsampling_factor = params['upsampling_factor']
-    spread_threshold = params['spread_threshold']
-    site_range = params['site_range']
 
     # #############################################
 
-    metrics = pd.DataFrame()
-
     if epochs is None:
         epochs = [Epoch('complete_session', 0, np.inf)]
 
@@ -80,84 +105,476 @@ def extract_waveforms(raw_data,
     total_units = len(cluster_ids)
     total_epochs = len(epochs)
 
-    # allocate array for waveforms, datatype = default, double
-    mean_waveforms = np.zeros(
-        (total_units, total_epochs, 2, raw_data.shape[1], samples_per_spike))
-    spike_count = np.zeros((total_units, total_epochs + 1), dtype = 'int')
+    channel_map = np.squeeze(channel_map)
+    if peak_channels is None:
+        peak_channels = np.squeeze(channel_map[np.argmax(np.max(templates,1) - np.min(templates,1),1)])
 
-    peak_channels = np.squeeze(channel_map[np.argmax(np.max(templates,1) - np.min(templates,1),1)])
+    if unit_channels is None:
+        # allocate array for waveforms, datatype = default, double
+        total_channels = raw_data.shape[1]
+        dtype = 'float64'
+        site_pos = None
+    else:
+        # radius-limited extraction: look up site positions by data channel
+        total_channels = unit_channels.shape[1]
+        dtype = 'float32'
+        site_pos = np.full((raw_data.shape[1], 2), np.nan)
+        site_pos[channel_map, :] = channel_pos
 
-    for epoch_idx, epoch in enumerate(epochs):
+    shape = (total_units, total_epochs, 2, total_channels, samples_per_spike)
+
+    dimCoords, dimLabels = generateDimLabels(
+        cluster_ids, total_epochs, pre_samples, samples_per_spike, total_channels, sample_rate)
 
-        print("Epoch: " + epoch.name)
+    if unit_channels is not None:
+        dimLabels[3] = 'local_channel'
 
-        in_epoch = ((spike_times / sample_rate) > epoch.start_time) * ((spike_times / sample_rate) < epoch.end_time)
+    if store_file is not None:
+        store = WaveformStore(store_file, dimCoords, dimLabels, dtype)
+    else:
+        store = None
 
-        spike_times_in_epoch = spike_times[in_epoch]
+    # spike times to extract for each (epoch, cluster); drawn here so the
+    # serial and parallel paths read the same spikes
+    tasks = []
 
-        for cluster_idx, cluster_id in enumerate(cluster_ids):
+    for epoch_idx, epoch in enumerate(epochs):
 
-            printProgressBar(cluster_idx+1, total_units)
+        if cluster_spikes is None:
+            in_epoch = ((spike_times / sample_rate) > epoch.start_time) * ((spike_times / sample_rate) < epoch.end_time)
 
-            in_cluster = (spike_clusters[in_epoch] == cluster_id)
+            spike_times_in_epoch = spike_times[in_epoch]
+            spike_clusters_in_epoch = spike_clusters[in_epoch]
 
-            if np.sum(in_cluster) > 0:
+        for cluster_idx, cluster_id in enumerate(cluster_ids):
 
-                times_for_cluster = spike_times_in_epoch[in_cluster]
+            if cluster_spikes is None:
+                times_for_cluster = spike_times_in_epoch[spike_clusters_in_epoch == cluster_id]
+            else:
+                # file order, as in the scan above, so the same spikes are drawn
+                times_for_cluster = spike_times[np.sort(cluster_spikes(cluster_id))]
+                times_for_cluster = times_for_cluster[((times_for_cluster / sample_rate) > epoch.start_time) *
+                                                      ((times_for_cluster / sample_rate) < epoch.end_time)]
 
-                waveforms = np.empty(
-                    (spikes_per_epoch, raw_data.shape[1], samples_per_spike))
-                waveforms[:] = np.nan
+            if times_for_cluster.size > 0:
 
                 np.random.shuffle(times_for_cluster)
 
-                total_waveforms = np.min(
-                    [times_for_cluster.size, spikes_per_epoch])
-
-                for wv_idx, peak_time in enumerate(times_for_cluster[:total_waveforms]):
-                    start = int(peak_time-pre_samples)
-                    end = start + samples_per_spike
-                    rawWaveform = raw_data[start:end, :].T
-
-                    # in case spike was at start or end of dataset
-                    if rawWaveform.shape[1] == samples_per_spike:
-                        waveforms[wv_idx, :, :] = rawWaveform * bit_volts
-
-                # concatenate to existing dataframe
-                metrics = pd.concat([metrics, calculate_waveform_metrics(waveforms[:total_waveforms, :, :],
-                                                                         cluster_id, 
-                                                                         peak_channels[cluster_idx], 
-                                                                         channel_map,
-                                                                         sample_rate, 
-                                                                         upsampling_factor,
-                                                                         spread_threshold,
-                                                                         site_range,
-                                                                         site_spacing,
-                                                                         epoch.name
-                                                                         )])
-
-                with warnings.catch_warnings():
-
-                    warnings.simplefilter("ignore", category=RuntimeWarning)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   0, :, :] = np.nanmean(waveforms, 0)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   1, :, :] = np.nanstd(waveforms, 0)
-
-                    # remove offset
-                    for channel in range(0, mean_waveforms.shape[3]):
-                        mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] = \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] - \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, 0]
-
-                spike_count[cluster_idx, epoch_idx] = total_waveforms
+                tasks.append((cluster_idx, epoch_idx, epoch.name,
+                              times_for_cluster[:spikes_per_epoch]))
 
-    dimCoords, dimLabels = generateDimLabels(
-        cluster_ids, total_epochs, pre_samples, samples_per_spike, raw_data.shape[1], sample_rate)
+    if store is not None:
+        # finish each unit before moving to the next
+        tasks.sort(key=lambda task: task[0])
+
+    worker_params = {'channel_map' : channel_map,
+                     'peak_channels' : peak_channels,
+                     'unit_channels' : unit_channels,
+                     'site_pos' : site_pos,
+                     'bit_volts' : bit_volts,
+                     'sample_rate' : sample_rate,
+                     'site_spacing' : site_spacing,
+                     'params' : params}
+
+    num_workers = params.get('num_workers', 1)
+
+    if num_workers > 1 and isinstance(raw_data, np.memmap) and raw_data.filename is not None:
+        mean_waveforms, spike_count, metrics = \
+            extract_waveforms_parallel(raw_data, tasks, shape, dtype, worker_params,
+                                       num_workers, params.get('io_concurrency', 0), store)
+    else:
+        if store is None:
+            mean_waveforms = np.zeros(shape, dtype=dtype)
+        else:
+            mean_waveforms = np.zeros((total_units, 1) + shape[2:], dtype=dtype)
+            unit_waveforms = np.zeros(shape[1:], dtype=dtype)
+
+        spike_count = np.zeros((total_units, total_epochs + 1), dtype = 'int')
+        metrics = []
+
+        for task_idx, task in enumerate(tasks):
+
+            printProgressBar(task_idx+1, len(tasks))
+
+            cluster_idx, epoch_idx = task[:2]
+
+            mean_std, total_waveforms, unit_metrics = \
+                extract_cluster_waveforms(raw_data, *task, **worker_params)
+
+            nchan = mean_std.shape[1]
+
+            if store is None:
+                mean_waveforms[cluster_idx, epoch_idx, :, :nchan, :] = mean_std
+            else:
+                unit_waveforms[epoch_idx, :, :nchan, :] = mean_std
+
+                if task_idx + 1 == len(tasks) or tasks[task_idx + 1][0] != cluster_idx:
+                    store.write_unit(cluster_idx, unit_waveforms)
+                    mean_waveforms[cluster_idx, 0] = unit_waveforms[-1]
+                    unit_waveforms[:] = 0
+
+            spike_count[cluster_idx, epoch_idx] = total_waveforms
+            metrics.append((cluster_idx, epoch_idx, unit_metrics))
+
+        metrics = concat_metrics(metrics)
+
+    if store is not None:
+        store.close(spike_count)
 
     return mean_waveforms, spike_count, dimCoords, dimLabels, metrics
 
 
+def extract_cluster_waveforms(raw_data,
+                              cluster_idx,
+                              epoch_idx,
+                              epoch_name,
+                              times_for_cluster,
+                              channel_map,
+                              peak_channels,
+                              unit_channels,
+                              site_pos,
+                              bit_volts,
+                              sample_rate,
+                              site_spacing,
+                              params,
+                              io_lock=None):
+
+    """
+    Extracts the waveforms of one cluster in one epoch, and computes their
+    mean, standard deviation and waveform metrics
+
+    Inputs:
+    -------
+    raw_data : continuous data as numpy array (samples x channels)
+    cluster_idx : index of the cluster (equal to the cluster ID)
+    epoch_idx : index of the epoch
+    epoch_name : name of the epoch, for the metrics table
+    times_for_cluster : spike times to extract (in samples)
+    io_lock : (optional) semaphore held while reading from raw_data
+
+    Remaining inputs as in extract_waveforms.
+
+    Outputs:
+    -------
+    mean_std : numpy array (2 x channels x samples) with offset-corrected mean
+        and standard deviation
+    total_waveforms : number of waveforms extracted
+    unit_metrics : DataFrame with waveform metrics
+
+    """
+
+    samples_per_spike = params['samples_per_spike']
+    pre_samples = params['pre_samples']
+
+    if unit_channels is None:
+        channels = slice(None)
+        waveforms = np.empty(
+            (len(times_for_cluster), raw_data.shape[1], samples_per_spike))
+    else:
+        channels = unit_channels[cluster_idx]
+        channels = channels[channels >= 0]
+        waveforms = np.empty(
+            (len(times_for_cluster), channels.size, samples_per_spike), dtype='float32')
+    waveforms[:] = np.nan
+
+    total_waveforms = len(times_for_cluster)
+
+    if io_lock is not None:
+        io_lock.acquire()
+
+    try:
+        for wv_idx, peak_time in enumerate(times_for_cluster):
+            start = int(peak_time-pre_samples)
+            end = start + samples_per_spike
+            rawWaveform = raw_data[start:end, channels].T
+
+            # in case spike was at start or end of dataset
+            if rawWaveform.shape[1] == samples_per_spike:
+                waveforms[wv_idx, :, :] = rawWaveform * bit_volts
+    finally:
+        if io_lock is not None:
+            io_lock.release()
+
+    if unit_channels is None:
+        unit_metrics = calculate_waveform_metrics(waveforms,
+                                                  cluster_idx,
+                                                  peak_channels[cluster_idx],
+                                                  channel_map,
+                                                  sample_rate,
+                                                  params['upsampling_factor'],
+                                                  params['spread_threshold'],
+                                                  params['site_range'],
+                                                  site_spacing,
+                                                  epoch_name
+                                                  )
+    else:
+        unit_metrics = calculate_sparse_waveform_metrics(waveforms,
+                                                         cluster_idx,
+                                                         channels,
+                                                         site_pos[channels, 0],
+                                                         site_pos[channels, 1],
+                                                         sample_rate,
+                                                         params['upsampling_factor'],
+                                                         params['spread_threshold'],
+                                                         params['site_range'],
+                                                         epoch_name
+                                                         )
+
+    mean_std = np.zeros((2, waveforms.shape[1], samples_per_spike), dtype=waveforms.dtype)
+
+    with warnings.catch_warnings():
+
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        mean_std[0] = np.nanmean(waveforms, 0)
+        mean_std[1] = np.nanstd(waveforms, 0)
+
+        # remove offset
+        mean_std[0] = mean_std[0] - mean_std[0, :, :1]
+
+    return mean_std, total_waveforms, unit_metrics
+
+
+# per-process state for the parallel extraction workers, set by
+# init_extraction_worker
+_worker_state = {}
+
+
+def init_extraction_worker(data_file, data_dtype, data_shape, data_offset,
+                           unit_shape, dtype, worker_params, io_lock):
+
+    """ Opens the raw data memmap in a worker """
+
+    _worker_state['raw_data'] = np.memmap(data_file, dtype=data_dtype, mode='r',
+                                          offset=data_offset, shape=data_shape)
+    _worker_state['unit_shape'] = unit_shape
+    _worker_state['dtype'] = dtype
+    _worker_state['worker_params'] = worker_params
+    _worker_state['io_lock'] = io_lock
+
+
+def extraction_worker(batch):
+
+    """
+    Extracts a batch of (cluster, epoch) tasks in a worker process
+
+    batch is (shm_name, units, tasks). Mean waveforms are written straight
+    into the batch's shared buffer (units x epochs x 2 x channels x
+    samples, rows in the order of units); only the spike counts and metrics
+    are returned to the parent.
+    """
+
+    shm_name, units, tasks = batch
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    batch_waveforms = None
+
+    try:
+        batch_waveforms = np.ndarray((len(units),) + _worker_state['unit_shape'],
+                                     dtype=_worker_state['dtype'], buffer=shm.buf)
+        batch_waveforms[:] = 0
+
+        results = []
+
+        for task in tasks:
+
+            cluster_idx, epoch_idx = task[:2]
+
+            mean_std, total_waveforms, unit_metrics = \
+                extract_cluster_waveforms(_worker_state['raw_data'], *task,
+                                          io_lock=_worker_state['io_lock'],
+                                          **_worker_state['worker_params'])
+
+            unit_idx = np.searchsorted(units, cluster_idx)
+            batch_waveforms[unit_idx, epoch_idx, :, :mean_std.shape[1], :] = mean_std
+
+            results.append((cluster_idx, epoch_idx, total_waveforms, unit_metrics))
+
+    finally:
+        batch_waveforms = None
+        shm.close()
+
+    return results
+
+
+def concat_metrics(metrics):
+
+    """ Concatenates (cluster_idx, epoch_idx, DataFrame) in epoch, cluster order """
+
+    metrics.sort(key=lambda m: (m[1], m[0]))
+
+    if len(metrics) > 0:
+        return pd.concat([m[2] for m in metrics])
+    else:
+        return pd.DataFrame()
+
+
+def extract_waveforms_parallel(raw_data, tasks, shape, dtype, worker_params,
+                               num_workers, io_concurrency=0, store=None):
+
+    """
+    Runs extract_cluster_waveforms over a pool of worker processes
+
+    Each worker opens its own read-only memmap of the file behind raw_data.
+    Every batch of units gets its own shared buffer, so waveform buffers
+    are never pickled; the parent copies a finished batch into the output
+    (and the store) and releases its buffer. At most 2 x num_workers
+    batches are in flight, so with a store the full cube is never held in
+    memory.
+
+    Inputs:
+    -------
+    raw_data : numpy.memmap (samples x channels)
+    tasks : list of (cluster_idx, epoch_idx, epoch_name, spike times)
+    shape : shape of the full mean_waveforms cube
+    dtype : dtype of the mean_waveforms output
+    worker_params : keyword arguments for extract_cluster_waveforms
+    num_workers : number of worker processes
+    io_concurrency : max number of workers reading raw data at once
+        (0 = no limit)
+    store : (optional) WaveformStore; each unit is written to it as soon
+        as its batch finishes, and only the last epoch is returned
+
+    Outputs:
+    -------
+    mean_waveforms, spike_count, metrics : as in extract_waveforms
+
+    """
+
+    ctx = multiprocessing.get_context()
+
+    io_lock = ctx.BoundedSemaphore(io_concurrency) if io_concurrency > 0 else None
+
+    # several small batches per worker to balance the load; all epochs of a
+    # unit go to the same batch, so it is complete when the batch returns
+    num_batches = max(1, min(shape[0], num_workers * 4))
+    batches = [[] for i in range(num_batches)]
+    for task in tasks:
+        batches[task[0] % num_batches].append(task)
+    batches = [batch for batch in batches if len(batch) > 0]
+
+    if store is None:
+        mean_waveforms = np.zeros(shape, dtype=dtype)
+    else:
+        mean_waveforms = np.zeros((shape[0], 1) + shape[2:], dtype=dtype)
+
+    spike_count = np.zeros((shape[0], shape[1] + 1), dtype = 'int')
+    metrics = []
+
+    unit_size = int(np.prod(shape[1:])) * np.dtype(dtype).itemsize
+
+    # finished batches are reported through this queue by the pool callbacks
+    finished = queue.Queue()
+    buffers = {}
+
+    initargs = (raw_data.filename, raw_data.dtype, raw_data.shape, raw_data.offset,
+                shape[1:], dtype, worker_params, io_lock)
+
+    try:
+        with ctx.Pool(num_workers, initializer=init_extraction_worker, initargs=initargs) as pool:
+
+            def submit(batch_idx):
+                units = np.unique([task[0] for task in batches[batch_idx]])
+                shm = shared_memory.SharedMemory(create=True, size=max(1, units.size * unit_size))
+                buffers[batch_idx] = (shm, units)
+                pool.apply_async(extraction_worker, ((shm.name, units, batches[batch_idx]),),
+                                 callback=lambda results: finished.put((batch_idx, results)),
+                                 error_callback=lambda error: finished.put((None, error)))
+
+            next_batch = min(len(batches), 2 * num_workers)
+            for batch_idx in range(next_batch):
+                submit(batch_idx)
+
+            for done_idx in range(len(batches)):
+
+                batch_idx, results = finished.get()
+
+                if batch_idx is None:
+                    raise results
+
+                printProgressBar(done_idx+1, len(batches))
+
+                shm, units = buffers.pop(batch_idx)
+                batch_waveforms = None
+
+                try:
+                    batch_waveforms = np.ndarray((units.size,) + shape[1:], dtype=dtype, buffer=shm.buf)
+
+                    if store is None:
+                        mean_waveforms[units] = batch_waveforms
+                    else:
+                        for unit_idx, cluster_idx in enumerate(units):
+                            store.write_unit(cluster_idx, batch_waveforms[unit_idx])
+                        mean_waveforms[units, 0] = batch_waveforms[:, -1]
+
+                finally:
+                    # the view must be released before the shared memory is closed
+                    batch_waveforms = None
+                    shm.close()
+                    shm.unlink()
+
+                for cluster_idx, epoch_idx, total_waveforms, unit_metrics in results:
+                    spike_count[cluster_idx, epoch_idx] = total_waveforms
+                    metrics.append((cluster_idx, epoch_idx, unit_metrics))
+
+                if next_batch < len(batches):
+                    submit(next_batch)
+                    next_batch += 1
+
+    finally:
+        # buffers of batches still in flight after an error
+        for shm, units in buffers.values():
+            shm.close()
+            shm.unlink()
+
+    return mean_waveforms, spike_count, concat_metrics(metrics)
+
+
+def get_sparse_channel_map(channel_map, channel_pos, peak_channels, radius_um):
+
+    """
+    Finds the neighbourhood of data channels to extract for each cluster
+
+    Sites within radius_um of the cluster's peak site are listed in order
+    of distance, so local channel 0 is always the peak channel. Rows are
+    padded with -1 up to the largest neighbourhood.
+
+    Inputs:
+    -------
+    channel_map : numpy.ndarray (num_channels x 0)
+        Data channel for each template channel
+    channel_pos : numpy.ndarray (num_channels x 2)
+        X and Z coordinates for each template channel, in um
+    peak_channels : numpy.ndarray (num_clusters x 0)
+        Peak data channel for each cluster ID, 0 to max(spike_clusters),
+        e.g. KilosortDataset.cluster_peak_channels (cluster IDs differ from
+        template IDs after merges and splits in phy)
+    radius_um : float
+        Radius around the peak site to extract
+
+    Outputs:
+    --------
+    unit_channels : numpy.ndarray (num_clusters x max local channels), int32
+        Data channel for each (cluster ID, local channel); -1 for padding
+
+    """
+
+    channel_map = np.squeeze(channel_map)
+
+    # template channel (row of channel_pos) of each data channel
+    template_channel = np.full((np.max(channel_map) + 1,), -1, dtype = 'int64')
+    template_channel[channel_map] = np.arange(channel_map.size)
+    peak_chan_idx = template_channel[np.asarray(peak_channels, dtype = 'int64')]
+
+    dist = ProbeGeometry(channel_pos).distances[peak_chan_idx,:]
+    order = np.argsort(dist, axis=1, kind='stable')
+    in_radius = np.take_along_axis(dist, order, 1) <= radius_um
+
+    max_local = np.max(np.sum(in_radius, 1))
+    unit_channels = np.where(in_radius, channel_map[order], -1)
+
+    return unit_channels[:, :max_local].astype('int32')
+
+
 def generateDimLabels(good_clusters, num_epochs, pre_samples, total_samples, num_channels, sample_rate):
     """ Generate dimension labels and coordinates for the xarray """
 
@@ -202,9 +619,17 @@ def writeDataAsXarray(mean_waveforms, spike_count, dimCoords, dimLabels, output_
     ds.to_netcdf(output_file)
 
 
-def writeDataAsNpy(waveforms, output_file):
-    """ Saves mean waveforms as xarray """
+def writeDataAsNpy(waveforms, output_file, unit_channels=None):
+    """ Saves mean waveforms as xarray 
+
+    For radius-limited waveforms, the (unit, local channel) -> data channel
+    map is saved alongside as <output_file>_channels.npy
+    """
 
     mean_waveforms = waveforms[:, -1, 0, :, :]  # extract overall mean
 
     np.save(output_file, mean_waveforms)
+
+    if unit_channels is not None:
+        base, ext = os.path.splitext(output_file)
+        np.save(base + '_channels' + ext, unit_channels)
@@ -0,0 +1,116 @@
+import numpy as np
+import os
+import pathlib
+
+
+def versioned_path(base_path, version):
+
+    """
+    Path of a versioned output file, following getFileVersion:
+    version 0 is the base path, later versions add _version to the stem
+    """
+
+    if version == 0:
+        return base_path
+    else:
+        base = pathlib.Path(base_path)
+        return os.path.join(base.parent, base.stem + '_' + repr(version) + base.suffix)
+
+
+def find_changed_clusters(prev_labels, labels, prev_clus_table, clus_table):
+
+    """
+    Finds the cluster IDs whose mean waveforms must be recomputed after a
+    round of curation in phy
+
+    A cluster is unchanged if it has exactly the same spikes as in the
+    previous version, and the same clus_Table row (spike count and peak
+    channel). Merges, splits and reassigned spikes mark every cluster ID
+    involved, including the IDs that no longer exist.
+
+    Inputs:
+    -------
+    prev_labels : numpy.ndarray (num_spikes x 0)
+        spike_clusters from the previous version
+    labels : numpy.ndarray (num_spikes x 0)
+        current spike_clusters
+    prev_clus_table : numpy.ndarray (num_clusters x 2)
+        clus_Table from the previous version
+    clus_table : numpy.ndarray (num_clusters x 2)
+        current clus_Table
+
+    Outputs:
+    --------
+    changed : numpy.ndarray
+        Sorted cluster IDs to recompute, or None if the spike sets differ
+        (e.g. postprocessing was rerun) and everything must be recomputed
+
+    """
+
+    prev_labels = np.squeeze(prev_labels).astype('int64')
+    labels = np.squeeze(labels).astype('int64')
+
+    if prev_labels.shape != labels.shape:
+        return None
+
+    diff = prev_labels != labels
+    changed = np.union1d(prev_labels[diff], labels[diff])
+
+    # clusters whose table rows differ, and clusters beyond the old table
+    num_common = min(prev_clus_table.shape[0], clus_table.shape[0])
+    row_diff = np.flatnonzero(np.any(prev_clus_table[:num_common,:] != clus_table[:num_common,:], 1))
+    new_rows = num_common + np.flatnonzero(clus_table[num_common:,0] > 0)
+
+    return np.union1d(changed, np.concatenate((row_diff, new_rows)))
+
+
+def write_cluster_subset(output_dir, clus_table, spike_times, spike_clusters, cluster_ids):
+
+    """
+    Writes C_Waves inputs restricted to a subset of clusters
+
+    The clus_Table keeps its full size, so C_Waves output rows are still
+    indexed by cluster ID; the counts of the other clusters are set to zero
+    and their spikes are left out.
+
+    Inputs:
+    -------
+    output_dir : directory for the subset files
+    clus_table : numpy.ndarray (num_clusters x 2)
+    spike_times : numpy.ndarray (num_spikes x 0)
+    spike_clusters : numpy.ndarray (num_spikes x 0), uint32
+    cluster_ids : cluster IDs to keep
+
+    Outputs:
+    --------
+    clus_table_npy, clus_time_npy, clus_lbl_npy : paths to the subset files
+
+    """
+
+    spike_clusters = np.squeeze(spike_clusters)
+    in_subset = np.isin(spike_clusters, cluster_ids)
+
+    subset_table = np.zeros_like(clus_table)
+    subset_table[cluster_ids,:] = clus_table[cluster_ids,:]
+
+    clus_table_npy = os.path.join(output_dir, 'clus_Table_incr.npy')
+    clus_time_npy = os.path.join(output_dir, 'spike_times_incr.npy')
+    clus_lbl_npy = os.path.join(output_dir, 'spike_clusters_incr.npy')
+
+    np.save(clus_table_npy, subset_table)
+    np.save(clus_time_npy, np.squeeze(spike_times)[in_subset])
+    np.save(clus_lbl_npy, spike_clusters[in_subset])
+
+    return clus_table_npy, clus_time_npy, clus_lbl_npy
+
+
+def copy_unchanged_rows(new_array, prev_array, unchanged):
+
+    """
+    Copies the rows of unchanged cluster IDs from the previous version
+    into a newly computed array (mean waveforms or cluster snr)
+    """
+
+    new_array[unchanged,...] = prev_array[unchanged,...]
+
+    return new_array
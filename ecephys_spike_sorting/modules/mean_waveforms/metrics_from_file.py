@@ -69,11 +69,59 @@ def metrics_from_file(mean_waveform_fullpath,
 
     """
 
+    mean_waveforms = np.load(mean_waveform_fullpath)
+    snr_array = np.load(snr_fullpath)
+    clus_table = np.load(clus_fullpath)
+    peak_channels = clus_table[:,1]
+
+    cluster_ids = np.arange(np.max(spike_clusters) + 1)
+
+    return metrics_from_avg_waveforms(mean_waveforms,
+                                      snr_array,
+                                      peak_channels,
+                                      cluster_ids,
+                                      channel_map,
+                                      sample_rate,
+                                      site_x,
+                                      site_y,
+                                      params)
+
+
+def metrics_from_avg_waveforms(mean_waveforms,
+                               snr_array,
+                               peak_channels,
+                               cluster_ids,
+                               channel_map,
+                               sample_rate,
+                               site_x,
+                               site_y,
+                               params):
+
+    """
+    Call waveform_metrics for each cluster, given average waveforms
+
+    Inputs:
+    -------
+    mean_waveforms : numpy.ndarray (num_clusters x num_sites x num_samples)
+        average waveform for each cluster id
+    snr_array : numpy.ndarray (num_clusters x 2)
+        snr and spike count for each cluster id
+    peak_channels : numpy.ndarray (num_clusters x 0)
+        peak channel for each cluster id
+    cluster_ids : cluster ids to calculate
+    channel_map : numpy.ndarray
+        Channels used for spike sorting
+    sample_rate : Hz
+    site_x, site_y: x and y coordinates of all channels, in um
+
+    Outputs:
+    -------
+    metrics : DataFrame with waveform metrics
+
+    """
+
     # #############################################
 
-    samples_per_spike = params['samples_per_spike']
-    pre_samples = params['pre_samples']
-    spikes_per_epoch = params['spikes_per_epoch']
     upsampling_factor = params['upsampling_factor']
     spread_threshold = params['spread_threshold']
     site_range = params['site_range']
@@ -82,41 +130,20 @@ def metrics_from_file(mean_waveform_fullpath,
 
     metrics = pd.DataFrame()
 
-    cluster_ids = np.arange(np.max(spike_clusters) + 1)
     total_units = len(cluster_ids)
-    
-    mean_waveforms = np.load(mean_waveform_fullpath)
-    snr_array = np.load(snr_fullpath)
-    clus_table = np.load(clus_fullpath)
-    peak_channels = clus_table[:,1]
 
-#    channel_map = np.squeeze(channel_map)
-#    
-#    nTemplate = templates.shape[0]
-#    
-#    # initialize peak_channels array
-#    peak_channels = np.zeros([nTemplate,],'uint32')
-#    # for each template (nt x nchan), multiply the the transpose (nchan x nt) by inverse of 
-#    # the whitening matrix (nchan x nchan); get max and min along tthe time axis (1)
-#    # to find the peak channel
-#    for i in np.arange(0,nTemplate):
-#        currT = templates[i,:].T
-#        curr_unwh = np.matmul(w_inv, currT)
-#        currdiff = np.max(curr_unwh,1) - np.min(curr_unwh,1)
-#        peak_channels[i] = channel_map[np.argmax(currdiff)]
-    
     for cluster_idx, cluster_id in enumerate(cluster_ids):
 
         printProgressBar(cluster_idx+1, total_units)
 
-        snr = snr_array[cluster_idx,0]
-        nSpike = snr_array[cluster_idx,1]
+        snr = snr_array[cluster_id,0]
+        nSpike = snr_array[cluster_id,1]
         # if at least one spike, calculate metrics and concatenate to existing dataframe
         if nSpike > 0:
-            metrics = pd.concat([metrics, calculate_waveform_metrics_from_avg(mean_waveforms[cluster_idx,:],
+            metrics = pd.concat([metrics, calculate_waveform_metrics_from_avg(mean_waveforms[cluster_id,:],
                                                                      snr,
                                                                      cluster_id, 
-                                                                     peak_channels[cluster_idx], 
+                                                                     peak_channels[cluster_id], 
                                                                      channel_map,
                                                                      sample_rate, 
                                                                      upsampling_factor,
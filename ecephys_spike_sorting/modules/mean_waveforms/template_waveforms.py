@@ -0,0 +1,127 @@
+import numpy as np
+
+from scipy import sparse
+
+
+def calculate_template_waveforms(spike_clusters,
+                                 spike_templates,
+                                 amplitudes,
+                                 templates,
+                                 w_inv,
+                                 channel_map,
+                                 bit_volts,
+                                 num_sites,
+                                 samples_per_spike,
+                                 pre_samples,
+                                 template_pre_samples = 20):
+
+    """
+    Estimate mean waveforms from Kilosort templates, without reading raw data.
+
+    The mean waveform of each cluster is the amplitude-weighted average of
+    the templates of its spikes, unwhitened with the inverse whitening matrix.
+    Clusters built from several templates by manual curation get a mixture of
+    those templates; as in getSortResults, the peak channel is taken from the
+    most common (majority) template.
+
+    The SNR is estimated in whitened space, where the noise is ~unit variance,
+    as (Vmax - Vmin)/2 on the peak channel. It is a proxy for the C_Waves
+    SNR, not a measurement.
+
+    Inputs:
+    -------
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike
+    spike_templates : numpy.ndarray (num_spikes x 0)
+        Template IDs for each spike
+    amplitudes : numpy.ndarray (num_spikes x 0)
+        Template scaling amplitude for each spike
+    templates : numpy.ndarray (num_templates x num_samples x num_channels)
+        Whitened templates, with zero padding removed
+    w_inv : numpy.ndarray (num_channels x num_channels)
+        Inverse of the whitening matrix
+    channel_map : numpy.ndarray (num_channels x 0)
+        Data channel for each template channel
+    bit_volts : float
+        Scalar to convert data values to uV
+    num_sites : int
+        Number of sites in the output waveforms
+    samples_per_spike : int
+        Number of samples in the output waveforms
+    pre_samples : int
+        Number of samples before the spike time in the output waveforms
+    template_pre_samples : int
+        Number of template samples before the spike time (Kilosort nt0min)
+
+    Outputs:
+    --------
+    mean_waveforms : numpy.ndarray (num_clusters x num_sites x samples_per_spike)
+        Estimated mean waveforms in uV, float32
+    snr_array : numpy.ndarray (num_clusters x 2)
+        Estimated SNR and spike count; same layout as C_Waves cluster_snr.npy
+    clus_table : numpy.ndarray (num_clusters x 2)
+        Spike count and peak channel; same layout as clus_Table.npy
+
+    """
+
+    spike_clusters = np.squeeze(spike_clusters).astype('int64')
+    spike_templates = np.squeeze(spike_templates).astype('int64')
+    amplitudes = np.squeeze(amplitudes)
+    channel_map = np.squeeze(channel_map)
+
+    num_clusters = np.max(spike_clusters) + 1
+    num_templates, num_samples, num_channels = templates.shape
+
+    # spike count and summed amplitude for each (cluster, template) pair
+    pairs, pair_inv = np.unique(spike_clusters * num_templates + spike_templates,
+                                return_inverse = True)
+    pair_counts = np.bincount(pair_inv)
+    pair_amps = np.bincount(pair_inv, weights = amplitudes)
+    pair_cluster = pairs // num_templates
+    pair_template = pairs % num_templates
+
+    spike_counts = np.bincount(spike_clusters, minlength = num_clusters)
+
+    # majority template for each cluster; ties go to the lower template id,
+    # matching np.argmax(np.bincount()) in getSortResults
+    order = np.lexsort((pair_template, -pair_counts, pair_cluster))
+    first_cluster, first_idx = np.unique(pair_cluster[order], return_index = True)
+    majority_template = np.zeros((num_clusters,), dtype = 'int64')
+    majority_template[first_cluster] = pair_template[order[first_idx]]
+
+    # amplitude-weighted mixture of templates for each cluster, whitened space
+    weights = sparse.csr_matrix((pair_amps / spike_counts[pair_cluster],
+                                 (pair_cluster, pair_template)),
+                                shape = (num_clusters, num_templates))
+    whitened = weights.dot(np.reshape(templates, (num_templates, -1)))
+    whitened = np.reshape(whitened, (num_clusters, num_samples, num_channels)).astype('float32')
+
+    unwhitened = np.matmul(whitened, w_inv.astype('float32'))
+
+    # peak channel from the unwhitened majority template
+    maj_temps = np.matmul(templates[majority_template,:,:], w_inv)
+    peak_chan_idx = np.argmax(np.max(maj_temps,1) - np.min(maj_temps,1), 1)
+
+    clus_table = np.zeros((num_clusters, 2), dtype = 'uint32')
+    clus_table[:,0] = spike_counts
+    clus_table[spike_counts > 0, 1] = channel_map[peak_chan_idx[spike_counts > 0]]
+
+    peak_whitened = whitened[np.arange(num_clusters), :, peak_chan_idx]
+    snr_array = np.zeros((num_clusters, 2))
+    snr_array[:,0] = (np.max(peak_whitened,1) - np.min(peak_whitened,1)) / 2
+    snr_array[:,1] = spike_counts
+
+    # place template samples so the spike time falls at pre_samples, and
+    # template channels at their data channels
+    mean_waveforms = np.zeros((num_clusters, num_sites, samples_per_spike), dtype = 'float32')
+
+    shift = pre_samples - template_pre_samples
+    t_first = max(0, -shift)
+    t_last = min(num_samples, samples_per_spike - shift)
+
+    mean_waveforms[:, channel_map, t_first + shift:t_last + shift] = \
+        np.transpose(unwhitened[:, t_first:t_last, :], (0, 2, 1)) * bit_volts
+
+    mean_waveforms[spike_counts == 0, :, :] = 0
+
+    return mean_waveforms, snr_array, clus_table
@@ -177,6 +177,69 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
 
     return metrics
 
+def calculate_sparse_waveform_metrics(waveforms,
+                                      cluster_id,
+                                      channels,
+                                      site_x, site_y,
+                                      sample_rate,
+                                      upsampling_factor,
+                                      spread_threshold,
+                                      site_range,
+                                      epoch_name):
+
+    """
+    Calculate metrics for an array of radius-limited waveforms for a single cluster.
+
+    Inputs:
+    -------
+    waveforms : numpy.ndarray (num_spikes x num_local_channels x num_samples)
+        Can include NaN values for missing spikes; local channel 0 is the 
+        peak channel
+    cluster_id : int
+        ID for cluster
+    channels : numpy.ndarray (num_local_channels x 0)
+        Data channel for each local channel
+    site_x, site_y : numpy.ndarray (num_local_channels x 0)
+        Positions of the local channels in um
+    sample_rate : float
+        Sample rate in Hz
+    upsampling_factor : float
+        Relative rate at which to upsample the spike waveform
+    spread_threshold : float
+        Threshold for computing spread of 2D waveform
+    site_range : float
+        Number of sites to use for 2D waveform metrics
+    epoch_name : str
+        Name of the epoch these waveforms were drawn from
+
+    Outputs:
+    -------
+    metrics : pandas.DataFrame
+        Single-row table containing all metrics
+
+    """
+
+    snr = calculate_snr(waveforms[:, 0, :])
+
+    mean_2D_waveform = np.nanmean(waveforms, 0)
+
+    metrics = calculate_waveform_metrics_from_avg(mean_2D_waveform,
+                                                  snr,
+                                                  cluster_id,
+                                                  0,
+                                                  channels,
+                                                  sample_rate,
+                                                  upsampling_factor,
+                                                  spread_threshold,
+                                                  site_range,
+                                                  site_x, site_y)
+
+    # report the data channel rather than the local index
+    metrics['peak_channel'] = channels[0]
+    metrics['epoch_name'] = epoch_name
+
+    return metrics
+
 # ==========================================================
 
 # EXTRACTING 1D FEATURES
@@ -0,0 +1,121 @@
+import numpy as np
+
+
+class WaveformStore:
+
+    """
+    Chunked, compressed on-disk store for the full mean waveform cube
+
+    The (cluster, epoch, mean/std, channel, time) array is chunked by
+    cluster, so each unit is written once as it finishes and can be read
+    back without decompressing the rest of the file.
+
+    Files ending in .zarr are written with zarr (optional dependency,
+    zarr >= 3); anything else is written as a netCDF4-compatible HDF5 file
+    with h5py. Both can be opened with xarray (open_zarr with consolidated=False,
+    or open_dataset with engine='h5netcdf').
+
+    """
+
+    def __init__(self, output_file, dimCoords, dimLabels, dtype='float64', compression_level=4):
+
+        """
+        Inputs:
+        -------
+        output_file : path to the store (.zarr, or .nc/.h5)
+        dimCoords : list of coordinates for each dimension, as returned by
+            generateDimLabels
+        dimLabels : list of labels for each dimension
+        dtype : data type of the waveforms
+        compression_level : gzip level for HDF5 (zarr uses its default codec)
+
+        """
+
+        self.output_file = output_file
+        self.labels = list(dimLabels)
+
+        # the waveform cube has no 'all' epoch
+        num_epochs = len(dimCoords[1]) - 1
+
+        self.coords = [np.asarray(dimCoords[0]),
+                       np.asarray(dimCoords[1][:num_epochs], dtype=str),
+                       np.asarray(dimCoords[2], dtype=str),
+                       np.asarray(dimCoords[3]),
+                       np.asarray(dimCoords[4])]
+
+        self.shape = tuple(len(c) for c in self.coords)
+        chunks = (1,) + self.shape[1:]
+
+        self.use_zarr = output_file.rstrip('/\\').endswith('.zarr')
+
+        if self.use_zarr:
+            try:
+                import zarr
+            except ImportError:
+                raise ImportError('zarr is required to write ' + output_file +
+                                  '; install it, or use a .nc file')
+
+            self.file = zarr.open_group(output_file, mode='w')
+
+            for label, coord in zip(self.labels, self.coords):
+                arr = self.file.create_array(label, shape=coord.shape,
+                                             dtype=str if coord.dtype.kind == 'U' else coord.dtype,
+                                             dimension_names=[label])
+                arr[:] = coord
+
+            self.waveforms = self.file.create_array('waveforms', shape=self.shape,
+                                                    chunks=chunks, dtype=dtype,
+                                                    fill_value=0,
+                                                    dimension_names=self.labels)
+
+        else:
+            import h5py
+
+            self.file = h5py.File(output_file, 'w')
+
+            for label, coord in zip(self.labels, self.coords):
+                if coord.dtype.kind == 'U':
+                    self.file.create_dataset(label, data=coord.astype(object),
+                                             dtype=h5py.string_dtype())
+                else:
+                    self.file.create_dataset(label, data=coord)
+                self.file[label].make_scale(label)
+
+            self.waveforms = self.file.create_dataset('waveforms', shape=self.shape,
+                                                      chunks=chunks, dtype=dtype,
+                                                      fillvalue=0, shuffle=True,
+                                                      compression='gzip',
+                                                      compression_opts=compression_level)
+
+            for dim, label in enumerate(self.labels):
+                self.waveforms.dims[dim].attach_scale(self.file[label])
+
+
+    def write_unit(self, cluster_idx, unit_waveforms):
+
+        """
+        Writes the (epochs x 2 x channels x samples) waveforms of one unit
+        """
+
+        self.waveforms[cluster_idx] = unit_waveforms
+
+
+    def close(self, spike_count):
+
+        """
+        Saves the spike counts (clusters x epochs) and closes the store
+        """
+
+        spike_count = np.asarray(spike_count)[:, :self.shape[1]]
+
+        if self.use_zarr:
+            arr = self.file.create_array('spike_count', shape=spike_count.shape,
+                                         dtype=spike_count.dtype,
+                                         dimension_names=self.labels[:2])
+            arr[:] = spike_count
+
+        else:
+            ds = self.file.create_dataset('spike_count', data=spike_count)
+            for dim, label in enumerate(self.labels[:2]):
+                ds.dims[dim].attach_scale(self.file[label])
+            self.file.close()
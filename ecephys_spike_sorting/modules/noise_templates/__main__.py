@@ -8,6 +8,7 @@ import numpy as np
 from .id_noise_templates import id_noise_templates, id_noise_templates_rf
 
 from ...common.utils import write_cluster_group_tsv, load_kilosort_data
+from ...common.probe_geometry import ProbeGeometry
 
 
 def classify_noise_templates(args):
@@ -25,11 +26,12 @@ def classify_noise_templates(args):
     if args['noise_waveform_params']['use_random_forest']:
         # use random forest classifier
         cluster_ids, is_noise = id_noise_templates_rf(spike_times, spike_clusters, \
-                    cluster_ids, templates, args['noise_waveform_params'])
+                    cluster_ids, templates, args['noise_waveform_params'], channel_pos)
     else:
         # use heuristics to identify templates that look like noise
+        geometry = ProbeGeometry.from_kilosort(args['directories']['kilosort_output_directory'])
         cluster_ids, is_noise = id_noise_templates(cluster_ids, templates, np.squeeze(channel_map), \
-            args['noise_waveform_params'])
+            args['noise_waveform_params'], geometry)
 
     mapping = {False: 'good', True: 'noise'}
     labels = [mapping[value] for value in is_noise]
@@ -1,19 +1,21 @@
+import os
 import numpy as np
 
-from scipy.signal import correlate, find_peaks, cwt, ricker
+from scipy.signal import correlate, find_peaks, convolve
 from sklearn.ensemble import RandomForestClassifier
 
-from scipy.interpolate import griddata
-from scipy.ndimage.filters import gaussian_filter1d
+from scipy.ndimage import gaussian_filter1d
 
 from ...common.utils import printProgressBar
+from ...common.template_interpolation import get_template_interpolator
+from ...common.probe_geometry import infer_shank_index
 
 import multiprocessing
-from functools import partial
+from multiprocessing import shared_memory
 
 import pickle
 
-def id_noise_templates_rf(spike_times, spike_clusters, cluster_ids, templates, params):
+def id_noise_templates_rf(spike_times, spike_clusters, cluster_ids, templates, params, channel_pos = None):
 
     """
     Uses a random forest classifier to identify noise units based on waveform shape
@@ -24,6 +26,8 @@ def id_noise_templates_rf(spike_times, spike_clusters, cluster_ids, templates, p
     spike_clusters : cluster IDs for each spike time []
     cluster_ids : all unique cluster ids
     templates : template for each unit output by Kilosort
+    channel_pos : (optional) x and y of each template channel; the feature
+        windows then follow the probe geometry (see get_classifier_features)
 
     Outputs:
     -------
@@ -36,45 +40,112 @@ def id_noise_templates_rf(spike_times, spike_clusters, cluster_ids, templates, p
 
     """
     
-    # #############################################
+    classifier = load_classifier(params['classifier_path'])
 
-    classifier_path = params['classifier_path']
+    feature_matrix = get_classifier_features(templates, cluster_ids, channel_pos)
 
-    # #############################################
+    is_noise = classifier.predict(feature_matrix)
+    is_noise = is_noise.astype('bool')
 
-    classifier = pickle.load(open(classifier_path, 'rb'))
+    return cluster_ids, is_noise
 
-    feature_matrix = np.zeros((cluster_ids.size, 61, 32))
 
-    peak_channels = np.squeeze(np.argmax(np.max(templates,1) - np.min(templates,1),1))
+# classifiers loaded in this process, by path; reloaded if the file changes
+_classifiers = {}
 
-    for idx, unit in enumerate(cluster_ids):
-        
-        peak_channel = peak_channels[unit]
 
-        min_chan = np.max([0,peak_channel-16])
-        if min_chan == 0:
-            max_chan = 32
-        else:
-            max_chan = np.min([templates.shape[2], peak_channel+16])
-            if max_chan == templates.shape[2]:
-                min_chan = max_chan - 32
+def load_classifier(classifier_path):
 
-        sub_template = templates[unit, :, min_chan:max_chan]
+    """ Unpickles a classifier once per process (and again if the file is replaced) """
 
-        feature_matrix[idx,:,:] = sub_template
+    mtime = os.stat(classifier_path).st_mtime_ns
 
-    feature_matrix = np.reshape(feature_matrix[:,:,:], (feature_matrix.shape[0], feature_matrix.shape[1] * feature_matrix.shape[2]), 2)
-    feature_matrix = feature_matrix[:,::4]
+    if classifier_path not in _classifiers or _classifiers[classifier_path][0] != mtime:
+        with open(classifier_path, 'rb') as f:
+            _classifiers[classifier_path] = (mtime, pickle.load(f))
 
-    is_noise = classifier.predict(feature_matrix)
-    is_noise = is_noise.astype('bool')
+    return _classifiers[classifier_path][1]
 
-    return cluster_ids, is_noise
-    
 
+def get_classifier_features(templates, units = None, channel_pos = None, peak_channels = None, num_channels = 32):
 
-def id_noise_templates(cluster_ids, templates, channel_map, params):
+    """
+    Feature vectors for the random forest noise classifier
+
+    Each unit's template is cut to a window of num_channels sites around
+    its peak channel, and every 4th value of the window, flattened channel
+    by channel, is kept. Without channel_pos the window is a range of
+    template channels (the layout the classifier was trained on, which
+    assumes a linear NP1.0 channel order). With channel_pos the window is
+    chosen from the sites ordered by shank, depth and channel index, and
+    stays on the peak channel's shank. Either way the window's channels are
+    in channel index order, so on an NP1.0 probe (whatever the x stagger)
+    the features are the same as without channel_pos; for other probes and
+    channel maps the window holds the sites nearest in depth.
+
+    Inputs:
+    -------
+    templates : numpy.ndarray (num_templates x num_samples x num_channels)
+    units : numpy.ndarray (optional)
+        Templates to compute features for; default all
+    channel_pos : numpy.ndarray (num_channels x 2) (optional)
+        x and y of each template channel, in um
+    peak_channels : numpy.ndarray (num_templates x 0) (optional)
+        Peak channel of each template; default the channel with the largest
+        peak-to-peak amplitude
+
+    Outputs:
+    --------
+    features : numpy.ndarray (units x num_samples * num_channels / 4)
+
+    """
+
+    if units is None:
+        units = np.arange(templates.shape[0])
+    units = np.asarray(units)
+
+    total_channels = templates.shape[2]
+
+    if peak_channels is None:
+        peak_channels = np.argmax(np.max(templates,1) - np.min(templates,1),1)
+    peak_channels = np.asarray(peak_channels)[units]
+
+    if channel_pos is None:
+        order = np.arange(total_channels)
+        first = np.zeros((units.size,), dtype = 'int')
+        last = np.full((units.size,), total_channels)
+    else:
+        shank_index = infer_shank_index(channel_pos)
+        order = np.lexsort((np.arange(total_channels), channel_pos[:,1], shank_index))
+        rank = np.argsort(order)
+
+        # sites of the peak channel's shank, if there are enough of them
+        shank_bounds = np.searchsorted(shank_index[order], np.arange(np.max(shank_index) + 2))
+        peak_shank = shank_index[peak_channels]
+        first = shank_bounds[peak_shank]
+        last = shank_bounds[peak_shank + 1]
+        too_few = (last - first) < num_channels
+        first[too_few] = 0
+        last[too_few] = total_channels
+
+        peak_channels = rank[peak_channels]
+
+    start = np.clip(peak_channels - num_channels // 2, first, last - num_channels)
+    windows = np.sort(order[start[:,np.newaxis] + np.arange(num_channels)], 1)
+
+    # (units x channels x samples), flattened channel by channel (the
+    # Fortran-order reshape of (units x samples x channels) used in training)
+    feature_matrix = templates[units[:,np.newaxis,np.newaxis],
+                               np.arange(templates.shape[1])[np.newaxis,np.newaxis,:],
+                               windows[:,:,np.newaxis]]
+
+    feature_matrix = np.reshape(feature_matrix, (feature_matrix.shape[0], feature_matrix.shape[1] * feature_matrix.shape[2]))
+
+    return feature_matrix[:,::4]
+
+
+
+def id_noise_templates(cluster_ids, templates, channel_map, params, geometry = None):
 
     """
     Uses a set of heuristics to identify noise units based on waveform shape
@@ -84,6 +155,9 @@ def id_noise_templates(cluster_ids, templates, channel_map, params):
     cluster_ids : all unique cluster ids
     templates : template for each unit output by Kilosort
     channel_map : mapping between template channels and actual probe channels
+    geometry : (optional) ProbeGeometry of the template channels, e.g.
+        ProbeGeometry.from_kilosort; without it the spatial peak check
+        assumes the NP1.0 layout
 
     Outputs:
     -------
@@ -105,7 +179,7 @@ def id_noise_templates(cluster_ids, templates, channel_map, params):
     #print(cluster_ids[np.where(is_noise)[0]])
 
     print('Checking spatial peaks...')
-    is_noise += check_template_spatial_peaks(templates, channel_map, params)
+    is_noise += check_template_spatial_peaks(templates, channel_map, params, geometry)
     print(' Total noise templates: ' + str(np.sum(is_noise)))
     #print(cluster_ids[np.where(is_noise)[0]])
 
@@ -130,35 +204,49 @@ def check_template_spread(templates, channel_map, params):
     ----------
     """
 
-    is_noise = []
+    # all templates at once: (templates x channels) amplitude profiles
+    MM = np.max(np.abs(templates),1)
+    MM = MM / np.max(MM,1)[:,np.newaxis]
+    MMF = gaussian_filter1d(MM, params['smoothed_template_filter_width'], axis=1)
+
+    spread1 = np.sum(MMF > params['smoothed_template_amplitude_threshold'], 1)
+    spread2 = np.sum(MM > params['template_amplitude_threshold'], 1)
 
-    for i in range(templates.shape[0]):
-        MM = np.max(np.abs(templates[i,:,:]),0)
-        MM = MM / np.max(MM)
-        MMF = gaussian_filter1d(MM, params['smoothed_template_filter_width'])
+    small = spread1 <= params['mid_spread_threshold']
 
-        spread1 = np.sum(MMF > params['smoothed_template_amplitude_threshold'])
-        spread2 = np.sum(MM > params['template_amplitude_threshold'])
+    # above the mid threshold the spread is noise, unless the shape looks like a spike
+    is_noise = np.invert(small)
+    is_noise[small] = spread2[small] < params['min_spread_threshold']
 
-        if (spread1 <= params['mid_spread_threshold']):
-            is_noise.append(spread2 < params['min_spread_threshold'])
-        elif spread1 > params['mid_spread_threshold'] and spread1 <= params['max_spread_threshold']:
-            is_noise.append(check_template_shape(templates[i,:,:], params))
-        else:
-            is_noise.append(True)
+    to_check = np.flatnonzero(np.invert(small) & (spread1 <= params['max_spread_threshold']))
+    if to_check.size > 0:
+        is_noise[to_check] = check_template_shapes(templates[to_check,:,:], params)
+
+    return is_noise
 
-    return np.array(is_noise)
 
+# below this many templates per worker, starting the pool costs more than it saves
+MIN_TEMPLATES_PER_WORKER = 64
 
-def check_template_spatial_peaks(templates, channel_map, params):
+# per-process state for the spatial peak workers, set by init_spatial_peaks_worker
+_worker_state = {}
+
+
+def check_template_spatial_peaks(templates, channel_map, params, geometry = None):
 
     """
     Checks templates for multiple spatial peaks
 
+    The templates are placed in shared memory once, and a pool of
+    params['multiprocessing_worker_count'] workers checks contiguous
+    ranges of templates, returning one boolean per template. Small inputs
+    are checked in this process.
+
     Inputs:
     -------
     templates : template for each unit output by Kilosort
     channel_map : mapping between template channels and actual probe channels
+    geometry : (optional) ProbeGeometry of the template channels
 
     Outputs:
     -------
@@ -168,25 +256,130 @@ def check_template_spatial_peaks(templates, channel_map, params):
     ----------
     """
 
-    is_noise = []
+    num_templates = templates.shape[0]
+    num_workers = int(np.min([params['multiprocessing_worker_count'], multiprocessing.cpu_count()]))
+
+    if num_workers <= 1 or num_templates < num_workers * MIN_TEMPLATES_PER_WORKER:
+        return template_spatial_peaks_range(templates, channel_map, params, 0, num_templates, geometry)
 
-    pool = multiprocessing.Pool(np.min([params['multiprocessing_worker_count'],multiprocessing.cpu_count()]))
-    is_noise = pool.map(partial(template_spatial_peaks, templates, channel_map, params), 
-                        np.arange(templates.shape[0]))
+    templates = np.ascontiguousarray(templates)
 
-    return np.array(is_noise)
+    # several ranges per worker to balance the load
+    bounds = np.linspace(0, num_templates, num_workers * 4 + 1).astype('int')
+    ranges = [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
 
+    is_noise = np.zeros((num_templates,), dtype = bool)
 
-def template_spatial_peaks(templates, channel_map, params, index):
+    ctx = multiprocessing.get_context()
+    shm = shared_memory.SharedMemory(create=True, size=max(1, templates.nbytes))
+    shared_templates = None
 
-    template = templates[index,:,:]
-        
-    peak_channel = np.argmax((np.max(template,0) - np.min(template,0)))
-    peak_index = np.argmax((np.max(template,1) - np.min(template,1)))
+    try:
+        shared_templates = np.ndarray(templates.shape, dtype=templates.dtype, buffer=shm.buf)
+        shared_templates[:] = templates
+
+        initargs = (shm.name, templates.shape, templates.dtype, channel_map, params, geometry)
+
+        with ctx.Pool(num_workers, initializer=init_spatial_peaks_worker, initargs=initargs) as pool:
+            for (start, end), result in zip(ranges, pool.imap(spatial_peaks_worker, ranges)):
+                is_noise[start:end] = result
+
+    finally:
+        # the view must go before the buffer is released, also after an error
+        del shared_templates
+        shm.close()
+        shm.unlink()
+
+    return is_noise
+
+
+def init_spatial_peaks_worker(shm_name, shape, dtype, channel_map, params, geometry):
+
+    """ Attaches a worker to the shared templates array """
+
+    _worker_state['shm'] = shared_memory.SharedMemory(name=shm_name)
+    _worker_state['templates'] = np.ndarray(shape, dtype=dtype, buffer=_worker_state['shm'].buf)
+    _worker_state['channel_map'] = channel_map
+    _worker_state['params'] = params
+    _worker_state['geometry'] = geometry
+
+
+def spatial_peaks_worker(template_range):
+
+    """ Checks templates start to end (exclusive) in a worker process """
+
+    start, end = template_range
+
+    return template_spatial_peaks_range(_worker_state['templates'],
+                                        _worker_state['channel_map'],
+                                        _worker_state['params'],
+                                        start, end,
+                                        _worker_state['geometry'])
+
+
+def template_spatial_peaks_range(templates, channel_map, params, start, end, geometry = None):
+
+    """
+    Spatial peak check for templates start to end (exclusive)
+
+    Only the sample with the largest peak-to-peak amplitude of each
+    template is needed, so just those samples are interpolated, together.
+    With a geometry, the sites of each shank are interpolated separately,
+    for the templates that peak on that shank.
+    """
+
+    templates = np.asarray(templates[start:end])
+
+    peak_channels = np.argmax((np.max(templates,1) - np.min(templates,1)), 1)
+    peak_indices = np.argmax((np.max(templates,2) - np.min(templates,2)), 1)
+
+    peak_frames = templates[np.arange(templates.shape[0]), peak_indices, :]
+
+    is_noise = np.zeros((templates.shape[0],), dtype = bool)
+
+    if geometry is None:
+        # rows of the NP1.0 grid are 10 um apart, about one per channel
+        interp_frames = interpolate_templates(peak_frames[:,np.newaxis,:], channel_map)[:,0,:,:]
+
+        for i in range(templates.shape[0]):
+            is_noise[i] = spatial_peaks(interp_frames[i], channel_map[peak_channels[i]], params)
+
+        return is_noise
+
+    peak_shanks = geometry.shank_index[peak_channels]
+
+    for shank in np.unique(peak_shanks):
+
+        on_shank = np.flatnonzero(geometry.shank_index == shank)
+        units = np.flatnonzero(peak_shanks == shank)
+
+        positions = geometry.positions[on_shank]
+        interp_frames = interpolate_templates(peak_frames[units][:,np.newaxis,on_shank], channel_map[on_shank],
+                                              positions)[:,0,:,:]
+
+        y_first = np.unique(grid_channel_locations(positions)[:,1])[0]
+        peak_rows = np.round((geometry.positions[peak_channels[units],1] - y_first) / 10).astype('int')
+
+        for i, unit in enumerate(units):
+            is_noise[unit] = spatial_peaks(interp_frames[i], peak_rows[i], params)
+
+    return is_noise
 
-    temp = interpolate_template(template, channel_map)
+
+def template_spatial_peaks(templates, channel_map, params, index, geometry = None):
+
+    return template_spatial_peaks_range(templates, channel_map, params, index, index + 1, geometry)[0]
+
+
+def spatial_peaks(interp_frame, peak_row, params):
+
+    """
+    True if the peaks along the probe of the interpolated peak sample
+    (height x width) are spread too widely; peaks are only counted within
+    params['peak_channel_range'] rows of peak_row
+    """
     
-    peak_waveform = temp[peak_index,:,1:6]
+    peak_waveform = interp_frame[:,1:6]
     pw = peak_waveform.flatten()
     si = np.sign(pw[np.argmax(np.abs(pw))])
 
@@ -198,8 +391,8 @@ def template_spatial_peaks(templates, channel_map, params, index):
             D = D * si
             D = D / np.max(np.abs(D))
             p, _ = find_peaks(D, height = params['peak_height_thresh'], prominence = params['peak_prominence_thresh'])
-            peaks_in_range = p[(p > (channel_map[peak_channel] - params['peak_channel_range'])) * \
-                (p < (channel_map[peak_channel] + params['peak_channel_range']))]
+            peaks_in_range = p[(p > (peak_row - params['peak_channel_range'])) * \
+                (p < (peak_row + params['peak_channel_range']))]
             peak_locs.extend(list(peaks_in_range))
 
     return (np.std(peak_locs) > params['peak_locs_std_thresh'])
@@ -249,42 +442,89 @@ def check_template_shape(template, params):
     ----------
     """
 
+    return check_template_shapes(template[np.newaxis,:,:], params)[0]
+
+
+def check_template_shapes(templates, params):
+
+    """
+    Check shape of templates with large spread, for many templates at once
+
+    The difference between the normalized waveforms on every 4th channel
+    around the peak channel and the waveform on the peak channel is
+    averaged, and filtered with a Ricker wavelet of width
+    1 + 2 * params['wavelet_index'] samples (the row of the continuous
+    wavelet transform over widths 1, 3, 5... that the check uses). Only
+    that one width is computed, as one convolution for all templates.
+
+    Inputs:
+    -------
+    templates : templates (templates x samples x channels)
+
+    Outputs:
+    -------
+    is_noise : boolean array, True where the shape is abnormal
+
+    Parameters:
+    ----------
+    """
+
+    num_templates, num_samples, num_channels = templates.shape
+
     channels_to_use = np.arange(-params['template_shape_channel_range'],
                                 params['template_shape_channel_range']+1,
                                 4)
 
-    T2 = np.zeros((template.shape[0], channels_to_use.size))
-    T2[:] = np.nan
-
-    peak_channel = np.argmax((np.max(template,0) - np.min(template,0)))
-
-    for ii,i in enumerate(channels_to_use):
-        try:
-            T = template[:,peak_channel+i]
-        except IndexError:
-            pass
-        else:
-            T2[:,ii] = T / np.max(np.abs(T))
-
-    T3 = T2 - np.tile(T2[:,int(np.floor(channels_to_use.size/2))],
-                      (channels_to_use.size,1)
-                      ).T
-    T4 = np.nanmean(T3,1)
-    cwtmatr = cwt(T4, ricker, np.arange(1,template.shape[0],2))
-    T5 = cwtmatr[params['wavelet_index'],:]
-    wavelet_peak_loc = np.argmax(T5)
-    wavelet_peak_height = np.max(T5)
-
-    if wavelet_peak_height > params['min_wavelet_peak_height'] and \
-       wavelet_peak_loc > params['min_wavelet_peak_loc'] and \
-       wavelet_peak_loc < params['max_wavelet_peak_loc']:
-        is_noise = False
-    else:
-        is_noise = True
+    peak_channels = np.argmax((np.max(templates,1) - np.min(templates,1)), 1)
+
+    # channels past the last one are missing (NaN); negative channel
+    # indices wrap around, as with single-template indexing
+    channels = peak_channels[:,np.newaxis] + channels_to_use[np.newaxis,:]
+    missing = (channels >= num_channels) | (channels < -num_channels)
+    channels = np.where(missing, 0, channels) % num_channels
+
+    T = templates[np.arange(num_templates)[:,np.newaxis,np.newaxis],
+                  np.arange(num_samples)[np.newaxis,:,np.newaxis],
+                  channels[:,np.newaxis,:]].astype('float64')
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        T2 = T / np.max(np.abs(T),1)[:,np.newaxis,:]
+    T2[np.broadcast_to(missing[:,np.newaxis,:], T2.shape)] = np.nan
+
+    T3 = T2 - T2[:,:,int(np.floor(channels_to_use.size/2))][:,:,np.newaxis]
+    T4 = np.nanmean(T3,2)
+
+    width = 1 + 2 * params['wavelet_index']
+    wavelet = ricker(min(10 * width, num_samples), width)[::-1]
+    T5 = convolve(T4, wavelet[np.newaxis,:], mode='same', method='direct')
+
+    wavelet_peak_loc = np.argmax(T5,1)
+    wavelet_peak_height = np.max(T5,1)
+
+    is_noise = np.invert((wavelet_peak_height > params['min_wavelet_peak_height']) & \
+                         (wavelet_peak_loc > params['min_wavelet_peak_loc']) & \
+                         (wavelet_peak_loc < params['max_wavelet_peak_loc']))
     
     return is_noise
 
 
+def ricker(points, a):
+
+    """
+    Ricker ("Mexican hat") wavelet of width a, sampled at points points
+
+    Same definition as scipy.signal.ricker (removed in SciPy 1.15)
+    """
+
+    A = 2 / (np.sqrt(3 * a) * (np.pi**0.25))
+    wsq = a**2
+    vec = np.arange(0, points) - (points - 1.0) / 2
+    xsq = vec**2
+    mod = (1 - xsq / wsq)
+    gauss = np.exp(-xsq / (2 * wsq))
+
+    return A * mod * gauss
+
 
 def actual_channel_locations(channel_map):
     """
@@ -336,7 +576,32 @@ def interp_channel_locations(channel_map):
 
     return interp_channel_locations
 
-def interpolate_template(template, channel_map):
+def grid_channel_locations(channel_pos):
+
+    """
+    Locations of virtual channels for interpolating one shank: 7 columns
+    spanning the sites and rows every 10 um, as interp_channel_locations
+    lays them out for NP1.0
+
+    Inputs:
+    -------
+    channel_pos : (x,y) locations of the sites of one shank (in microns)
+
+    Outputs:
+    --------
+    locations : (x,y) locations of each virtual electrode (in microns),
+                row by row
+    
+    """
+
+    x_i = np.linspace(np.min(channel_pos[:,0]), np.max(channel_pos[:,0]), 7)
+    y_i = np.arange(np.floor(np.min(channel_pos[:,1]) / 10) * 10, np.max(channel_pos[:,1]) + 10, 10)
+
+    y_grid, x_grid = np.meshgrid(y_i, x_i, indexing = 'ij')
+
+    return np.stack((x_grid.flatten(), y_grid.flatten()), 1)
+
+def interpolate_template(template, channel_map, channel_pos = None):
 
     """
     Interpolate template, based on physical channel locations
@@ -345,6 +610,8 @@ def interpolate_template(template, channel_map):
     -------
     template : template for one unit (samples x channels)
     channel_map : mapping between template channels and actual probe channels
+    channel_pos : (optional) x and y of each template channel on one shank;
+        the NP1.0 layout is assumed if not given
 
     Outputs:
     --------
@@ -352,18 +619,41 @@ def interpolate_template(template, channel_map):
     
     """
 
-    total_samples = template.shape[0]
-    loc_a = actual_channel_locations(channel_map)
-    loc_i = interp_channel_locations(channel_map)
+    return interpolate_templates(template[np.newaxis,:,:], channel_map, channel_pos)[0]
+
+
+def interpolate_templates(templates, channel_map, channel_pos = None):
+
+    """
+    Interpolate templates, based on physical channel locations
+
+    The interpolation weights are computed once per channel map and
+    applied to all samples of all templates together.
+
+    Inputs:
+    -------
+    templates : templates for several units (units x samples x channels)
+    channel_map : mapping between template channels and actual probe channels
+    channel_pos : (optional) x and y of each template channel on one shank;
+        the NP1.0 layout is assumed if not given
+
+    Outputs:
+    --------
+    templates_interp : 4D interpolated templates (units x samples x height x width)
+    
+    """
+
+    if channel_pos is None:
+        loc_a = actual_channel_locations(channel_map)
+        loc_i = interp_channel_locations(channel_map)
+    else:
+        loc_a = np.asarray(channel_pos, dtype = 'float64')
+        loc_i = grid_channel_locations(loc_a)
     
     x_i = np.unique(loc_i[:,0])
     y_i = np.unique(loc_i[:,1])
     
-    interp_temp = np.zeros((total_samples, len(x_i) * len(y_i)))
-    
-    for t in range(0,total_samples):
-
-        interp_temp[t,:,] = griddata(loc_a, template[t,:], loc_i, method='cubic', fill_value=0, rescale=False)  
+    interp_temp = get_template_interpolator(loc_a, loc_i)(templates)
 
-    return np.reshape(interp_temp, (total_samples, len(y_i), len(x_i))).astype('float')       
+    return np.reshape(interp_temp, templates.shape[:2] + (len(y_i), len(x_i))).astype('float')       
 
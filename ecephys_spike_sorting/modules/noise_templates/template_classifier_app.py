@@ -13,6 +13,8 @@ import pandas as pd
 
 import os
 
+from ecephys_spike_sorting.common.kilosort_dataset import unwhiten_templates
+
 matplotlib.use('QT5Agg')
 
 mapping = {
@@ -204,14 +206,10 @@ class App(QWidget):
                 whitening_mat_inv = np.load(os.path.join(fname, 'whitening_mat_inv.npy'))
                 self.channel_map = np.load(os.path.join(fname, 'channel_map.npy'))
 
-                self.templates = np.zeros(templates.shape)
+                self.templates = unwhiten_templates(templates, whitening_mat_inv)
 
                 self.unit_list = np.unique(self.spike_clusters)
 
-                for unit in self.unit_list:
-                    template = templates[unit,:,:]
-                    self.templates[unit,:,:] = np.dot(np.ascontiguousarray(template),np.ascontiguousarray(whitening_mat_inv))
-
                 self.output_file = os.path.join(fname, 'template_ratings_new.csv')
 
                 if os.path.exists(self.output_file):
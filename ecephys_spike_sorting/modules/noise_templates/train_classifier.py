@@ -1,10 +1,14 @@
 import os
 import glob
+import multiprocessing
 import numpy as np
 import pandas as pd
 
 import matplotlib.pyplot as plt
 
+from ecephys_spike_sorting.common.kilosort_dataset import unwhiten_templates
+from ecephys_spike_sorting.modules.noise_templates.id_noise_templates import get_classifier_features
+
 base_directory = '/mnt/md0/data'
 
 mice = ['392810', '405755', '448504', '407972', '444384']
@@ -22,115 +26,172 @@ def read_template_ratings_file(filename):
     
     return cluster_ids, cluster_quality
 
-original_features = np.zeros((15000, 61, 32))
-labels = np.zeros((15000,))
+# per-directory feature cache, written next to template_ratings_new.csv
+FEATURES_FILE = 'classifier_features.npz'
 
-unit_idx = 0
+FEATURE_SOURCES = ['templates.npy', 'whitening_mat_inv.npy', 'template_ratings_new.csv', 'channel_positions.npy']
 
-for mouse in mice:
-    
-    print(mouse)
-    
-    directory = os.path.join(base_directory, 'mouse' + mouse)
-    
-    probe_directories = glob.glob(directory + '/*probe*sorted')
-    probe_directories.sort()
-    
-    for folder in probe_directories:
-        
-        subfolder = glob.glob(os.path.join(folder, 'continuous', 'Neuropix-*-100.0'))[0]
-        
-        templates_raw = load(subfolder,'templates.npy')
-        unwhitening_mat = load(subfolder,'whitening_mat_inv.npy')
-        cluster_ids, cluster_quality = read_template_ratings_file(os.path.join(subfolder, 'template_ratings_new.csv'))
-        
-        templates = np.zeros(templates_raw.shape)
-        
-        for temp_idx in range(templates.shape[0]):
-            
-            templates[temp_idx,:,:] = np.dot(np.ascontiguousarray(templates_raw[temp_idx,:,:]),np.ascontiguousarray(unwhitening_mat))
-            
-        peak_channels = np.argmin(np.min(templates,1),1)
-        
-        for idx, unit in enumerate(cluster_ids):
-                    
-            peak_channel = peak_channels[unit]
-
-            min_chan = np.max([0,peak_channel-16])
-            if min_chan == 0:
-                max_chan = 32
-            else:
-                max_chan = np.min([templates.shape[2], peak_channel+16])
-                if max_chan == templates.shape[2]:
-                    min_chan = max_chan - 32
-    
-            sub_template = templates[unit, 21:, min_chan:max_chan]
 
-            original_features[unit_idx,:,:] = sub_template
-            labels[unit_idx] = cluster_quality[idx]
-            unit_idx += 1
-        
-    print(probe_directories)
-# %%
-original_features = original_features[:unit_idx,:,:]
-features = np.reshape(original_features[:,:,:], (original_features.shape[0], original_features.shape[1] * original_features.shape[2]), 2)
-features = features[:,::4]
-labels = labels[:unit_idx]
+def get_probe_features(subfolder, use_cache = True):
+
+    """
+    Classifier features and ratings for the rated templates of one probe
+
+    The features are cached in the Kilosort output directory, and reused
+    while the cache is newer than the templates, whitening matrix, channel
+    positions and ratings it was built from.
+
+    Inputs:
+    -------
+    subfolder : Kilosort output directory, with template_ratings_new.csv
+    use_cache : read and write the feature cache
+
+    Outputs:
+    --------
+    features : numpy.ndarray (rated templates x features)
+    labels : numpy.ndarray (rated templates x 0), index into qualities
+
+    """
+
+    cache_file = os.path.join(subfolder, FEATURES_FILE)
+
+    sources = [os.path.join(subfolder, f) for f in FEATURE_SOURCES if os.path.exists(os.path.join(subfolder, f))]
+
+    if use_cache and os.path.exists(cache_file) and \
+       all(os.stat(cache_file).st_mtime_ns >= os.stat(f).st_mtime_ns for f in sources):
+        with np.load(cache_file) as cache:
+            return cache['features'], cache['labels']
+
+    templates_raw = load(subfolder,'templates.npy')
+    unwhitening_mat = load(subfolder,'whitening_mat_inv.npy')
+    cluster_ids, cluster_quality = read_template_ratings_file(os.path.join(subfolder, 'template_ratings_new.csv'))
+
+    if os.path.exists(os.path.join(subfolder, 'channel_positions.npy')):
+        channel_pos = load(subfolder, 'channel_positions.npy')
+    else:
+        channel_pos = None
+
+    templates = unwhiten_templates(templates_raw, unwhitening_mat)
+
+    peak_channels = np.argmin(np.min(templates,1),1)
+
+    features = get_classifier_features(templates[:,21:,:], np.array(cluster_ids, dtype = 'int'),
+                                       channel_pos, peak_channels)
+    labels = np.array(cluster_quality, dtype = 'float64')
+
+    if use_cache:
+        try:
+            np.savez(cache_file, features = features, labels = labels)
+        except OSError:
+            print('Could not write ' + cache_file)
+
+    return features, labels
+
+
+def get_probe_directories(base_directory, mice):
+
+    """ Kilosort output directory of each sorted probe, mouse by mouse """
+
+    subfolders = []
+
+    for mouse in mice:
+
+        directory = os.path.join(base_directory, 'mouse' + mouse)
+
+        probe_directories = glob.glob(directory + '/*probe*sorted')
+        probe_directories.sort()
+
+        for folder in probe_directories:
+            subfolders.append(glob.glob(os.path.join(folder, 'continuous', 'Neuropix-*-100.0'))[0])
+
+    return subfolders
+
+
+def build_training_set(subfolders, num_workers = None):
+
+    """
+    Features and labels of all rated templates, with the probe directories
+    processed in parallel (one directory per task)
+    """
+
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+
+    num_workers = min(num_workers, len(subfolders))
+
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            results = pool.map(get_probe_features, subfolders, chunksize = 1)
+    else:
+        results = [get_probe_features(subfolder) for subfolder in subfolders]
+
+    features = np.concatenate([r[0] for r in results])
+    labels = np.concatenate([r[1] for r in results])
+
+    return features, labels
+
+
+if __name__ == '__main__':
+
+    subfolders = get_probe_directories(base_directory, mice)
+    print(subfolders)
+
+    features, labels = build_training_set(subfolders)
 
-# %%
+    # %%
 
-noise_templates = np.where(labels > 0)[0]
-good_templates = np.where(labels == 0)[0]
+    noise_templates = np.where(labels > 0)[0]
+    good_templates = np.where(labels == 0)[0]
 
-order_noise = np.random.permutation(noise_templates.size)
-order_good = np.random.permutation(good_templates.size)
+    order_noise = np.random.permutation(noise_templates.size)
+    order_good = np.random.permutation(good_templates.size)
 
-# %%
+    # %%
 
-# # # # # # # # # # # #
+    # # # # # # # # # # # #
 
-# These numbers are critical. The ratio of good units vs. noise units used in training
-# determines the hit rate and false alarm rate.
+    # These numbers are critical. The ratio of good units vs. noise units used in training
+    # determines the hit rate and false alarm rate.
 
-n_train_noise = 300
-n_train_good = 500
-# # # # # # # # # # # #
+    n_train_noise = 300
+    n_train_good = 500
+    # # # # # # # # # # # #
 
-x_train = np.concatenate((features[noise_templates[order_noise[:n_train_noise]],:], features[good_templates[order_good[:n_train_good]],:]))
-y_train = np.concatenate((labels[noise_templates[order_noise[:n_train_noise]]], labels[good_templates[order_good[:n_train_good]]]))
+    x_train = np.concatenate((features[noise_templates[order_noise[:n_train_noise]],:], features[good_templates[order_good[:n_train_good]],:]))
+    y_train = np.concatenate((labels[noise_templates[order_noise[:n_train_noise]]], labels[good_templates[order_good[:n_train_good]]]))
 
-x_test = np.concatenate((features[noise_templates[order_noise[n_train_noise:]],:], features[good_templates[order_good[n_train_good:]],:]))
-y_test = np.concatenate((labels[noise_templates[order_noise[n_train_noise:]]], labels[good_templates[order_good[n_train_good:]]]))
+    x_test = np.concatenate((features[noise_templates[order_noise[n_train_noise:]],:], features[good_templates[order_good[n_train_good:]],:]))
+    y_test = np.concatenate((labels[noise_templates[order_noise[n_train_noise:]]], labels[good_templates[order_good[n_train_good:]]]))
 
-# %%
+    # %%
 
-from sklearn.ensemble import RandomForestClassifier
+    from sklearn.ensemble import RandomForestClassifier
 
-clf = RandomForestClassifier(n_estimators=50, max_depth=50, random_state=10, bootstrap = False, warm_start=True, criterion='entropy', class_weight={0 : 0.01, 1: 1})
+    clf = RandomForestClassifier(n_estimators=50, max_depth=50, random_state=10, bootstrap = False, warm_start=True, criterion='entropy', class_weight={0 : 0.01, 1: 1})
 
-clf.n_estimators = 50
-clf.fit(x_train, y_train)
+    clf.n_estimators = 50
+    clf.fit(x_train, y_train)
 
-predicted_labels = clf.predict(x_test)
+    predicted_labels = clf.predict(x_test)
 
-hits = np.sum((predicted_labels == 0) * (y_test == 0)) / np.sum(y_test == 0)
-fp = np.sum((predicted_labels == 0) * (y_test > 0)) / np.sum(y_test > 0)
+    hits = np.sum((predicted_labels == 0) * (y_test == 0)) / np.sum(y_test == 0)
+    fp = np.sum((predicted_labels == 0) * (y_test > 0)) / np.sum(y_test > 0)
 
-confusion_matrix = np.zeros((5,5))
+    confusion_matrix = np.zeros((5,5))
 
-for i in range(5):
-    for j in range(5):
-        confusion_matrix[i,j] = np.sum((predicted_labels == i) * (y_test == j)) / np.sum(y_test == j)
+    for i in range(5):
+        for j in range(5):
+            confusion_matrix[i,j] = np.sum((predicted_labels == i) * (y_test == j)) / np.sum(y_test == j)
 
-overall = np.sum(((predicted_labels == 0) * (y_test == 0)) + ((predicted_labels > 0) * (y_test > 0))) / len(y_test)
+    overall = np.sum(((predicted_labels == 0) * (y_test == 0)) + ((predicted_labels > 0) * (y_test > 0))) / len(y_test)
 
-print('Hit rate: ' + str(hits))
-print('FP rate: ' + str(fp))
-print('Overall rate: ' + str(overall))
+    print('Hit rate: ' + str(hits))
+    print('FP rate: ' + str(fp))
+    print('Overall rate: ' + str(overall))
 
-plt.figure(14111)
-plt.clf()
+    plt.figure(14111)
+    plt.clf()
 
-plt.imshow(confusion_matrix)
+    plt.imshow(confusion_matrix)
 
-# %%
\ No newline at end of file
+    # %%
@@ -11,6 +11,7 @@ import pandas as pd
 from ...common.utils import load_kilosort_data
 from ...common.utils import getFileVersion
 from ...common.epoch import get_epochs_from_nwb_file
+from ...common.probe_geometry import ProbeGeometry
 
 from .metrics import calculate_metrics
 
@@ -52,7 +53,9 @@ def calculate_quality_metrics(args):
             pc_features = []
             pc_feature_ind = []
                     
-        metrics = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, args['quality_metrics_params'])
+        geometry = ProbeGeometry.from_kilosort(args['directories']['kilosort_output_directory'])
+
+        metrics = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, args['quality_metrics_params'], geometry = geometry)
 
     except FileNotFoundError:
         
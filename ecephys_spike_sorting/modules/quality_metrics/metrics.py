@@ -16,9 +16,12 @@ from scipy import special
 
 from ...common.epoch import Epoch
 from ...common.utils import printProgressBar, get_spike_depths
+from ...common.kilosort_dataset import get_majority_templates
+from ...common.probe_geometry import ProbeGeometry
+from ...common.feature_store import MaskedFeatures
 
 
-def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, params, epochs = None):
+def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, params, epochs = None, geometry = None):
 
     """ Calculate metrics for all units on one probe
 
@@ -47,6 +50,9 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
         'tbin_sec' : time bin for ccg for contam_rate
     epochs : list of Epoch objects
         contains information on Epoch start and stop times
+    geometry : ProbeGeometry, optional
+        Geometry of the template channels, e.g. ProbeGeometry.from_kilosort;
+        built from channel_pos if not given
 
     
     Outputs:
@@ -66,6 +72,9 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
     # epochs = [Epoch('test',0,10)]
     
     include_pcs = params['include_pcs']
+
+    if geometry is None:
+        geometry = ProbeGeometry(channel_pos)
     
     
 #   after any curation, the number of templates may not match the number of templates  
@@ -103,6 +112,15 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
         amplitude_cutoff = calculate_amplitude_cutoff(spike_clusters[in_epoch], amplitudes[in_epoch], total_units)
         
         if include_pcs:
+
+            # select the epoch once for all PC metrics; a blocked store is
+            # not decompressed here, only the per-unit gathers below read it
+            if np.all(in_epoch):
+                epoch_pc_features = pc_features
+            elif isinstance(pc_features, np.ndarray):
+                epoch_pc_features = pc_features[in_epoch,:,:]
+            else:
+                epoch_pc_features = MaskedFeatures(pc_features, np.flatnonzero(~in_epoch))
             
             # determine template this is the best match for each cluster id
             # initialize template ids
@@ -110,9 +128,8 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
             curr_spike_clusters = spike_clusters[in_epoch]
             curr_spike_templates = spike_templates[in_epoch]
             curr_cluster_ids = np.unique(curr_spike_clusters)
-            for cid in curr_cluster_ids:
-                cluster_templates = curr_spike_templates[np.where(curr_spike_clusters==cid)]
-                template_ids[cid] = np.argmax(np.bincount(cluster_templates)) 
+            majority_templates = get_majority_templates(curr_spike_clusters, curr_spike_templates)[1]
+            template_ids[curr_cluster_ids] = majority_templates[curr_cluster_ids]
 
             print("Calculating PC-based metrics")
             isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate = calculate_pc_metrics(spike_clusters[in_epoch],
@@ -120,20 +137,21 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
                                                                                                 total_units,
                                                                                                 curr_cluster_ids,
                                                                                                 template_ids,
-                                                                                                pc_features[in_epoch,:,:],
+                                                                                                epoch_pc_features,
                                                                                                 pc_feature_ind,
                                                                                                 channel_pos,
                                                                                                 params['max_radius_um'],
                                                                                                 params['max_spikes_for_unit'],
                                                                                                 params['max_spikes_for_nn'],
-                                                                                                params['n_neighbors'])
+                                                                                                params['n_neighbors'],
+                                                                                                geometry)
   
             print("Calculating silhouette score")
             nSpikes = spike_times[in_epoch].size
             the_silhouette_score = calculate_silhouette_score(spike_clusters[in_epoch], 
                                                        spike_templates[in_epoch],
                                                        total_units,                                                      
-                                                       pc_features[in_epoch,:,:],
+                                                       epoch_pc_features,
                                                        pc_feature_ind,
                                                        min(nSpikes, params['n_silhouette']))
 
@@ -141,10 +159,10 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
             print("Calculating drift metrics")
             max_drift, cumulative_drift = calculate_drift_metrics(spike_times[in_epoch],
                                                        spike_clusters[in_epoch], 
-                                                       spike_templates,
+                                                       spike_templates[in_epoch],
                                                        template_ids,
                                                        total_units,
-                                                       pc_features[in_epoch,:,:],
+                                                       epoch_pc_features,
                                                        pc_feature_ind,
                                                        channel_pos,
                                                        params['drift_metrics_interval_s'],
@@ -298,7 +316,8 @@ def calculate_pc_metrics(spike_clusters,
                          max_radius_um, 
                          max_spikes_for_cluster, 
                          max_spikes_for_nn, 
-                         n_neighbors):
+                         n_neighbors,
+                         geometry = None):
 
 # OLDER calculatioon assuming linear array and using a number of channels instead of max_radius
 #    assert(num_channels_to_compare % 2 == 1)
@@ -311,6 +330,12 @@ def calculate_pc_metrics(spike_clusters,
     d_primes = np.zeros((total_units,))
     nn_hit_rates = np.zeros((total_units,))
     nn_miss_rates = np.zeros((total_units,))
+
+    if geometry is None:
+        geometry = ProbeGeometry(channel_pos)
+
+    # channels within max_radius_um of each channel
+    neighbors = geometry.neighbors(max_radius_um, same_shank = False)
     
 
 # pc_feature_ind is NOT updated by phy during manual clustering
@@ -333,9 +358,8 @@ def calculate_pc_metrics(spike_clusters,
             
         peak_channel = peak_channels[cluster_id]
         
-        # calculate distances from all channels to peak channel
-        chan_dist = np.sqrt(np.square(channel_pos[:,0] - channel_pos[peak_channel,0]) + \
-                            np.square(channel_pos[:,1] - channel_pos[peak_channel,1]) )
+        # channels within range of the peak channel
+        nearby_channels = neighbors[peak_channel]
 
 # OLDER calculatioon assuming linear array
 #        half_spread_down = peak_channel \
@@ -364,7 +388,7 @@ def calculate_pc_metrics(spike_clusters,
         
         # of those units that have pc overlap, which have their peak channel 
         # within range of the current unit?              
-        units_in_range = np.where( chan_dist[peak_channels[units_for_channel]] < max_radius_um )[0]
+        units_in_range = np.where( np.isin(peak_channels[units_for_channel], nearby_channels) )[0]
            
             
         # If there is at least one neighbor unit in range, compare pcs across 
@@ -378,7 +402,7 @@ def calculate_pc_metrics(spike_clusters,
 # OLDER calculatioon assuming linear array
 #           channels_to_use = np.arange(peak_channel - half_spread_down, peak_channel + half_spread_up + 1)
             
-            channels_to_use = np.where(chan_dist < max_radius_um)[0]
+            channels_to_use = nearby_channels
 
     
             spike_counts = np.zeros(units_for_channel.shape, dtype = 'int')
@@ -479,6 +503,9 @@ def calculate_silhouette_score(spike_clusters,
     # initialize array to hold pcs: number of spikes X number of channeles x number of pc features
     all_pcs = np.zeros((total_spikes, np.max(pc_feature_ind) * num_pc_features + 1))
 
+    # gather the sampled spikes in one read
+    sampled_pc_features = pc_features[random_spike_inds,:,:]
+
     for idx, i in enumerate(random_spike_inds):
         
         # unit_id = spike_clusters[i]
@@ -489,7 +516,7 @@ def calculate_silhouette_score(spike_clusters,
         
         # fill pcs into the correct channels for this spike
         for j in range(0,num_pc_features):
-            all_pcs[idx, channels + np.max(pc_feature_ind) * j] = pc_features[i,j,:]
+            all_pcs[idx, channels + np.max(pc_feature_ind) * j] = sampled_pc_features[idx,j,:]
 
     cluster_labels = spike_clusters[random_spike_inds]
 
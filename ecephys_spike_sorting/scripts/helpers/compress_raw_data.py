@@ -0,0 +1,70 @@
+import argparse
+import time
+
+import numpy as np
+
+from ecephys_spike_sorting.common.raw_recording import RawRecording
+from ecephys_spike_sorting.common.compressed_recording import compress_recording
+
+
+def benchmark(bin_file, cbin_file, num_channels = None, num_snippets = 2000, snippet_length = 82, seed = 0):
+
+	"""
+	Compares read times for the uncompressed memmap and the compressed file
+
+	Three access patterns are timed: a sequential pass in 1 s chunks (as in
+	depth_estimation and get_noise_channels), random short snippets (as in
+	mean_waveforms), and the same snippets in time order.
+	"""
+
+	results = {}
+
+	for label, path in (('bin', bin_file), ('cbin', cbin_file)):
+
+		recording = RawRecording(path, num_channels = num_channels)
+		rng = np.random.default_rng(seed)
+		starts = rng.integers(0, recording.num_samples - snippet_length, num_snippets)
+
+		t0 = time.time()
+		for chunk_start, chunk_end, data in recording.iter_chunks(scaled = False):
+			pass
+		sequential = time.time() - t0
+
+		t0 = time.time()
+		for start in starts:
+			np.asarray(recording.data[start:start + snippet_length, :])
+		random_snippets = time.time() - t0
+
+		t0 = time.time()
+		for start in np.sort(starts):
+			np.asarray(recording.data[start:start + snippet_length, :])
+		sorted_snippets = time.time() - t0
+
+		results[label] = (sequential, random_snippets, sorted_snippets)
+
+		print(label + ': sequential ' + '{:.2f}'.format(sequential) + ' s, ' +
+			repr(num_snippets) + ' random snippets ' + '{:.2f}'.format(random_snippets) + ' s, ' +
+			'sorted snippets ' + '{:.2f}'.format(sorted_snippets) + ' s')
+
+	return results
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description = 'Write a chunk-compressed (.cbin) copy of a raw binary file')
+	parser.add_argument('bin_file')
+	parser.add_argument('--num_channels', type = int, default = None)
+	parser.add_argument('--chunk_duration', type = float, default = 1.0)
+	parser.add_argument('--compression_level', type = int, default = 1)
+	parser.add_argument('--benchmark', action = 'store_true')
+	args = parser.parse_args()
+
+	t0 = time.time()
+	cbin_file, ch_file = compress_recording(args.bin_file,
+											num_channels = args.num_channels,
+											chunk_duration = args.chunk_duration,
+											compression_level = args.compression_level)
+	print('wrote ' + cbin_file + ' in ' + '{:.1f}'.format(time.time() - t0) + ' s')
+
+	if args.benchmark:
+		benchmark(args.bin_file, cbin_file, num_channels = args.num_channels)
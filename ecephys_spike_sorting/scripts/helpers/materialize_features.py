@@ -0,0 +1,20 @@
+import argparse
+import time
+
+from ecephys_spike_sorting.common.feature_store import materialize_features
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description = 'Write compacted pc_features and template_features files, '
+											   'applying the removed-spike sidecars left by kilosort_postprocessing')
+	parser.add_argument('kilosort_output_directory')
+	parser.add_argument('--feature_store', action = 'store_true', help = 'write blocked stores (.blk) instead of .npy files')
+	parser.add_argument('--feature_store_dtype', default = None)
+	args = parser.parse_args()
+
+	t0 = time.time()
+	materialize_features(args.kilosort_output_directory,
+						 use_store = args.feature_store,
+						 stored_dtype = args.feature_store_dtype)
+	print('features written in ' + '{:.1f}'.format(time.time() - t0) + ' s')
@@ -0,0 +1,52 @@
+import pytest
+import numpy as np
+import json
+import os
+
+from ecephys_spike_sorting.common.OEFileInfo import OEContinuousFile
+
+
+def test_scaled_continuous_data(tmpdir):
+
+	num_channels = 6
+	raw = np.arange(500 * num_channels, dtype='int16').reshape((500, num_channels)) - 1000
+	bit_volts = [0.195, 0.195, 0.5, 0.195, 0.25, 1.0]
+
+	folder = os.path.join(str(tmpdir), 'continuous', 'Neuropix-PXI-100.0')
+	os.makedirs(folder)
+	raw.tofile(os.path.join(folder, 'continuous.dat'))
+	np.save(os.path.join(folder, 'timestamps.npy'), np.arange(500) + 10000)
+
+	info = {'continuous' : [{'folder_name' : 'Neuropix-PXI-100.0',
+							 'num_channels' : num_channels,
+							 'sample_rate' : 30000.0,
+							 'channels' : [{'bit_volts' : b} for b in bit_volts]}]}
+	json_file = str(tmpdir.join('structure.oebin'))
+	with open(json_file, 'w') as f:
+		json.dump(info, f)
+
+	data = OEContinuousFile(json_file).load()
+	expected = raw * np.array(bit_volts)
+
+	assert(data.shape == raw.shape)
+
+	for index in [(slice(10, 20), slice(None)),   # rows
+				  (slice(None), 5),               # one channel
+				  (slice(None), slice(1, 4)),
+				  (7, slice(None)),
+				  (7, 2),
+				  (slice(3, 9), [4, 0, 2]),       # fancy channels
+				  ([1, 5, 2], slice(None)),       # fancy rows
+				  ([1, 5, 2], [0, 4, 2]),         # paired, as in numpy
+				  (np.arange(6)[:, np.newaxis], [3, 1]),
+				  (slice(None), np.array([True, False, True, False, False, True]))]:
+		assert(np.allclose(data[index], expected[index]))
+		assert(np.shape(data[index]) == np.shape(expected[index]))
+
+	assert(np.allclose(data[50:60], expected[50:60]))
+	assert(np.allclose(np.asarray(data), expected))
+	assert(np.allclose(data.time_slice(10100, 10110, [0, 2]), expected[100:110, [0, 2]]))
+
+	data32 = OEContinuousFile(json_file).load(dtype='float32')
+	assert(data32[:, 2].dtype == np.float32)
+	assert(np.allclose(data32[:, 2], expected[:, 2]))
@@ -0,0 +1,21 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.common.compressed_recording import CompressedRecording, compress_recording
+
+
+def test_compressed_recording(tmpdir):
+
+	raw = np.random.randint(-32768, 32767, (1000, 4)).astype('int16')
+	bin_file = str(tmpdir.join('test.bin'))
+	raw.tofile(bin_file)
+
+	cbin_file, ch_file = compress_recording(bin_file, num_channels=4, sample_rate=300, chunk_duration=1.0)
+
+	data = CompressedRecording(cbin_file, cache_size=1)
+
+	assert(data.shape == raw.shape)
+	assert(data.chunk_bounds.size == 5)
+	assert(np.array_equal(data[:, :], raw))
+	assert(np.array_equal(data[250:650, [3, 1]], raw[250:650, [3, 1]]))
+	assert(np.array_equal(data[[999, 0, 301], 2], raw[[999, 0, 301], 2]))
@@ -0,0 +1,73 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.common.feature_store import write_blocked_array, load_features, save_features, compact_features, \
+	mark_removed_spikes, materialize_features
+
+
+def test_blocked_array(tmpdir):
+
+	pc_features = np.random.randn(1000, 3, 8).astype('float32')
+
+	store = write_blocked_array(str(tmpdir.join('pc.blk')), pc_features, block_size=64)
+
+	assert(store.shape == pc_features.shape)
+	assert(np.array_equal(store[100:300, 0, :], pc_features[100:300, 0, :]))
+	assert(np.array_equal(store[[999, 5, 64], :, 2], pc_features[[999, 5, 64], :, 2]))
+	assert(np.array_equal(np.asarray(store), pc_features))
+
+
+def test_save_features(tmpdir):
+
+	pc_features = np.random.randn(100, 3, 8).astype('float32')
+
+	save_features(str(tmpdir), 'pc_features', pc_features, use_store=True, stored_dtype='float16')
+
+	assert(not tmpdir.join('pc_features.npy').exists())
+
+	loaded = load_features(str(tmpdir), 'pc_features')
+
+	assert(loaded.dtype == pc_features.dtype)
+	assert(np.allclose(loaded[:], pc_features, atol=1e-2))
+
+
+def test_compact_features(tmpdir):
+
+	pc_features = np.random.randn(1000, 3, 8).astype('float32')
+	keep = np.random.rand(1000) > 0.2
+
+	np.save(str(tmpdir.join('pc_features.npy')), pc_features)
+
+	compact_features(str(tmpdir), 'pc_features', keep, chunk_size=64)
+
+	assert(np.array_equal(np.load(str(tmpdir.join('pc_features.npy'))), pc_features[keep]))
+
+	compact_features(str(tmpdir), 'pc_features', keep[keep], use_store=True)
+
+	assert(not tmpdir.join('pc_features.npy').exists())
+	assert(np.array_equal(np.asarray(load_features(str(tmpdir), 'pc_features')), pc_features[keep]))
+
+
+def test_mark_removed_spikes(tmpdir):
+
+	pc_features = np.random.randn(1000, 3, 8).astype('float32')
+	keep1 = np.random.rand(1000) > 0.1
+	keep2 = np.random.rand(np.sum(keep1)) > 0.1
+
+	np.save(str(tmpdir.join('pc_features.npy')), pc_features)
+
+	mark_removed_spikes(str(tmpdir), 'pc_features', keep1)
+	mark_removed_spikes(str(tmpdir), 'pc_features', keep2)
+
+	expected = pc_features[keep1][keep2]
+	loaded = load_features(str(tmpdir), 'pc_features')
+
+	assert(loaded.shape == expected.shape)
+	assert(np.array_equal(loaded[[0, 17, -1], 1, :], expected[[0, 17, -1], 1, :]))
+	assert(np.array_equal(loaded[100:300:3], expected[100:300:3]))
+	assert(np.array_equal(np.load(str(tmpdir.join('pc_features.npy'))), pc_features))
+
+	materialize_features(str(tmpdir))
+
+	assert(not tmpdir.join('pc_features.removed.npy').exists())
+	assert(np.array_equal(np.load(str(tmpdir.join('pc_features.npy'))), expected))
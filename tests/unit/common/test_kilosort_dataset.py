@@ -0,0 +1,80 @@
+import pytest
+import numpy as np
+import os
+
+from ecephys_spike_sorting.common.kilosort_dataset import KilosortDataset, get_majority_templates, \
+	get_spike_index, spike_index_is_current
+
+
+def test_get_majority_templates():
+
+	spike_clusters = np.array([0, 0, 0, 2, 2, 2, 2, 3])
+	spike_templates = np.array([4, 1, 4, 3, 1, 1, 3, 0])
+
+	spike_counts, majority_templates = get_majority_templates(spike_clusters, spike_templates)
+
+	assert(np.array_equal(spike_counts, [3, 0, 4, 1]))
+	assert(np.array_equal(majority_templates, [4, 0, 1, 0]))
+
+def test_kilosort_dataset(tmp_path):
+
+	templates = np.zeros((2, 25, 3), dtype='float32')
+	templates[0, 21:, 1] = [1, -3, 2, 0]
+	templates[1, 21:, 2] = [0, -1, 1, 0]
+
+	np.save(os.path.join(tmp_path, 'spike_times.npy'), np.array([[10], [20], [30]], dtype='uint64'))
+	np.save(os.path.join(tmp_path, 'spike_clusters.npy'), np.array([5, 5, 2], dtype='int32'))
+	np.save(os.path.join(tmp_path, 'spike_templates.npy'), np.array([[1], [0], [1]], dtype='uint32'))
+	np.save(os.path.join(tmp_path, 'templates.npy'), templates)
+	np.save(os.path.join(tmp_path, 'whitening_mat_inv.npy'), np.eye(3) * 2)
+	np.save(os.path.join(tmp_path, 'channel_map.npy'), np.array([[4], [6], [8]], dtype='int32'))
+
+	ks = KilosortDataset(tmp_path, template_zero_padding = 21, mmap_mode = 'r')
+
+	assert(ks.spike_times.shape == (3,))
+	assert(ks.templates.shape == (2, 4, 3))
+	assert(np.allclose(ks.unwhitened_templates, ks.templates * 2))
+	assert(np.array_equal(ks.cluster_ids, [2, 5]))
+	assert(np.array_equal(ks.template_peak_channels, [6, 8]))
+	assert(np.array_equal(ks.cluster_spike_counts[[2, 5]], [1, 2]))
+	assert(ks.cluster_majority_templates[5] == 0)
+	assert(ks.cluster_peak_channels[2] == 8)
+
+def test_cluster_summary_cache(tmp_path):
+
+	np.save(os.path.join(tmp_path, 'spike_clusters.npy'), np.array([0, 0, 1], dtype='int32'))
+	np.save(os.path.join(tmp_path, 'spike_templates.npy'), np.array([0, 0, 1], dtype='uint32'))
+	np.save(os.path.join(tmp_path, 'templates.npy'), np.random.rand(2, 25, 3).astype('float32'))
+	np.save(os.path.join(tmp_path, 'whitening_mat_inv.npy'), np.eye(3))
+	np.save(os.path.join(tmp_path, 'channel_map.npy'), np.arange(3))
+
+	assert(np.array_equal(KilosortDataset(tmp_path).cluster_spike_counts, [2, 1]))
+	assert(os.path.exists(os.path.join(tmp_path, 'cluster_summary.npz')))
+
+	# curation rewrites spike_clusters.npy, which invalidates the cache
+	np.save(os.path.join(tmp_path, 'spike_clusters.npy'), np.array([0, 2, 2, 2], dtype='int32'))
+	np.save(os.path.join(tmp_path, 'spike_templates.npy'), np.array([0, 0, 1, 1], dtype='uint32'))
+
+	ks = KilosortDataset(tmp_path)
+
+	assert(np.array_equal(ks.cluster_spike_counts, [1, 0, 3]))
+	assert(np.array_equal(ks.cluster_majority_templates, [0, 0, 1]))
+
+def test_spike_index(tmp_path):
+
+	spike_clusters = np.array([2, 0, 2, 1, 0, 2], dtype='uint32')
+	spike_times = np.array([5, 6, 1, 8, 9, 3], dtype='uint64')
+
+	np.save(os.path.join(tmp_path, 'spike_clusters.npy'), spike_clusters)
+	np.save(os.path.join(tmp_path, 'spike_times.npy'), spike_times)
+
+	ks = KilosortDataset(tmp_path)
+
+	assert(np.array_equal(ks.cluster_spikes(2), [2, 5, 0]))
+	assert(np.array_equal(ks.cluster_spikes(0), [1, 4]))
+	assert(ks.cluster_spikes(7).size == 0)
+	assert(spike_index_is_current(tmp_path))
+
+	order, offsets = get_spike_index(spike_clusters, spike_times)
+
+	assert(np.array_equal(offsets, [0, 2, 3, 6]))
@@ -0,0 +1,48 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.common.probe_geometry import ProbeGeometry
+
+
+def test_probe_geometry(tmpdir):
+
+	positions = np.array([[0, 0], [32, 0], [0, 20], [32, 20], [0, 40]], dtype='float')
+	np.save(str(tmpdir.join('channel_positions.npy')), positions)
+
+	geometry = ProbeGeometry.from_kilosort(str(tmpdir))
+
+	assert(tmpdir.join('probe_geometry.npz').exists())
+	assert(np.array_equal(ProbeGeometry.from_kilosort(str(tmpdir)).positions, positions))
+
+	assert(np.array_equal(geometry.neighbors(25)[2], [0, 2, 4]))
+	assert(np.array_equal(geometry.neighbors(20)[2], [2]))
+	assert(geometry.neighbor_mask(40)[0, 3])
+	assert(not geometry.neighbor_mask(20)[0, 2])
+
+	geometry = ProbeGeometry(positions, shank_index=[0, 1, 0, 1, 0])
+
+	assert(np.array_equal(geometry.neighbors(40)[0], [0, 2]))
+
+
+def test_probe_geometry_sidecar(tmpdir):
+
+	# two shanks, 250 um apart
+	positions = np.array([[0, 0], [32, 0], [0, 20], [250, 0], [282, 0], [250, 20]], dtype='float')
+	np.save(str(tmpdir.join('channel_positions.npy')), positions)
+
+	geometry = ProbeGeometry.from_kilosort(str(tmpdir))
+
+	assert(np.array_equal(geometry.shank_index, [0, 0, 0, 1, 1, 1]))
+
+	neighbors = geometry.neighbors(300)
+	assert(np.array_equal(neighbors[0], [0, 1, 2]))
+	assert(np.array_equal(geometry.neighbors(300, same_shank=False)[0], [0, 1, 2, 3, 4, 5]))
+
+	# the lists are read back from the sidecar, without a KD-tree query
+	cached = ProbeGeometry.from_kilosort(str(tmpdir))
+
+	assert(np.array_equal(cached.shank_index, geometry.shank_index))
+	for same_shank in [True, False]:
+		for expected, loaded in zip(geometry.neighbors(300, same_shank), cached.neighbors(300, same_shank)):
+			assert(np.array_equal(expected, loaded))
+	assert('kdtree' not in vars(cached))
@@ -0,0 +1,27 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.common.raw_recording import RawRecording
+
+
+def test_raw_recording(tmpdir):
+
+	raw = np.arange(1000 * 4, dtype='int16').reshape((1000, 4))
+	bin_file = str(tmpdir.join('test.imec0.ap.bin'))
+	raw.tofile(bin_file)
+
+	with open(str(tmpdir.join('test.imec0.ap.meta')), 'w') as f:
+		f.write('nSavedChans=4\nimSampRate=30000.0\nimAiRangeMax=0.6\nimMaxInt=512\n' +
+			'imroTbl=(0,384)(0 0 0 500 250 1)(1 0 0 500 250 1)\n')
+
+	rec = RawRecording(bin_file)
+
+	assert(rec.num_channels == 4)
+	assert(rec.num_samples == 1000)
+	assert(np.isclose(rec.bit_volts, 0.6 / 512 / 500 * 1e6))
+	assert(np.array_equal(rec.read(10, 20, channels=[2, 0], scaled=False), raw[10:20, [2, 0]]))
+
+	for read_ahead in (True, False):
+		chunks = [data for start, end, data in rec.iter_chunks(chunk_size=300, scaled=False, read_ahead=read_ahead)]
+		assert(len(chunks) == 4)
+		assert(np.array_equal(np.concatenate(chunks), raw))
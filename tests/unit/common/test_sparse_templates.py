@@ -0,0 +1,48 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.common.sparse_templates import SparseTemplates
+from ecephys_spike_sorting.common.kilosort_dataset import unwhiten_templates
+
+
+def test_sparse_templates():
+
+	templates = np.zeros((3, 10, 8), dtype='float32')
+	templates[0, 4, 1] = -5
+	templates[0, 4, 2] = -2
+	templates[1, 3, 6] = -1
+	templates[1, 3, 7] = -4
+	templates[2, 5, 0] = 3
+
+	w_inv = np.eye(8) * 2
+
+	sparse = SparseTemplates(templates, w_inv, num_active = 3, block_size = 2)
+
+	assert(sparse.channels.shape == (3, 3))
+	assert(np.array_equal(sparse.peak_channel_index, [1, 7, 0]))
+	assert(np.allclose(sparse.amplitudes, [10, 8, 6]))
+	assert(np.allclose(sparse.to_dense(), templates * 2))
+
+
+def test_sparse_templates_dense_w_inv():
+
+	rng = np.random.default_rng(0)
+
+	templates = rng.standard_normal((20, 30, 16)).astype('float32') * 0.1
+	templates[:, 10:14, :4] += rng.standard_normal((20, 4, 4)).astype('float32') * 5
+
+	# not block-diagonal: every channel mixes into every other one
+	w_inv = np.eye(16) * 2 + rng.standard_normal((16, 16)) * 0.3
+
+	sparse = SparseTemplates(templates, w_inv, num_active = 6, block_size = 7)
+	dense = unwhiten_templates(templates, w_inv)
+
+	active = np.take_along_axis(dense, sparse.channels[:,np.newaxis,:], 2)
+	assert(np.allclose(sparse.values, active, rtol = 1e-5, atol = 1e-5))
+
+	ptp = np.max(dense, 1) - np.min(dense, 1)
+	peak = np.argmax(ptp, 1)
+	in_active = np.any(sparse.channels == peak[:,np.newaxis], 1)
+	assert(np.all(in_active))
+	assert(np.array_equal(sparse.peak_channel_index, peak))
+	assert(np.allclose(sparse.amplitudes, ptp[np.arange(20), peak], rtol = 1e-5))
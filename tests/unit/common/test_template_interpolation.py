@@ -0,0 +1,32 @@
+import pytest
+import numpy as np
+from scipy.interpolate import griddata
+
+from ecephys_spike_sorting.common.template_interpolation import get_template_interpolator
+
+
+def test_template_interpolator():
+
+	num_channels = 64
+
+	loc_a = np.zeros((num_channels, 2))
+	loc_a[:, 0] = np.array([16, 48, 0, 32])[np.arange(num_channels) % 4]
+	loc_a[:, 1] = np.floor(np.arange(num_channels) / 2) * 20
+
+	loc_i = np.zeros((num_channels * 7, 2))
+	loc_i[:, 0] = np.array([0, 8, 16, 24, 32, 40, 48])[np.arange(num_channels * 7) % 7]
+	loc_i[:, 1] = np.floor(np.arange(num_channels * 7) / 7) * 10
+
+	templates = np.random.randn(3, 20, num_channels)
+
+	interpolator = get_template_interpolator(loc_a, loc_i)
+
+	assert(get_template_interpolator(loc_a, loc_i) is interpolator)
+
+	interp_temp = interpolator(templates)
+
+	assert(interp_temp.shape == (3, 20, num_channels * 7))
+
+	for t in (0, 7, 19):
+		expected = griddata(loc_a, templates[2, t, :], loc_i, method='cubic', fill_value=0, rescale=False)
+		assert(np.allclose(interp_temp[2, t, :], expected, atol=1e-4))
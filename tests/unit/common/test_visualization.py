@@ -0,0 +1,30 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.common.visualization import _load_raw_data
+
+
+def test_load_raw_data(tmpdir):
+
+	# no .meta file: 384 channels unless the count is given
+	raw = np.arange(10 * 384, dtype='int16').reshape((10, 384))
+	dat_file = str(tmpdir.join('continuous.dat'))
+	raw.tofile(dat_file)
+
+	assert(np.array_equal(_load_raw_data(dat_file, None), raw))
+	assert(_load_raw_data(dat_file, 96).shape == (40, 96))
+
+	# a .meta file without a channel count is an error, not a 384-channel file
+	bin_file = str(tmpdir.join('test.imec0.ap.bin'))
+	raw.tofile(bin_file)
+	with open(str(tmpdir.join('test.imec0.ap.meta')), 'w') as f:
+		f.write('imSampRate=30000.0\n')
+
+	with pytest.raises(ValueError):
+		_load_raw_data(bin_file, None)
+
+	with open(str(tmpdir.join('test.imec0.ap.meta')), 'w') as f:
+		f.write('nSavedChans=96\nimSampRate=30000.0\nimAiRangeMax=0.6\nimMaxInt=512\n' +
+			'imroTbl=(0,384)(0 0 0 500 250 1)\n')
+
+	assert(_load_raw_data(bin_file, None).shape == (40, 96))
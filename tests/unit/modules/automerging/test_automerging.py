@@ -3,6 +3,7 @@ import numpy as np
 import os
 
 from ecephys_spike_sorting.modules.automerging.automerging import automerging
+from ecephys_spike_sorting.modules.automerging.metrics import compare_templates
 import ecephys_spike_sorting.common.utils as utils
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
@@ -21,4 +22,36 @@ def test_automerging():
 	
 	clusters, ids, labels = automerging(spike_times, spike_clusters, cluster_ids, cluster_quality, templates, params)
 
-	assert(len(ids) == len(labels))
\ No newline at end of file
+	assert(len(ids) == len(labels))
+
+
+@pytest.mark.parametrize('total_rows', [384, 31, 61, 82])
+def test_compare_templates(total_rows):
+
+	# next_fast_len(2 * total_rows) is odd for 31, 61 and 82 rows
+	rng = np.random.default_rng(0)
+
+	for depth1, depth2 in ((total_rows // 2, total_rows // 2 + 4), (3, 6), (total_rows - 4, total_rows - 7)):
+
+		t1 = np.zeros((61, total_rows, 7))
+		t2 = np.zeros((61, total_rows, 7))
+		t1[:, max(0, depth1 - 10):depth1 + 10] = rng.standard_normal((61, min(total_rows, depth1 + 10) - max(0, depth1 - 10), 7))
+		t2[:, max(0, depth2 - 10):depth2 + 10] = rng.standard_normal((61, min(total_rows, depth2 + 10) - max(0, depth2 - 10), 7))
+		t1[20, depth1, 0] = -50
+		t2[20, depth2, 0] = -50
+
+		sim, offset_distance = compare_templates(t1, t2)
+
+		# np.corrcoef of zero-padded copies, one offset at a time
+		padding_neg = min(10, max(depth1, depth2))
+		padding_pos = total_rows - min(depth1, depth2) if min(depth1, depth2) > total_rows - 10 else 10
+		m1 = np.zeros((61, total_rows + padding_neg + padding_pos, 7))
+		m1[:, padding_neg:total_rows + padding_neg] = t1
+
+		assert(sim.size == padding_neg + padding_pos)
+
+		for idx, offset in enumerate(range(-padding_neg, padding_pos)):
+			m2 = np.zeros(m1.shape)
+			m2[:, padding_neg + offset:total_rows + padding_neg + offset] = t2
+			assert(np.isclose(sim[idx], np.corrcoef(m1.flatten(), m2.flatten())[0, 1]))
+			assert(offset_distance[idx] == -offset * 10)
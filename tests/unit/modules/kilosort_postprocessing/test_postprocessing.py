@@ -0,0 +1,211 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.modules.kilosort_postprocessing.postprocessing import \
+	find_all_between_unit_overlaps, find_between_unit_overlap, find_within_unit_overlap, \
+	find_double_counted_spikes, \
+	get_cluster_mean_waveforms, get_alignment_offsets
+from ecephys_spike_sorting.common.probe_geometry import ProbeGeometry
+
+
+def pairwise_overlaps(spike_times, spike_clusters, sorted_unit_list, close_units, cluster_amplitude, overlap_window, deletionMode):
+
+	# the loop over unit pairs of remove_double_counted_spikes; close_units is
+	# indexed by unit ID, as in find_double_counted_spikes
+	num_units = len(sorted_unit_list)
+	overlap_matrix = np.zeros((num_units, num_units), dtype = 'int')
+	spikes_to_remove = np.zeros((0,), dtype = 'int')
+
+	for idx1, unit_id1 in enumerate(sorted_unit_list):
+		for idx2, unit_id2 in enumerate(sorted_unit_list):
+			if idx1 < idx2 and close_units[unit_id1, unit_id2]:
+				for_unit1 = np.where(spike_clusters == unit_id1)[0]
+				for_unit2 = np.where(spike_clusters == unit_id2)[0]
+				to_remove1, to_remove2 = find_between_unit_overlap(spike_times[for_unit1], spike_times[for_unit2],
+																	cluster_amplitude[unit_id1], cluster_amplitude[unit_id2],
+																	overlap_window, deletionMode)
+				overlap_matrix[idx1, idx2] = len(to_remove1)
+				overlap_matrix[idx2, idx1] = len(to_remove2)
+				spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove1], for_unit2[to_remove2]))
+
+	return spikes_to_remove, overlap_matrix
+
+
+def make_overlapping_spikes(case, rng, num_units):
+
+	if case == 'sparse':
+		spike_times = np.array([100, 5000, 9000])
+		spike_clusters = np.array([0, 1, 2])
+
+	elif case == 'none':
+		spike_times = np.arange(3000) * 50
+		spike_clusters = rng.integers(0, num_units, spike_times.size)
+
+	elif case == 'bursts':
+		# unit 0 fires every 5 samples; no other spike is close to it
+		spike_times = np.concatenate((1000 + 5 * np.arange(40), 50000 + 3000 * np.arange(60)))
+		spike_clusters = np.concatenate((np.zeros((40,), dtype = 'int'), rng.integers(1, num_units, 60)))
+
+	else:
+		spike_times = rng.choice(300000, 3000, replace = False)
+		spike_clusters = rng.integers(0, num_units, spike_times.size)
+
+		# copies of unit 0 in unit 1, a few samples late
+		copies = spike_times[spike_clusters == 0][::2]
+		copies = copies + rng.integers(1, 4, copies.size)
+		spike_times = np.concatenate((spike_times, copies))
+		spike_clusters = np.concatenate((spike_clusters, np.ones(copies.shape, dtype = spike_clusters.dtype)))
+
+		spike_times, first = np.unique(spike_times, return_index = True)
+		spike_clusters = spike_clusters[first]
+
+	order = np.argsort(spike_times, kind = 'stable')
+
+	return spike_times[order].astype('uint64'), spike_clusters[order]
+
+
+@pytest.mark.parametrize('case', ['copies', 'none', 'sparse', 'bursts'])
+@pytest.mark.parametrize('deletionMode', ['lowAmpCluster', 'deleteFirst'])
+def test_find_all_between_unit_overlaps(deletionMode, case):
+
+	rng = np.random.default_rng(1)
+
+	num_units = 6
+	spike_times, spike_clusters = make_overlapping_spikes(case, rng, num_units)
+
+	sorted_unit_list = rng.permutation(num_units)
+	close_units = rng.random((num_units, num_units)) < 0.7
+	close_units[[0, 1], [1, 0]] = True
+	close_units[0, np.arange(num_units)] = True
+	cluster_amplitude = rng.random(num_units) * 100
+
+	expected_spikes, expected_matrix = pairwise_overlaps(spike_times, spike_clusters, sorted_unit_list, close_units,
+														 cluster_amplitude, 5, deletionMode)
+
+	spikes_to_remove, overlap_matrix = find_all_between_unit_overlaps(spike_times, spike_clusters, sorted_unit_list,
+																	  close_units, cluster_amplitude, 5, deletionMode)
+
+	assert np.array_equal(overlap_matrix, expected_matrix)
+	assert np.array_equal(np.unique(spikes_to_remove), np.unique(expected_spikes))
+
+	if case == 'copies' or (case == 'bursts' and deletionMode == 'lowAmpCluster'):
+		assert np.sum(overlap_matrix) > 0
+	if case in ('none', 'sparse'):
+		assert np.sum(overlap_matrix) == 0
+
+
+def test_double_counted_sparse_spikes():
+
+	params = {'within_unit_overlap_window' : 0.000166,
+			  'between_unit_overlap_window' : 0.000166,
+			  'between_unit_dist_um' : 50,
+			  'deletion_mode' : 'lowAmpCluster'}
+
+	channel_pos = np.stack((np.zeros(4), np.arange(4) * 20.0), 1)
+
+	keep, overlap_matrix, overlap_summary = find_double_counted_spikes(np.array([100, 5000, 9000], dtype = 'uint64'),
+																	   np.array([0, 1, 2]), np.arange(4), channel_pos,
+																	   None, np.ones(3), 30000.0, params,
+																	   peak_chan_idx = np.array([0, 1, 2]))
+
+	assert(np.all(keep))
+	assert(np.sum(overlap_matrix) == 0)
+
+
+def test_alignment_offsets(tmpdir):
+
+	rng = np.random.default_rng(0)
+
+	num_channels = 32
+	num_samples = 300000
+	shift = np.array([-3, 0, 4])
+	peak_channels = np.array([2, 16, 30])
+
+	spike_times = np.sort(rng.integers(200, num_samples - 200, 600))
+	spike_clusters = rng.integers(0, 3, spike_times.size)
+
+	data = rng.normal(0, 5, (num_samples, num_channels))
+	t = np.arange(82)
+
+	for k in range(3):
+		wave = -80 * np.exp(-0.5 * ((t - 19 - shift[k]) / 2) ** 2)
+		for spike_time in spike_times[spike_clusters == k]:
+			data[spike_time - 20:spike_time + 62, peak_channels[k]] += wave
+
+	bin_file = str(tmpdir.join('continuous.dat'))
+	data.astype('int16').tofile(bin_file)
+
+	mean_waveforms, spike_counts = get_cluster_mean_waveforms(spike_times, spike_clusters, bin_file,
+															  peak_channels, num_channels=num_channels)
+
+	assert(mean_waveforms.shape == (3, 82, 17))
+	assert(np.array_equal(spike_counts, np.bincount(spike_clusters)))
+	assert(np.array_equal(get_alignment_offsets(mean_waveforms, spike_counts), -shift))
+
+
+@pytest.mark.parametrize('radius', [40, 68])
+def test_double_counted_kilosort_geometry(tmpdir, radius):
+
+	rng = np.random.default_rng(3)
+
+	num_units = 6
+	num_channels = 16
+	spike_times, spike_clusters = make_overlapping_spikes('copies', rng, num_units)
+
+	# staggered sites; 68 um is exactly the distance between some of them
+	channel_pos = np.stack((np.tile([16.0, 48.0], num_channels // 2), np.repeat(np.arange(num_channels // 2) * 20.0, 2)), 1)
+	np.save(str(tmpdir.join('channel_positions.npy')), channel_pos)
+
+	peak_chan_idx = rng.permutation(num_channels)[:num_units]
+	cluster_amplitude = rng.random(num_units) * 100
+
+	params = {'within_unit_overlap_window' : 0.0,
+			  'between_unit_overlap_window' : 0.000166,
+			  'between_unit_dist_um' : radius,
+			  'deletion_mode' : 'lowAmpCluster'}
+
+	geometry = ProbeGeometry.from_kilosort(str(tmpdir))
+
+	keep, overlap_matrix, overlap_summary = find_double_counted_spikes(spike_times, spike_clusters, np.arange(num_channels),
+																	   channel_pos, None, cluster_amplitude, 30000.0, params,
+																	   peak_chan_idx = peak_chan_idx, geometry = geometry)
+
+	# the dense distance test this replaced
+	peak_pos = channel_pos[peak_chan_idx]
+	close_units = np.sqrt(np.sum(np.square(peak_pos[:,None,:] - peak_pos[None,:,:]), 2)) < radius
+
+	expected_spikes, expected_matrix = pairwise_overlaps(spike_times, spike_clusters, np.argsort(peak_chan_idx), close_units,
+														 cluster_amplitude, 4, 'lowAmpCluster')
+
+	assert(np.array_equal(np.flatnonzero(~keep), np.unique(expected_spikes)))
+	assert(np.array_equal(overlap_matrix, expected_matrix))
+	assert(np.sum(overlap_matrix) > 0)
+	assert('distances' not in vars(geometry))
+
+
+def test_within_unit_overlaps():
+
+	rng = np.random.default_rng(2)
+
+	num_units = 8
+	num_channels = 16
+	spike_times = np.sort(rng.integers(0, 100000, 5000)).astype('uint64')
+	spike_clusters = rng.integers(0, num_units, spike_times.size)
+	channel_pos = np.stack((np.zeros(num_channels), np.arange(num_channels) * 20.0), 1)
+
+	params = {'within_unit_overlap_window' : 0.001,
+			  'between_unit_overlap_window' : 0.0,
+			  'between_unit_dist_um' : 0,
+			  'deletion_mode' : 'lowAmpCluster'}
+
+	keep, overlap_matrix, overlap_summary = find_double_counted_spikes(spike_times, spike_clusters, np.arange(num_channels),
+																	   channel_pos, None, np.ones(num_units), 30000.0, params,
+																	   peak_chan_idx=rng.integers(0, num_channels, num_units))
+
+	expected = np.ones(spike_times.shape, dtype=bool)
+	for unit_id in range(num_units):
+		for_unit = np.where(spike_clusters == unit_id)[0]
+		expected[for_unit[find_within_unit_overlap(spike_times[for_unit], 30)]] = False
+
+	assert(np.array_equal(keep, expected))
+	assert(np.array_equal(overlap_summary[:, 2], np.bincount(spike_clusters[~expected], minlength=num_units)))
@@ -1,6 +1,8 @@
 import pytest
 import numpy as np
 import os
+import pandas as pd
+import h5py
 
 from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import extract_waveforms
 import ecephys_spike_sorting.common.utils as utils
@@ -29,4 +31,397 @@ def test_extract_waveforms():
     
     data, spike_counts, coords, labels = extract_waveforms(data, spike_times, spike_clusters, cluster_ids, cluster_quality, bit_volts, sample_rate, params)
 
-    print(labels)
\ No newline at end of file
+    print(labels)
+
+def make_curated_recording(rng, num_channels = 32, num_samples = 60000):
+
+    channel_map = np.arange(num_channels)
+    channel_pos = np.stack((np.tile([16, 48], num_channels // 2), 20 * (np.arange(num_channels) // 2)), 1).astype('float')
+
+    # 4 templates; after curation in phy, template 1 is split into clusters
+    # 7 and 9, and templates 2 and 3 are merged into cluster 8
+    template_peaks = np.array([3, 12, 20, 28])
+    spike_templates = rng.integers(0, 4, 400)
+    spike_times = np.sort(rng.choice(np.arange(100, num_samples - 100), 400, replace = False))
+    spike_clusters = np.array([0, 7, 8, 8])[spike_templates]
+    spike_clusters[(spike_templates == 1) & (rng.random(400) < 0.5)] = 9
+    spike_clusters[(spike_templates == 3) & (np.arange(400) % 4 == 0)] = 8
+
+    data = rng.normal(0, 2, (num_samples, num_channels))
+    wave = -100 * np.exp(-0.5 * ((np.arange(82) - 20) / 2) ** 2)
+    for spike_time, template in zip(spike_times, spike_templates):
+        data[spike_time - 20:spike_time + 62, template_peaks[template]] += wave
+
+    templates = np.zeros((4, 82, num_channels))
+    templates[np.arange(4), 20, template_peaks] = -1
+
+    return data, spike_times, spike_clusters, spike_templates, templates, template_peaks, channel_map, channel_pos
+
+
+def test_sparse_channels_merged_clusters():
+
+    from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import get_sparse_channel_map
+    from ecephys_spike_sorting.common.kilosort_dataset import get_majority_templates
+
+    rng = np.random.default_rng(0)
+
+    data, spike_times, spike_clusters, spike_templates, templates, template_peaks, channel_map, channel_pos = \
+        make_curated_recording(rng)
+
+    spike_counts, majority_templates = get_majority_templates(spike_clusters, spike_templates)
+    peak_channels = channel_map[template_peaks[majority_templates]]
+
+    unit_channels = get_sparse_channel_map(channel_map, channel_pos, peak_channels, 50)
+
+    assert(unit_channels.shape[0] == np.max(spike_clusters) + 1)
+    assert(np.array_equal(unit_channels[[0, 7, 8, 9], 0], peak_channels[[0, 7, 8, 9]]))
+
+    params = {'samples_per_spike' : 82, 'pre_samples' : 20, 'num_epochs' : 1, 'spikes_per_epoch' : 1000,
+              'upsampling_factor' : 200 / 82, 'spread_threshold' : 0.12, 'site_range' : 16}
+
+    sparse, spike_count, coords, labels, metrics = extract_waveforms(data, spike_times, spike_clusters, templates,
+                                                                    channel_map, 1.0, 30000.0, 20e-6, params,
+                                                                    unit_channels = unit_channels,
+                                                                    channel_pos = channel_pos,
+                                                                    peak_channels = peak_channels)
+
+    assert(np.array_equal(spike_count[:, 0], spike_counts))
+
+    for cluster_id in [0, 7, 8, 9]:
+        channels = unit_channels[cluster_id]
+        channels = channels[channels >= 0]
+        times = spike_times[spike_clusters == cluster_id]
+        expected = np.mean([data[t - 20:t + 62, channels].T for t in times], 0)
+        expected = expected - expected[:, :1]
+        assert(np.allclose(sparse[cluster_id, -1, 0, :channels.size], expected, atol = 1e-3))
+        # the peak (local channel 0) carries the spike
+        assert(np.min(sparse[cluster_id, -1, 0, 0]) < -50)
+
+def old_clus_table(spike_clusters, spike_templates, templates, w_inv, channel_map):
+
+    # clus_Table as built by the loop in the original getSortResults
+    unqLabel, labelCounts = np.unique(spike_clusters, return_counts = True)
+    peak_channels = np.zeros([unqLabel.size,], 'uint32')
+
+    for i in np.arange(0, unqLabel.size):
+        curr_spkTemplate = spike_templates[np.where(spike_clusters == unqLabel[i])]
+        template_mode = np.argmax(np.bincount(curr_spkTemplate))
+        curr_unwh = np.matmul(w_inv, templates[template_mode,:].T)
+        peak_channels[i] = channel_map[np.argmax(np.max(curr_unwh,1) - np.min(curr_unwh,1))]
+
+    clus_Table = np.zeros((np.max(unqLabel) + 1, 2), dtype = 'uint32')
+    clus_Table[unqLabel, 0] = labelCounts
+    clus_Table[unqLabel, 1] = peak_channels
+
+    return clus_Table
+
+
+@pytest.mark.parametrize('pre_samples', [20, 10, 30])
+def test_template_waveforms(pre_samples):
+
+    from ecephys_spike_sorting.modules.mean_waveforms.template_waveforms import calculate_template_waveforms
+
+    rng = np.random.default_rng(1)
+
+    num_templates = 5
+    num_channels = 12
+    num_sites = 16
+    channel_map = np.array([0, 1, 2, 3, 5, 6, 7, 8, 9, 10, 12, 14])
+
+    templates = rng.normal(0, 0.05, (num_templates, 61, num_channels))
+    templates[np.arange(num_templates), 20, [1, 4, 6, 9, 11]] = [-3, -2, -4, -5, -1]
+
+    # Kilosort's inverse whitening matrix is symmetric
+    w_inv = rng.normal(0, 0.1, (num_channels, num_channels))
+    w_inv = np.eye(num_channels) * 2 + (w_inv + w_inv.T) / 2
+
+    # template 1 split into clusters 1 and 6, templates 3 and 4 merged into
+    # cluster 3 (mostly template 4), no spikes for clusters 2, 4 and 5
+    spike_templates = rng.choice(np.array([0, 1, 3, 4, 4]), 500)
+    spike_clusters = np.array([0, 1, 2, 3, 3])[spike_templates]
+    spike_clusters[(spike_templates == 1) & (rng.random(500) < 0.4)] = 6
+    amplitudes = rng.uniform(5, 20, 500)
+
+    mean_waveforms, snr_array, clus_table = calculate_template_waveforms(spike_clusters, spike_templates, amplitudes,
+                                                                         templates, w_inv, channel_map, 0.195,
+                                                                         num_sites, 82, pre_samples)
+
+    assert(np.array_equal(clus_table, old_clus_table(spike_clusters, spike_templates, templates, w_inv, channel_map)))
+
+    # per-cluster, per-spike mean of the scaled, unwhitened templates
+    for cluster_id in range(7):
+
+        for_cluster = spike_clusters == cluster_id
+
+        expected = np.zeros((num_sites, 82))
+        expected_snr = 0
+
+        if np.any(for_cluster):
+            whitened = np.mean([a * templates[t] for t, a in zip(spike_templates[for_cluster], amplitudes[for_cluster])], 0)
+            unwhitened = np.matmul(whitened, w_inv) * 0.195
+
+            for sample in range(82):
+                t = sample - pre_samples + 20
+                if 0 <= t < 61:
+                    expected[channel_map, sample] = unwhitened[t]
+
+            peak = whitened[:, list(channel_map).index(clus_table[cluster_id, 1])]
+            expected_snr = (np.max(peak) - np.min(peak)) / 2
+
+        assert(np.allclose(mean_waveforms[cluster_id], expected, atol = 1e-4))
+        assert(np.isclose(snr_array[cluster_id, 0], expected_snr, atol = 1e-4))
+        assert(snr_array[cluster_id, 1] == np.sum(for_cluster))
+
+
+def extract_curated_waveforms(tmpdir, **kwargs):
+
+    from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import get_sparse_channel_map
+    from ecephys_spike_sorting.common.kilosort_dataset import get_majority_templates
+    from ecephys_spike_sorting.common.epoch import Epoch
+
+    rng = np.random.default_rng(0)
+
+    data, spike_times, spike_clusters, spike_templates, templates, template_peaks, channel_map, channel_pos = \
+        make_curated_recording(rng)
+
+    raw_file = str(tmpdir.join('continuous.dat'))
+    np.round(data).astype('int16').tofile(raw_file)
+    raw_data = np.memmap(raw_file, dtype = 'int16', mode = 'r', shape = data.shape)
+
+    peak_channels = channel_map[template_peaks[get_majority_templates(spike_clusters, spike_templates)[1]]]
+    unit_channels = get_sparse_channel_map(channel_map, channel_pos, peak_channels, 50)
+
+    params = {'samples_per_spike' : 82, 'pre_samples' : 20, 'num_epochs' : 2, 'spikes_per_epoch' : 30,
+              'upsampling_factor' : 200 / 82, 'spread_threshold' : 0.12, 'site_range' : 16}
+    params.update(kwargs.pop('params', {}))
+
+    epochs = [Epoch('first_second', 0, 1), Epoch('complete_session', 0, np.inf)]
+
+    np.random.seed(3)
+    return extract_waveforms(raw_data, spike_times, spike_clusters, templates, channel_map, 0.195, 30000.0, 20e-6,
+                             params, epochs, unit_channels = unit_channels, channel_pos = channel_pos,
+                             peak_channels = peak_channels, **kwargs)
+
+
+@pytest.mark.parametrize('io_concurrency', [0, 1])
+def test_extract_waveforms_pool(tmpdir, io_concurrency):
+
+    # the serial path is the reference for the worker pool
+    mean_waveforms, spike_count, coords, labels, metrics = extract_curated_waveforms(tmpdir)
+
+    pool_waveforms, pool_count, pool_coords, pool_labels, pool_metrics = \
+        extract_curated_waveforms(tmpdir, params = {'num_workers' : 2, 'io_concurrency' : io_concurrency})
+
+    assert(np.sum(spike_count[:, 0]) > 0)
+    assert(np.array_equal(pool_count, spike_count))
+    assert(np.array_equal(pool_waveforms, mean_waveforms, equal_nan = True))
+    assert(pool_labels == labels)
+    pd.testing.assert_frame_equal(pool_metrics, metrics)
+
+
+def test_extract_waveforms_spike_index(tmpdir):
+
+    from ecephys_spike_sorting.common.kilosort_dataset import KilosortDataset, SPIKE_INDEX_FILES
+
+    # the same spikes as extract_curated_waveforms, saved as a Kilosort output
+    data, spike_times, spike_clusters, spike_templates, templates, template_peaks, channel_map, channel_pos = \
+        make_curated_recording(np.random.default_rng(0))
+
+    ks_dir = str(tmpdir.mkdir('kilosort'))
+    np.save(os.path.join(ks_dir, 'spike_times.npy'), spike_times.astype('uint64'))
+    np.save(os.path.join(ks_dir, 'spike_clusters.npy'), spike_clusters.astype('int32'))
+
+    mean_waveforms, spike_count, coords, labels, metrics = extract_curated_waveforms(tmpdir)
+
+    index_waveforms, index_count, index_coords, index_labels, index_metrics = \
+        extract_curated_waveforms(tmpdir, cluster_spikes = KilosortDataset(ks_dir).cluster_spikes)
+
+    assert(all(os.path.exists(os.path.join(ks_dir, f)) for f in SPIKE_INDEX_FILES))
+    assert(np.array_equal(index_count, spike_count))
+    assert(np.array_equal(index_waveforms, mean_waveforms, equal_nan = True))
+    pd.testing.assert_frame_equal(index_metrics, metrics)
+
+    # merging 7 and 9 in phy rewrites spike_clusters.npy; the index follows
+    spike_clusters[spike_clusters == 9] = 7
+    clusters_file = os.path.join(ks_dir, 'spike_clusters.npy')
+    np.save(clusters_file, spike_clusters.astype('int32'))
+    index_time = os.stat(os.path.join(ks_dir, SPIKE_INDEX_FILES[0])).st_mtime
+    os.utime(clusters_file, (index_time + 1, index_time + 1))
+
+    ks = KilosortDataset(ks_dir)
+
+    assert(np.array_equal(ks.cluster_spikes(7), np.flatnonzero(spike_clusters == 7)))
+    assert(ks.cluster_spikes(9).size == 0)
+
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+@pytest.mark.parametrize('store_name', ['waveforms.nc', 'waveforms.zarr'])
+def test_waveform_store(tmpdir, store_name, num_workers):
+
+    import xarray as xr
+
+    # the in-memory cube is the reference for the streamed store
+    mean_waveforms, spike_count, coords, labels, metrics = extract_curated_waveforms(tmpdir)
+
+    store_file = str(tmpdir.join(store_name))
+    last_epoch, store_count, store_coords, store_labels, store_metrics = \
+        extract_curated_waveforms(tmpdir, store_file = store_file, params = {'num_workers' : num_workers})
+
+    assert(np.array_equal(last_epoch, mean_waveforms[:, -1:], equal_nan = True))
+    assert(np.array_equal(store_count, spike_count))
+    pd.testing.assert_frame_equal(store_metrics, metrics)
+
+    if store_name.endswith('.zarr'):
+        store = xr.open_zarr(store_file, consolidated = False)
+    else:
+        store = xr.open_dataset(store_file, engine = 'h5netcdf')
+
+    with store:
+        assert(list(store['waveforms'].dims) == labels)
+        encoding = store['waveforms'].encoding
+        assert(tuple(encoding.get('chunksizes', encoding.get('chunks')))[0] == 1)
+        assert(np.array_equal(store['waveforms'].values, mean_waveforms, equal_nan = True))
+        assert(np.array_equal(store['spike_count'].values, spike_count[:, :mean_waveforms.shape[1]]))
+        assert(list(store['epoch'].values) == list(coords[1][:mean_waveforms.shape[1]]))
+
+
+def fake_c_waves(clus_table, spike_times, spike_clusters, num_sites = 8, num_samples = 10):
+
+    # stands in for C_Waves: each output row depends only on the spikes and
+    # clus_Table row of that cluster ID
+    mean_waveforms = np.zeros((clus_table.shape[0], num_sites, num_samples), dtype = 'float32')
+    snr_array = np.zeros((clus_table.shape[0], 2))
+
+    for cluster_id in np.flatnonzero(clus_table[:, 0] > 0):
+        times = spike_times[spike_clusters == cluster_id] % 997
+        mean_waveforms[cluster_id, clus_table[cluster_id, 1] % num_sites] = np.mean(times) + np.arange(num_samples)
+        snr_array[cluster_id] = [np.std(times), times.size]
+
+    return mean_waveforms, snr_array
+
+
+def make_clus_table(spike_clusters, spike_templates, template_peaks):
+
+    clus_table = np.zeros((np.max(spike_clusters) + 1, 2), dtype = 'uint32')
+    for cluster_id in np.unique(spike_clusters):
+        clus_table[cluster_id, 0] = np.sum(spike_clusters == cluster_id)
+        clus_table[cluster_id, 1] = template_peaks[np.argmax(np.bincount(spike_templates[spike_clusters == cluster_id]))]
+
+    return clus_table
+
+
+@pytest.mark.parametrize('curation', ['merge', 'split', 'reassign', 'merge_last', 'none'])
+def test_incremental_c_waves(tmpdir, curation):
+
+    from ecephys_spike_sorting.modules.mean_waveforms.incremental import find_changed_clusters, \
+        write_cluster_subset, copy_unchanged_rows
+
+    rng = np.random.default_rng(4)
+
+    template_peaks = rng.integers(0, 64, 10)
+    spike_templates = rng.integers(0, 10, 3000)
+    spike_times = np.sort(rng.choice(10 ** 6, 3000, replace = False))
+    prev_labels = spike_templates.astype('uint32')
+
+    labels = prev_labels.copy()
+    if curation == 'merge':
+        labels[np.isin(labels, [2, 3])] = 10
+        expected_changed = [2, 3, 10]
+    elif curation == 'split':
+        labels[(labels == 4) & (spike_times % 2 == 0)] = 10
+        expected_changed = [4, 10]
+    elif curation == 'reassign':
+        labels[np.flatnonzero(labels == 5)[:3]] = 6
+        expected_changed = [5, 6]
+    elif curation == 'merge_last':
+        labels[labels == 9] = 1
+        expected_changed = [1, 9]
+    else:
+        expected_changed = []
+
+    prev_table = make_clus_table(prev_labels, spike_templates, template_peaks)
+    clus_table = make_clus_table(labels, spike_templates, template_peaks)
+    prev_waveforms, prev_snr = fake_c_waves(prev_table, spike_times, prev_labels)
+
+    # incremental update, as in calculate_mean_waveforms
+    changed = find_changed_clusters(prev_labels, labels, prev_table, clus_table)
+    assert(set(expected_changed) <= set(changed))
+    assert(0 not in changed)
+    changed = changed[changed < clus_table.shape[0]]
+
+    table_npy, time_npy, lbl_npy = write_cluster_subset(str(tmpdir), clus_table, spike_times, labels, changed)
+    mean_waveforms, snr_array = fake_c_waves(np.load(table_npy), np.load(time_npy), np.load(lbl_npy))
+    assert(mean_waveforms.shape[0] == clus_table.shape[0])
+
+    unchanged = np.setdiff1d(np.flatnonzero(clus_table[:, 0] > 0), changed)
+    mean_waveforms = copy_unchanged_rows(mean_waveforms, prev_waveforms, unchanged)
+    snr_array = copy_unchanged_rows(snr_array, prev_snr, unchanged)
+
+    # matches a full recomputation
+    expected_waveforms, expected_snr = fake_c_waves(clus_table, spike_times, labels)
+
+    assert(np.array_equal(mean_waveforms, expected_waveforms))
+    assert(np.array_equal(snr_array, expected_snr))
+
+    # a rerun of postprocessing changes the spike set; everything is recomputed
+    assert(find_changed_clusters(prev_labels[1:], labels, prev_table, clus_table) is None)
+
+
+def test_waveform_store_pool_memory(tmpdir, monkeypatch):
+
+    import ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms as extract_module
+    from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import get_sparse_channel_map
+
+    rng = np.random.default_rng(5)
+
+    data, spike_times, spike_clusters, spike_templates, templates, template_peaks, channel_map, channel_pos = \
+        make_curated_recording(rng)
+
+    # many small units, so there are more batches than can be in flight
+    num_units = 40
+    spike_clusters = rng.integers(0, num_units, spike_times.size)
+    peak_channels = rng.integers(0, channel_map.size, num_units)
+    unit_channels = get_sparse_channel_map(channel_map, channel_pos, peak_channels, 50)
+
+    raw_file = str(tmpdir.join('continuous.dat'))
+    np.round(data).astype('int16').tofile(raw_file)
+    raw_data = np.memmap(raw_file, dtype = 'int16', mode = 'r', shape = data.shape)
+
+    # shared memory allocated by this process, in bytes
+    allocated = {'live' : 0, 'peak' : 0}
+
+    class TrackedSharedMemory(extract_module.shared_memory.SharedMemory):
+
+        def __init__(self, name = None, create = False, size = 0):
+            super().__init__(name, create, size)
+            self.tracked_size = size if create else 0
+            allocated['live'] += self.tracked_size
+            allocated['peak'] = max(allocated['peak'], allocated['live'])
+
+        def unlink(self):
+            allocated['live'] -= self.tracked_size
+            super().unlink()
+
+    monkeypatch.setattr(extract_module.shared_memory, 'SharedMemory', TrackedSharedMemory)
+
+    params = {'samples_per_spike' : 82, 'pre_samples' : 20, 'num_epochs' : 1, 'spikes_per_epoch' : 5,
+              'upsampling_factor' : 200 / 82, 'spread_threshold' : 0.12, 'site_range' : 16}
+
+    results = []
+    for num_workers, store_name in [(1, None), (2, 'waveforms.nc')]:
+        np.random.seed(3)
+        store_file = None if store_name is None else str(tmpdir.join(store_name))
+        results.append(extract_waveforms(raw_data, spike_times, spike_clusters, templates, channel_map, 0.195,
+                                         30000.0, 20e-6, dict(params, num_workers = num_workers), None,
+                                         unit_channels = unit_channels, channel_pos = channel_pos,
+                                         peak_channels = peak_channels, store_file = store_file))
+
+    mean_waveforms = results[0][0]
+    assert(np.array_equal(results[1][0], mean_waveforms[:, -1:], equal_nan = True))
+
+    with h5py.File(str(tmpdir.join('waveforms.nc')), 'r') as f:
+        assert(np.array_equal(f['waveforms'][:], mean_waveforms, equal_nan = True))
+
+    # 8 batches of 5 units, and at most 2 x 2 workers batches are in flight
+    assert(allocated['live'] == 0)
+    assert(0 < allocated['peak'] <= mean_waveforms.nbytes // 2)
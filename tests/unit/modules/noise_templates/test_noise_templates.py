@@ -2,7 +2,10 @@ import pytest
 import numpy as np
 import os
 
-from ecephys_spike_sorting.modules.noise_templates.id_noise_templates import id_noise_templates_rf
+import ecephys_spike_sorting.modules.noise_templates.id_noise_templates as id_noise_templates
+from ecephys_spike_sorting.modules.noise_templates.id_noise_templates import id_noise_templates_rf, \
+	check_template_spread, check_template_shape, check_template_shapes, get_classifier_features, \
+	check_template_spatial_peaks, template_spatial_peaks_range, MIN_TEMPLATES_PER_WORKER
 import ecephys_spike_sorting.common.utils as utils
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
@@ -20,4 +23,165 @@ def test_noise_templates():
 	
 	cluster_ids, is_noise = id_noise_templates_rf(spike_times, spike_clusters, cluster_ids, templates, params)
 
-	assert(len(cluster_ids) == len(is_noise))
\ No newline at end of file
+	assert(len(cluster_ids) == len(is_noise))
+
+
+def test_check_template_spread():
+
+	params = {'smoothed_template_amplitude_threshold' : 0.2,
+			  'template_amplitude_threshold' : 0.2,
+			  'smoothed_template_filter_width' : 2,
+			  'min_spread_threshold' : 4,
+			  'mid_spread_threshold' : 16,
+			  'max_spread_threshold' : 25,
+			  'template_shape_channel_range' : 12,
+			  'wavelet_index' : 2,
+			  'min_wavelet_peak_height' : 0.0,
+			  'min_wavelet_peak_loc' : 15,
+			  'max_wavelet_peak_loc' : 25}
+
+	num_channels = 96
+	t = np.arange(61)[:, np.newaxis]
+	channels = np.arange(num_channels)[np.newaxis, :]
+
+	templates = np.zeros((4, 61, num_channels))
+	templates[0] = -np.exp(-0.5 * ((t - 20) / 2) ** 2) * np.exp(-0.5 * ((channels - 40) / 4) ** 2)   # spike
+	templates[1] = -np.exp(-0.5 * ((t - 20) / 2) ** 2) * np.exp(-0.5 * ((channels - 40) / 0.5) ** 2) # one channel
+	templates[2] = -np.exp(-0.5 * ((t - 20) / 2) ** 2) * np.ones((1, num_channels))                  # whole probe
+	templates[3] = -np.exp(-0.5 * ((t - 20 - 0.5 * np.abs(channels - 40)) / 2) ** 2) * \
+					np.exp(-0.5 * ((channels - 40) / 8) ** 2)                                         # wide, travelling
+
+	is_noise = check_template_spread(templates, np.arange(num_channels), params)
+
+	assert(np.array_equal(is_noise[:3], [False, True, True]))
+	assert(np.array_equal(check_template_shapes(templates, params),
+						  [check_template_shape(template, params) for template in templates]))
+
+
+SPATIAL_PEAKS_PARAMS = {'channel_amplitude_thresh' : 0.25,
+						'peak_height_thresh' : 0.2,
+						'peak_prominence_thresh' : 0.2,
+						'peak_channel_range' : 24,
+						'peak_locs_std_thresh' : 3.5,
+						'multiprocessing_worker_count' : 2}
+
+
+def make_spatial_peak_templates(rng, num_templates, num_channels = 96):
+
+	t = np.arange(82)[:, np.newaxis]
+	channels = np.arange(num_channels)[np.newaxis, :]
+
+	# one spatial peak, or two (every third template)
+	templates = rng.normal(0, 0.02, (num_templates, 82, num_channels)).astype('float32')
+	for k in range(num_templates):
+		spread = np.exp(-0.5 * ((channels - rng.integers(10, num_channels - 10)) / rng.uniform(2, 6)) ** 2)
+		if k % 3 == 0:
+			spread = spread + np.exp(-0.5 * ((channels - rng.integers(10, num_channels - 10)) / 3) ** 2)
+		templates[k] += -np.exp(-0.5 * ((t - 20) / 3) ** 2) * spread
+
+	return templates
+
+
+def test_spatial_peaks_pool(monkeypatch):
+
+	params = SPATIAL_PEAKS_PARAMS
+
+	rng = np.random.default_rng(0)
+
+	num_templates = 2 * MIN_TEMPLATES_PER_WORKER + 7
+	num_channels = 96
+	templates = make_spatial_peak_templates(rng, num_templates, num_channels)
+
+	channel_map = np.arange(num_channels)
+
+	# the pool is only used with more than one CPU
+	monkeypatch.setattr(id_noise_templates.multiprocessing, 'cpu_count', lambda: 2)
+
+	is_noise = check_template_spatial_peaks(templates, channel_map, params)
+	expected = template_spatial_peaks_range(templates, channel_map, params, 0, num_templates)
+
+	assert(np.array_equal(is_noise, expected))
+	assert(0 < np.sum(is_noise) < num_templates)
+
+
+def test_spatial_peaks_geometry():
+
+	from ecephys_spike_sorting.common.probe_geometry import ProbeGeometry
+
+	rng = np.random.default_rng(1)
+
+	num_templates = 40
+	num_channels = 96
+	templates = make_spatial_peak_templates(rng, num_templates, num_channels)
+	channel_map = np.arange(num_channels)
+
+	# NP1.0 positions give the same result as the built-in NP1.0 layout
+	np1_pos = id_noise_templates.actual_channel_locations(channel_map)
+	expected = template_spatial_peaks_range(templates, channel_map, SPATIAL_PEAKS_PARAMS, 0, num_templates)
+
+	is_noise = template_spatial_peaks_range(templates, channel_map, SPATIAL_PEAKS_PARAMS, 0, num_templates,
+											ProbeGeometry(np1_pos))
+
+	assert(np.array_equal(is_noise, expected))
+	assert(0 < np.sum(expected) < num_templates)
+
+	# two shanks 250 um apart; each template is checked on its own shank only
+	two_shanks = np.zeros((num_templates, 82, 2 * num_channels), dtype = 'float32')
+	two_shanks[:num_templates // 2, :, :num_channels] = templates[:num_templates // 2]
+	two_shanks[num_templates // 2:, :, num_channels:] = templates[num_templates // 2:]
+
+	positions = np.concatenate((np1_pos, np1_pos + [250, 0]))
+	geometry = ProbeGeometry(positions, [0] * num_channels + [1] * num_channels)
+
+	is_noise = check_template_spatial_peaks(two_shanks, np.arange(2 * num_channels),
+											dict(SPATIAL_PEAKS_PARAMS, multiprocessing_worker_count = 1), geometry)
+
+	assert(np.array_equal(is_noise, expected))
+
+
+def old_classifier_features(templates, units, peak_channels):
+
+	# per-unit loop of id_noise_templates_rf before get_classifier_features
+	feature_matrix = np.zeros((units.size, 61, 32))
+
+	for idx, unit in enumerate(units):
+		peak_channel = peak_channels[unit]
+		min_chan = np.max([0, peak_channel - 16])
+		if min_chan == 0:
+			max_chan = 32
+		else:
+			max_chan = np.min([templates.shape[2], peak_channel + 16])
+			if max_chan == templates.shape[2]:
+				min_chan = max_chan - 32
+		feature_matrix[idx, :, :] = templates[unit, :, min_chan:max_chan]
+
+	# np.reshape(..., 2) was a Fortran-order reshape in the numpy the classifier was trained with
+	feature_matrix = np.reshape(feature_matrix, (units.size, 61 * 32), order = 'F')
+
+	return feature_matrix[:, ::4]
+
+
+@pytest.mark.parametrize('removed_channels', [[], [191]])
+def test_classifier_features(removed_channels):
+
+	rng = np.random.default_rng(0)
+
+	# NP1.0 site positions, as in depth_estimation.py
+	channels = np.delete(np.arange(384), removed_channels)
+	channel_pos = np.stack((np.array([43, 11, 59, 27])[channels % 4], 20 * (channels // 2 + 1)), 1)
+
+	num_channels = channels.size
+	templates = rng.standard_normal((50, 61, num_channels))
+	units = np.arange(50)
+
+	peak_channels = np.concatenate(([0, 10, 16, 17, 200, num_channels - 17, num_channels - 16, num_channels - 1],
+									rng.integers(0, num_channels, 42)))
+	expected = old_classifier_features(templates, units, peak_channels)
+
+	assert(np.array_equal(get_classifier_features(templates, units, None, peak_channels), expected))
+	assert(np.array_equal(get_classifier_features(templates, units, channel_pos, peak_channels), expected))
+
+	# default peak channels (largest peak-to-peak amplitude)
+	ptp_peaks = np.argmax(np.max(templates, 1) - np.min(templates, 1), 1)
+	assert(np.array_equal(get_classifier_features(templates, units[::3], channel_pos),
+						  old_classifier_features(templates, units[::3], ptp_peaks)))
@@ -3,6 +3,9 @@ import numpy as np
 import os
 
 from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_metrics
+from ecephys_spike_sorting.common.feature_store import BlockedArray, write_blocked_array
+from ecephys_spike_sorting.common.epoch import Epoch
+from ecephys_spike_sorting.common.probe_geometry import ProbeGeometry
 import ecephys_spike_sorting.common.utils as utils
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
@@ -31,6 +34,97 @@ def te_st_quality_metrics():
 
 	print(metrics)
 
+
+def make_pc_dataset(num_units=5, num_spikes=3000, num_channels=16):
+
+	rng = np.random.RandomState(0)
+
+	spike_clusters = rng.randint(num_units, size=num_spikes)
+	spike_times = np.sort(rng.rand(num_spikes) * 200.0)
+	amplitudes = rng.rand(num_spikes) + 10.0
+
+	channel_map = np.arange(num_channels)
+	channel_pos = np.zeros((num_channels, 2))
+	channel_pos[:,0] = np.tile([16, 48], num_channels // 2)
+	channel_pos[:,1] = np.repeat(np.arange(num_channels // 2) * 20.0, 2)
+
+	peak_channels = np.arange(num_units) * 3
+	pc_feature_ind = np.minimum(peak_channels[:,None] + np.arange(6), num_channels - 1)
+
+	pc_features = rng.randn(num_spikes, 3, 6).astype('float32')
+	pc_features[:,0,0] += 5.0 + spike_clusters
+
+	templates = np.zeros((num_units, 82, num_channels), dtype='float32')
+
+	return spike_times, spike_clusters, spike_clusters.copy(), amplitudes, channel_map, \
+		channel_pos, templates, pc_features, pc_feature_ind
+
+
+@pytest.mark.parametrize('epochs', [None, [Epoch('first', 0, 120), Epoch('second', 80, 200)]])
+def test_blocked_pc_features(tmpdir, monkeypatch, epochs):
+
+	spike_times, spike_clusters, spike_templates, amplitudes, channel_map, \
+		channel_pos, templates, pc_features, pc_feature_ind = make_pc_dataset()
+
+	params = {'include_pcs': True, 'isi_threshold': 0.0015, 'min_isi': 0.0, 'tbin_sec': 0.001,
+			  'max_radius_um': 68, 'max_spikes_for_unit': 500, 'max_spikes_for_nn': 1000,
+			  'n_neighbors': 4, 'n_silhouette': 1000, 'drift_metrics_interval_s': 51,
+			  'drift_metrics_min_spikes_per_interval': 10}
+
+	# the silhouette score uses np.in1d, which newer numpy only provides as np.isin
+	if not hasattr(np, 'in1d'):
+		monkeypatch.setattr(np, 'in1d', np.isin, raising=False)
+
+	np.random.seed(1)
+	expected = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map,
+								 channel_pos, templates, pc_features, pc_feature_ind, params, epochs)
+
+	store = write_blocked_array(str(tmpdir.join('pc_features.blk')), pc_features, block_size=256)
+
+	# the blocked store must only be read through per-unit gathers
+	def no_materialize(self, dtype=None, copy=None):
+		raise AssertionError('pc_features decompressed as a whole')
+
+	monkeypatch.setattr(BlockedArray, '__array__', no_materialize)
+
+	np.random.seed(1)
+	metrics = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map,
+								channel_pos, templates, store, pc_feature_ind, params, epochs)
+
+	assert(metrics.shape == expected.shape)
+	assert(np.allclose(metrics.select_dtypes('number').values, expected.select_dtypes('number').values, equal_nan=True))
+
+
+
+def test_pc_metrics_kilosort_geometry(tmpdir, monkeypatch):
+
+	spike_times, spike_clusters, spike_templates, amplitudes, channel_map, \
+		channel_pos, templates, pc_features, pc_feature_ind = make_pc_dataset()
+
+	np.save(str(tmpdir.join('channel_positions.npy')), channel_pos)
+
+	params = {'include_pcs': True, 'isi_threshold': 0.0015, 'min_isi': 0.0, 'tbin_sec': 0.001,
+			  'max_radius_um': 68, 'max_spikes_for_unit': 500, 'max_spikes_for_nn': 1000,
+			  'n_neighbors': 4, 'n_silhouette': 1000, 'drift_metrics_interval_s': 51,
+			  'drift_metrics_min_spikes_per_interval': 10}
+
+	if not hasattr(np, 'in1d'):
+		monkeypatch.setattr(np, 'in1d', np.isin, raising=False)
+
+	np.random.seed(1)
+	expected = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map,
+								 channel_pos, templates, pc_features, pc_feature_ind, params)
+
+	geometry = ProbeGeometry.from_kilosort(str(tmpdir))
+
+	np.random.seed(1)
+	metrics = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map,
+								channel_pos, templates, pc_features, pc_feature_ind, params, geometry=geometry)
+
+	assert(np.allclose(metrics.select_dtypes('number').values, expected.select_dtypes('number').values, equal_nan=True))
+	assert('distances' not in vars(geometry))
+
+
 if __name__ == "__main__":
     #test_quality_metrics()
     pass
\ No newline at end of file